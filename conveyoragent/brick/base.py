@@ -18,12 +18,15 @@ Helper code for the iSCSI volume driver.
 
 """
 
+import shlex
+
 from oslo_concurrency import processutils as putils
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from conveyoragent.brick import exception
 from conveyoragent.brick import executor
+from conveyoragent.brick import processes
 
 disk_data_opts = [
     cfg.IntOpt('ibs',
@@ -207,17 +210,34 @@ class MigrationCmd(BaseCmd):
                       {'dir_name': dir_name, 'error': e})
             raise exception.MakeDirError(error=e)
 
+    def _run_tracked(self, service, port, *cmd):
+        """Run cmd as root as the process of service on port, until it
+        ends.
+        """
+        argv = [str(arg) for arg in cmd]
+        if self._root_helper:
+            argv = shlex.split(self._root_helper) + argv
+        try:
+            process = processes.start(service, port, argv)
+        except OSError as e:
+            raise putils.ProcessExecutionError(cmd=' '.join(argv),
+                                               description=str(e))
+        returncode = process.wait()
+        if returncode:
+            raise putils.ProcessExecutionError(
+                exit_code=returncode, stderr=process.stderr(),
+                cmd=' '.join(argv))
+
     def fillp_start_server(self, address, port, des_dev, protocol):
 
         LOG.debug("Fillp server start for %s", port)
         try:
-            (out, err) = self._execute('fillp', 'start', 'server',
-                                       '-d', address,
-                                       '-p', port,
-                                       '-t', des_dev,
-                                       '-o', protocol,
-                                       run_as_root=True)
-            return out
+            self._run_tracked(protocol + '-server', port,
+                              'fillp', 'start', 'server',
+                              '-d', address,
+                              '-p', port,
+                              '-t', des_dev,
+                              '-o', protocol)
         except putils.ProcessExecutionError as e:
             _msg = 'Fill server start error: %s' % unicode(e)
             LOG.error(_msg)
@@ -228,41 +248,48 @@ class MigrationCmd(BaseCmd):
         LOG.debug('Fillp send data start for %(src_dev)s to %(des_dev)s',
                   {'src_dev': src_dev, 'des_dev': des_dev})
         try:
-            (out, err) = self._execute('fillp', 'send',
-                                       '-d', address,
-                                       '-p', port,
-                                       '-s', src_dev,
-                                       '-t', des_dev,
-                                       '-b', offset,
-                                       '-o', protocol,
-                                       run_as_root=True)
-            return out
+            self._run_tracked(protocol + '-client', port,
+                              'fillp', 'send',
+                              '-d', address,
+                              '-p', port,
+                              '-s', src_dev,
+                              '-t', des_dev,
+                              '-b', offset,
+                              '-o', protocol)
         except putils.ProcessExecutionError as e:
             _msg = 'Fillp send data error: %s' % unicode(e)
             LOG.error(_msg)
             raise exception.FillServerError(error=_msg)
 
-    def fillp_query_status(self, service):
+    def fillp_query_status(self, service, port=None):
+        """0 while the process of service on port runs, 1 once it ended
+        well or if there is none, -1 if it failed.
+        """
         LOG.debug('Fillp query status start for %(service)s',
                   {'service': service})
-        try:
-            (out, err) = self._execute('ps', 'aux', run_as_root=True)
-            lines = out.split('\n')
-            for line in lines:
-                if service in line:
-                    return 0
-            return 1
-        except putils.ProcessExecutionError as e:
-            _msg = 'Fillp query status error: %s' % unicode(e)
-            LOG.error(_msg)
-            raise exception.FillServerError(error=_msg)
+        return processes.status(service, port=port)
+
+    def fillp_query_process(self, service, port=None):
+        """Pid, exit code and end of stderr of the process of service on
+        port, None if there is none.
+        """
+        process = processes.find(service, port=port)
+        return process.to_dict() if process else None
 
-    def fillp_close_connect(self, service, protocol):
+    def fillp_close_connect(self, service, protocol, port=None):
+        """Stop the fillp service, only the process of port if given."""
         LOG.debug('Fillp stop server start')
+        cmd = ['fillp', 'close', service, '-o', protocol]
+        if port is not None:
+            process = processes.find(protocol + '-' + service, port=port)
+            if process is None or process.returncode is not None:
+                LOG.debug('Fillp %(service)s of port %(port)s not running',
+                          {'service': service, 'port': port})
+                return None
+            # the processes of the other transfers keep running
+            cmd += ['-i', process.pid]
         try:
-            (out, err) = self._execute('fillp', 'close',
-                                       service, '-o', protocol,
-                                       run_as_root=True)
+            (out, err) = self._execute(*cmd, run_as_root=True)
             return out
         except putils.ProcessExecutionError as e:
             _msg = 'Fillp stop error: %s' % unicode(e)
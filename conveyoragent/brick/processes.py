@@ -0,0 +1,155 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Transfer processes the agent started, followed by their pid.
+
+The agent keeps the child of every transfer process it starts, by service
+and port, and a thread of each child waits for it to end. Their status is
+then what that waitpid returned rather than a scan of the process table:
+two transfers of the same service are told apart, a failed one is seen as
+failed, and no query spawns a process or blocks. The last lines a process
+wrote to stderr are kept with its exit code. Each process leads a process
+group of its own, which is what stopping its transfer kills.
+"""
+
+import collections
+import os
+import subprocess
+import threading
+
+import six
+
+from oslo_log import log as logging
+
+LOG = logging.getLogger(__name__)
+
+# as the status of a transfer the source agent reports
+RUNNING = 0
+FINISHED = 1
+FAILED = -1
+
+# lines of stderr kept of a process
+_TAIL_LINES = 20
+# ended processes kept for their status
+_MAX_ENDED = 64
+
+_lock = threading.Lock()
+# (service, port): TrackedProcess, oldest first
+_processes = collections.OrderedDict()
+
+
+class TrackedProcess(object):
+    """A child process reaped by a thread of its own, which reads its
+    stderr until it ends.
+    """
+
+    def __init__(self, service, port, argv):
+        self.service = service
+        self.port = port
+        self.argv = argv
+        self.stderr_tail = collections.deque(maxlen=_TAIL_LINES)
+        # exit code, None while running
+        self.returncode = None
+        self._ended = threading.Event()
+        with open(os.devnull, 'r+b') as devnull:
+            self._proc = subprocess.Popen(argv, stdin=devnull,
+                                          stdout=devnull,
+                                          stderr=subprocess.PIPE,
+                                          close_fds=True,
+                                          preexec_fn=os.setsid)
+        self.pid = self._proc.pid
+        reaper = threading.Thread(target=self._reap,
+                                  name='reap-%d' % self.pid)
+        reaper.daemon = True
+        reaper.start()
+
+    def _reap(self):
+        stderr = self._proc.stderr
+        try:
+            for line in iter(stderr.readline, b''):
+                if not isinstance(line, six.text_type):
+                    line = line.decode('utf-8', 'replace')
+                self.stderr_tail.append(line.rstrip())
+        finally:
+            stderr.close()
+            # the only waitpid of the child, status queries never race it
+            self.returncode = self._proc.wait()
+            self._ended.set()
+
+    def wait(self):
+        """Wait for the process to end, returns its exit code.
+
+        Blocks the thread calling it.
+        """
+        self._ended.wait()
+        return self.returncode
+
+    def status(self):
+        returncode = self.returncode
+        if returncode is None:
+            return RUNNING
+        return FINISHED if returncode == 0 else FAILED
+
+    def stderr(self):
+        return '\n'.join(self.stderr_tail)
+
+    def to_dict(self):
+        return {'pid': self.pid,
+                'service': self.service,
+                'port': self.port,
+                'returncode': self.returncode,
+                'stderr': self.stderr()}
+
+
+def _port(port):
+    return None if port is None else str(port)
+
+
+def start(service, port, argv):
+    """Start argv as the process of service on port, returns it."""
+    port = _port(port)
+    process = TrackedProcess(service, port, argv)
+    LOG.debug("Started %(service)s process %(pid)s for port %(port)s",
+              {'service': service, 'pid': process.pid, 'port': port})
+    with _lock:
+        _processes.pop((service, port), None)
+        _processes[(service, port)] = process
+        ended = [key for key, p in _processes.items()
+                 if p.returncode is not None]
+        for key in ended[:max(len(ended) - _MAX_ENDED, 0)]:
+            del _processes[key]
+    return process
+
+
+def find(service, port=None):
+    """The process of service on port, else the last one of service
+    still running or else started.
+    """
+    with _lock:
+        if port is not None:
+            return _processes.get((service, _port(port)))
+        processes = [p for key, p in _processes.items()
+                     if key[0] == service]
+    for process in reversed(processes):
+        if process.returncode is None:
+            return process
+    return processes[-1] if processes else None
+
+
+def status(service, port=None):
+    """Status of the process of service on port, FINISHED if it has
+    none.
+    """
+    process = find(service, port=port)
+    if process is None:
+        return FINISHED
+    return process.status()
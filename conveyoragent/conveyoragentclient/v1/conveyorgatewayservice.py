@@ -48,7 +48,11 @@ class VServiceManager(base.Manager):
 
     def clone_volume(self, src_dev_name, des_dev_name, src_dev_format,
                      src_mount_point, src_gw_url, des_gw_url,
-                     trans_protocol=None, trans_port=None):
+                     trans_protocol=None, trans_port=None,
+                     des_dev_fresh=False, stream_count=None,
+                     compression=None, dedup=False, delta=False,
+                     verify=False, bandwidth_limit=None, bundle=False,
+                     sync=False):
         '''Clone volume data'''
 
         LOG.debug("Clone volume data start")
@@ -62,7 +66,16 @@ class VServiceManager(base.Manager):
                 'src_gw_url': src_gw_url,
                 'des_gw_url': des_gw_url,
                 'trans_protocol': trans_protocol,
-                'trans_port': trans_port
+                'trans_port': trans_port,
+                'des_dev_fresh': des_dev_fresh,
+                'stream_count': stream_count,
+                'compression': compression,
+                'dedup': dedup,
+                'delta': delta,
+                'verify': verify,
+                'bandwidth_limit': bandwidth_limit,
+                'bundle': bundle,
+                'sync': sync
             }
         }
 
@@ -71,6 +84,102 @@ class VServiceManager(base.Manager):
                   {'dev': src_dev_name, 'rsp': rsp})
         return rsp
 
+    def clone_volumes(self, volumes, policy=None):
+        '''Clone a batch of volumes, each a dict of the arguments of
+        clone_volume, returns the job id and the task ids
+        '''
+
+        LOG.debug("Clone %s volumes start", len(volumes))
+        body = {'clone_volumes': {'volumes': volumes, 'policy': policy}}
+        rsp = self._clone_volume("/v2vGateWayServices", body)
+        LOG.debug("Clone volumes end: %s", rsp)
+        return rsp
+
+    def get_clone_job(self, job_id):
+        '''Tasks of a batch of clones and their states'''
+
+        url = '/v2vGateWayServices/%s' % job_id
+        return self._get(url)
+
+    def resume_clone_volume(self, task_id):
+        '''Resume an interrupted clone volume task'''
+
+        LOG.debug("Resume clone volume task %s start", task_id)
+        body = {'resumeCloneVolume': {}}
+        url = '/v2vGateWayServices/%s/action' % task_id
+        rsp = self._post(url, body)
+        LOG.debug("Resume clone volume task %(task_id)s end: %(rsp)s",
+                  {'task_id': task_id, 'rsp': rsp})
+        return rsp
+
+    def set_bandwidth_limit(self, limit, task_id=None):
+        '''Limit the bytes per second of a task, or of the whole agent'''
+
+        LOG.debug("Set bandwidth limit of %(task_id)s to %(limit)s start",
+                  {'task_id': task_id, 'limit': limit})
+        body = {'setBandwidthLimit': {'limit': limit, 'task_id': task_id}}
+        url = '/v2vGateWayServices/%s/action' % (task_id or
+                                                 uuidutils.generate_uuid())
+        return self._post(url, body)
+
+    def send_bundle(self, address, port, path, token, max_size=None):
+        '''Send the small files of path in a tar stream to address:port,
+        after the token its receiver made
+        '''
+
+        LOG.debug("Send bundle of %(path)s to %(address)s:%(port)s",
+                  {'path': path, 'address': address, 'port': port})
+        body = {'sendBundle': {'trans_ip': address,
+                               'trans_port': port,
+                               'path': path,
+                               'token': token,
+                               'max_size': max_size}}
+        url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
+        return self._post(url, body)
+
+    def start_file_server(self, path):
+        '''Serve path to a destination pulling it, returns port and token'''
+
+        LOG.debug("Start file server of %s", path)
+        body = {'startFileServer': {'path': path}}
+        url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
+        return self._post(url, body)
+
+    def stop_file_server(self, port):
+        '''Stop the file server listening on port'''
+
+        LOG.debug("Stop file server on %s", port)
+        body = {'stopFileServer': {'port': port}}
+        url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
+        return self._post(url, body)
+
+    def transfer_done(self, callback_id, status, error=None):
+        '''Push the end of the transfer callback_id is waited on with'''
+
+        LOG.debug("Push end of transfer %(id)s: %(status)s",
+                  {'id': callback_id, 'status': status})
+        body = {'transferDone': {'callback_id': callback_id,
+                                 'status': status,
+                                 'error': error}}
+        url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
+        return self._post(url, body)
+
+    def get_transfer_stats(self):
+        '''Queue depth, workers busy and wait and run times of the
+        transfers of the agent
+        '''
+
+        body = {'getTransferStats': {}}
+        url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
+        return self._post(url, body)
+
+    def get_ftp_stats(self):
+        '''Transfers, bytes and rate of the ftp downloads of the agent'''
+
+        body = {'getFtpStats': {}}
+        url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
+        return self._post(url, body)
+
     def mount_disk(self, dev_name, mount_point):
         '''Mount disk'''
 
@@ -125,34 +234,62 @@ class VServiceManager(base.Manager):
         return dev_name
 
     def start_transformer_data(self, address, port,
-                               src_dev, des_dev, protocol):
+                               src_dev, des_dev, protocol, options=None):
         LOG.debug("Start query source vm agent service to to send data")
         body = {'fillpTransFormerData':
                     {'trans_ip': address,
                      'trans_port': port,
                      'src_disk': src_dev,
                      'des_disk': des_dev,
-                     'protocol': protocol}}
+                     'protocol': protocol,
+                     'options': options or {}}}
         url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
-        self._post(url, body)
+        rsp = self._post(url, body)
         LOG.debug("End query source vm agent service to send data")
+        return rsp
+
+    def get_transformer_tree(self, address, port, protocol, level=None,
+                             indexes=None, release=False):
+        LOG.debug("Start query transformer data tree")
+        body = {'getTransformerTree':
+                    {'trans_ip': address,
+                     'trans_port': port,
+                     'protocol': protocol,
+                     'level': level,
+                     'indexes': indexes,
+                     'release': release}}
+        url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
+        rsp = self._post(url, body)
+        LOG.debug("End query transformer data tree")
+        return rsp
 
     def stop_transformer_data(self, task_id):
         pass
 
-    def get_data_transformer_status(self, protocol):
+    def get_data_transformer_status(self, protocol, port=None):
+        '''Status of the transfer of protocol to port, with the pid, exit
+        code and end of stderr of its process
+        '''
         LOG.debug("Start query data transformer status")
-        body = {'fillpTransFormerStatus': {'protocol': protocol}}
+        body = {'fillpTransFormerStatus': {'protocol': protocol,
+                                           'port': port}}
         url = '/v2vGateWayServices/%s/action' % uuidutils.generate_uuid()
         rsp = self._post(url, body)
         LOG.debug("End query data transformer status %s", rsp.get('status'))
         return rsp
 
-    def get_data_trans_status(self, task_id):
+    def get_data_trans_status(self, task_id, wait=None, since=None):
+        '''State of task_id, once it changed past version since if wait
+        seconds are given
+        '''
 
         LOG.debug("Query data transformer state start")
 
         url = '/v2vGateWayServices/%s' % task_id
+        if wait is not None:
+            url += '?wait=%d' % wait
+            if since is not None:
+                url += '&since=%d' % since
 
         rsp = self._get(url)
 
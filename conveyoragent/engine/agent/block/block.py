@@ -0,0 +1,1221 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process block device streaming.
+
+The source agent opens the source device itself and streams it, chunk by
+chunk, over a TCP connection to a receiver running inside the destination
+agent, which writes every chunk at its offset on the destination device.
+
+With deduplication on, the sender offers the digest of each data chunk
+first and only ships the chunks the receiver cannot copy from a volume it
+already wrote. In delta mode the receiver streams the digests of what the
+destination already holds and only the chunks that differ are sent.
+
+The receiver can keep a completion bitmap of the transfer on disk, from
+which an interrupted transfer resumes by only sending the missing chunks.
+
+A verified transfer has both ends build a Merkle tree of the data as it
+flows, compared once the transfer is over.
+
+Both ends draw the bytes they move from token buckets: the sender from
+the bucket of its agent, the receiver from the buckets of its agent and
+of its task, which slows the sender down through TCP flow control.
+"""
+
+import collections
+import io
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from conveyoragent.engine.agent.block import checkpoint
+from conveyoragent.engine.agent.block import chunk_index
+from conveyoragent.engine.agent.block import merkle
+from conveyoragent.engine.agent.block import sparse
+from conveyoragent.engine.common import compression
+from conveyoragent.engine.common import throttle
+from conveyoragent import exception
+
+block_opts = [
+    cfg.IntOpt('block_chunk_size',
+               default=4 * 1024 * 1024,
+               help='Size in bytes of each chunk read from the source '
+                    'device, rounded down to a multiple of '
+                    'block_alignment'),
+    cfg.IntOpt('block_alignment',
+               default=4096,
+               help='Alignment in bytes of the chunks read from the source '
+                    'device'),
+    cfg.IntOpt('block_socket_buffer_size',
+               default=4 * 1024 * 1024,
+               help='Size in bytes of the kernel send and receive buffers '
+                    'of block transfer sockets'),
+    cfg.IntOpt('block_socket_timeout',
+               default=300,
+               help='Seconds a block transfer connection may stay idle '
+                    'before its stream is retried'),
+    cfg.IntOpt('block_stream_count',
+               default=1,
+               help='Default number of parallel connections used for one '
+                    'block transfer, overridden by stream_count in the '
+                    'clone request'),
+    cfg.IntOpt('block_max_stream_count',
+               default=16,
+               help='Upper bound of the stream count of one block '
+                    'transfer'),
+    cfg.IntOpt('block_stream_retries',
+               default=3,
+               help='Times a failed or stalled stream is retried from its '
+                    'last acknowledged offset'),
+    cfg.IntOpt('block_sync_interval',
+               default=64 * 1024 * 1024,
+               help='Bytes a stream sends between two acknowledgement '
+                    'requests'),
+    cfg.IntOpt('block_dedup_window',
+               default=16,
+               help='Chunk digests a deduplicating stream may offer before '
+                    'waiting for the receiver to answer them'),
+    cfg.IntOpt('block_delta_window',
+               default=16,
+               help='Chunks ahead of the one being sent whose destination '
+                    'digests a delta stream asks for'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(block_opts)
+
+LOG = logging.getLogger(__name__)
+
+# A block stream is a HELLO, then frames each followed by 'length' bytes of
+# payload, then an END frame which the receiver answers with an ACK.
+MAGIC = b'CVBK'
+VERSION = 1
+HELLO = struct.Struct('!4sBQ')
+FRAME = struct.Struct('!BQQ')
+ACK = struct.Struct('!BQ')
+# follows a FRAME_ZDATA frame: codec, length once decompressed
+ZHEADER = struct.Struct('!BQ')
+# follows an ACK_MISSING answer: length of the missing extent
+EXTENT = struct.Struct('!Q')
+
+FRAME_END = 0
+FRAME_DATA = 1
+# a range reading back as zeros, sent without payload
+FRAME_ZERO = 2
+# asks the receiver to acknowledge everything up to offset, 'length'
+# being the bytes before offset sent since the previous one; FRAME_END
+# carries the same
+FRAME_SYNC = 3
+# a compressed chunk, 'length' being the compressed size
+FRAME_ZDATA = 4
+# sender statistics, the offset field carrying compression microseconds
+FRAME_STATS = 5
+# the digest of a chunk, answered by ACK_HAVE or ACK_NEED
+FRAME_OFFER = 6
+# asks for the digest of a chunk of the destination, answered by ACK_SUM
+FRAME_SUMS = 7
+# asks for the parts of a range the destination misses, answered by
+# ACK_MISSING extents ending with an empty one
+FRAME_MISSING = 8
+# asks for the leaf size of the receiver's Merkle tree, answered by
+# ACK_TREE, 0 when the receiver does not verify
+FRAME_TREE = 9
+
+ACK_OK = 0
+ACK_ERROR = 1
+ACK_SYNC = 2
+# the offered chunk was copied locally, or has to be sent
+ACK_HAVE = 3
+ACK_NEED = 4
+# followed by the digest of the destination chunk at offset
+ACK_SUM = 5
+ACK_MISSING = 6
+ACK_TREE = 7
+
+# values reported through query_transformer_task_status, the same ones the
+# fillp wrapper reports: 0 still sending, 1 finished
+STATUS_RUNNING = 0
+STATUS_FINISHED = 1
+STATUS_ERROR = -1
+
+
+def chunk_size():
+    alignment = max(CONF.block_alignment, 1)
+    size = CONF.block_chunk_size - CONF.block_chunk_size % alignment
+    return max(size, alignment)
+
+
+def device_size(fd):
+    """Size of a regular file or a block device opened as fd."""
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def recv_exact(sock, size):
+    data = b''
+    while len(data) < size:
+        part = sock.recv(size - len(data))
+        if not part:
+            raise EOFError("Connection closed by peer")
+        data += part
+    return data
+
+
+def recv_into_exact(sock, view):
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise EOFError("Connection closed by peer")
+        received += n
+    return received
+
+
+def pwrite(fd, data, offset):
+    """Write all of data at offset without relying on a shared position."""
+    view = memoryview(data)
+    if hasattr(os, 'pwrite'):
+        written = 0
+        while written < len(view):
+            written += os.pwrite(fd, view[written:], offset + written)
+        return written
+
+    os.lseek(fd, offset, os.SEEK_SET)
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
+    return written
+
+
+def set_socket_buffers(sock):
+    size = CONF.block_socket_buffer_size
+    if size > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, size)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+
+class BlockSender(threading.Thread):
+    """Streams a source device to a BlockReceiver.
+
+    The device is split into stream_count ranges, each one moved by a
+    RangeStream over its own connection.
+    """
+
+    def __init__(self, address, port, src_dev, des_dev, stream_count=1,
+                 compression=None, dedup=False, delta=False,
+                 resume=False, ranges=None, verify=False, tree=None,
+                 limiter=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.address = address
+        self.port = int(port)
+        self.src_dev = src_dev
+        self.des_dev = des_dev
+        self.stream_count = max(int(stream_count), 1)
+        self.compression = compression
+        self.dedup = dedup
+        self.delta = delta
+        # only send what the receiver's checkpoint misses
+        self.resume = resume
+        # only send these (offset, length) ranges
+        self.ranges = ranges
+        self.verify = verify
+        # Merkle tree of the data sent, kept from an earlier sender of the
+        # same transfer
+        self.tree = tree
+        self._tree_lock = threading.Lock()
+        # throttle.Limiter the data sent is drawn from
+        self.limiter = limiter
+        self.streams = []
+        self.state = STATUS_RUNNING
+        self.error = None
+
+    @property
+    def bytes_sent(self):
+        return sum(s.bytes_sent for s in self.streams)
+
+    @property
+    def bytes_skipped(self):
+        return sum(s.bytes_skipped for s in self.streams)
+
+    @property
+    def bytes_deduped(self):
+        return sum(s.bytes_deduped for s in self.streams)
+
+    @property
+    def bytes_matched(self):
+        return sum(s.bytes_matched for s in self.streams)
+
+    def run(self):
+        try:
+            self.send()
+            self.state = STATUS_FINISHED
+            LOG.debug("Block send %(src)s to %(address)s:%(port)s finished: "
+                      "%(sent)s bytes sent, %(skipped)s zero bytes skipped, "
+                      "%(deduped)s bytes deduplicated, %(matched)s bytes "
+                      "already on the destination",
+                      {'src': self.src_dev, 'address': self.address,
+                       'port': self.port, 'sent': self.bytes_sent,
+                       'skipped': self.bytes_skipped,
+                       'deduped': self.bytes_deduped,
+                       'matched': self.bytes_matched})
+        except Exception as e:
+            self.error = e
+            self.state = STATUS_ERROR
+            LOG.error("Block send %(src)s to %(address)s:%(port)s error: "
+                      "%(error)s",
+                      {'src': self.src_dev, 'address': self.address,
+                       'port': self.port, 'error': e})
+
+    def send(self):
+        src = io.open(self.src_dev, 'rb', buffering=0)
+        try:
+            size = device_size(src.fileno())
+        finally:
+            src.close()
+
+        self.streams = [RangeStream(self, index, start, end)
+                        for index, (start, end)
+                        in enumerate(split_ranges(size, self.stream_count))]
+        for stream in self.streams:
+            stream.start()
+        for stream in self.streams:
+            stream.join()
+
+        failed = [s for s in self.streams if s.state != STATUS_FINISHED]
+        if failed:
+            raise exception.DownLoadDataError(
+                error="%(failed)d of %(total)d streams failed: %(error)s" %
+                      {'failed': len(failed), 'total': len(self.streams),
+                       'error': failed[0].error})
+
+    def get_tree(self, size, leaf_size):
+        with self._tree_lock:
+            if (self.tree is None or self.tree.size != size or
+                    self.tree.leaf_size != leaf_size):
+                self.tree = merkle.MerkleTree(size, leaf_size)
+            return self.tree
+
+    def connect(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        set_socket_buffers(sock)
+        sock.settimeout(CONF.block_socket_timeout)
+        sock.connect((self.address, self.port))
+        return sock
+
+
+def split_ranges(size, count):
+    """Split [0, size) into at most count chunk aligned ranges."""
+    chunk = chunk_size()
+    chunks = max((size + chunk - 1) // chunk, 1)
+    per_range = (chunks + count - 1) // count * chunk
+    return [(start, min(start + per_range, size))
+            for start in range(0, max(size, 1), per_range)]
+
+
+class RangeStream(threading.Thread):
+    """Sends [range_start, range_end) of the source over one connection.
+
+    The receiver acknowledges FRAME_SYNC frames as it goes, so after a
+    stall or a dropped connection the stream is retried on its own from
+    the last acknowledged offset while the other streams carry on.
+    """
+
+    def __init__(self, sender, index, range_start, range_end):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sender = sender
+        self.index = index
+        self.range_start = range_start
+        self.range_end = range_end
+        # everything below committed is written on the destination,
+        # everything below position has been sent
+        self.committed = range_start
+        self._sent = range_start
+        self.state = STATUS_RUNNING
+        self.error = None
+        self.attempts = 0
+        self.bytes_sent = 0
+        self.bytes_skipped = 0
+        self.bytes_deduped = 0
+        self.bytes_matched = 0
+        # (offset, length) of the offered chunks not answered yet
+        self._offers = collections.deque()
+        # offset -> digest of the destination chunks received in delta
+        # mode, and the offset digests have been asked for up to
+        self._sums = {}
+        self._sums_requested = 0
+        self._src = None
+        self._resend_buf = None
+        self._tree = None
+        self._zero_range = None
+        self._synced = range_start
+        self.compressor = None
+        if sender.compression:
+            self.compressor = compression.AdaptiveCompressor(
+                sender.compression)
+        self._reported_time = 0.0
+
+    def run(self):
+        retries = max(CONF.block_stream_retries, 0)
+        while True:
+            self.attempts += 1
+            try:
+                self.send()
+                self.state = STATUS_FINISHED
+                return
+            except Exception as e:
+                self.error = e
+                if self.attempts > retries:
+                    self.state = STATUS_ERROR
+                    LOG.error("Block stream %(index)s of %(src)s error: "
+                              "%(error)s",
+                              {'index': self.index,
+                               'src': self.sender.src_dev, 'error': e})
+                    return
+                LOG.warning("Block stream %(index)s of %(src)s error, "
+                            "retrying from offset %(offset)s: %(error)s",
+                            {'index': self.index,
+                             'src': self.sender.src_dev,
+                             'offset': self.committed, 'error': e})
+                time.sleep(self.attempts)
+
+    @property
+    def position(self):
+        if self._offers:
+            return self._offers[0][0]
+        return self._sent
+
+    def send(self):
+        self._sent = self._synced = self.committed
+        self._zero_range = None
+        self._offers.clear()
+        self._sums.clear()
+        self._sums_requested = 0
+        src = io.open(self.sender.src_dev, 'rb', buffering=0)
+        self._src = src
+        try:
+            sock = self.sender.connect()
+            try:
+                size = device_size(src.fileno())
+                sock.sendall(HELLO.pack(MAGIC, VERSION, size))
+                self._tree = None
+                if self.sender.verify:
+                    self._tree = self._query_tree(sock, size)
+                if self.sender.ranges is not None:
+                    for offset, length in self._own_ranges():
+                        self._send_ranges(sock, src, offset, offset + length)
+                elif self.sender.resume:
+                    for offset, length in self._query_missing(
+                            sock, self.committed, self.range_end):
+                        self._send_ranges(sock, src, offset, offset + length)
+                else:
+                    self._send_ranges(sock, src, self.committed,
+                                      self.range_end)
+                self._send_stats(sock)
+                sock.sendall(FRAME.pack(FRAME_END, self.range_end,
+                                        self.range_end - self._synced))
+                self._read_acks(sock, until_end=True)
+                self.committed = self.range_end
+            finally:
+                sock.close()
+        finally:
+            src.close()
+
+    def _own_ranges(self):
+        for offset, length in sorted(self.sender.ranges):
+            start = max(offset, self.committed)
+            end = min(offset + length, self.range_end)
+            if start < end:
+                yield start, end - start
+
+    def _query_tree(self, sock, size):
+        sock.sendall(FRAME.pack(FRAME_TREE, 0, 0))
+        status, leaf_size = ACK.unpack(recv_exact(sock, ACK.size))
+        if status != ACK_TREE:
+            raise exception.DownLoadDataError(
+                error="receiver failed after %d bytes" % leaf_size)
+        if not leaf_size:
+            LOG.warning("Block receiver of %s does not verify",
+                        self.sender.des_dev)
+            return None
+        return self.sender.get_tree(size, leaf_size)
+
+    def _feed(self, offset, view):
+        if self._tree is not None:
+            self._tree.feed(offset, view.tobytes())
+
+    def _query_missing(self, sock, start, end):
+        sock.sendall(FRAME.pack(FRAME_MISSING, start, end - start))
+        extents = []
+        while True:
+            status, value = ACK.unpack(recv_exact(sock, ACK.size))
+            if status != ACK_MISSING:
+                raise exception.DownLoadDataError(
+                    error="receiver failed after %d bytes" % value)
+            length, = EXTENT.unpack(recv_exact(sock, EXTENT.size))
+            if not length:
+                break
+            extents.append((value, length))
+        LOG.debug("Block stream %(index)s of %(src)s resumes %(missing)s "
+                  "of %(total)s bytes",
+                  {'index': self.index, 'src': self.sender.src_dev,
+                   'missing': sum(length for _o, length in extents),
+                   'total': end - start})
+        return extents
+
+    def _send_ranges(self, sock, src, start, end):
+        fd = src.fileno()
+        if sparse.seek_data_supported(fd):
+            # holes of files are found without reading them, and data
+            # extents can go out through sendfile
+            ranges = sparse.extents(fd, start, end)
+            use_sendfile = (hasattr(os, 'sendfile') and not self.compressor
+                            and not self.sender.dedup
+                            and not self.sender.delta
+                            and self._tree is None)
+        else:
+            ranges = [(start, end - start, True)]
+            use_sendfile = False
+
+        chunk = chunk_size()
+        buf = None
+        zeros = None
+        if not use_sendfile:
+            buf = memoryview(bytearray(chunk))
+            zeros = b'\0' * chunk
+
+        for offset, length, is_data in ranges:
+            if not is_data:
+                self._send_zero(sock, offset, length)
+                continue
+            end = offset + length
+            while offset < end:
+                length = min(chunk, end - offset)
+                if use_sendfile:
+                    self._send_data_header(sock, offset, length)
+                    self._sendfile(sock, src, offset, length)
+                elif self.sender.delta:
+                    self._request_sums(sock, offset, end)
+                    self._send_delta(sock, src, buf, zeros, offset, length)
+                else:
+                    self._sendbuf(sock, src, buf, zeros, offset, length)
+                offset += length
+                self._sync(sock)
+        self._flush_zero(sock)
+        self._read_offers(sock, 0)
+
+    def _send_data_header(self, sock, offset, length):
+        self._flush_zero(sock)
+        self._shape(length)
+        sock.sendall(FRAME.pack(FRAME_DATA, offset, length))
+        self.bytes_sent += length
+        self._advance(offset + length)
+
+    def _advance(self, end):
+        # chunks sent on ACK_NEED lie behind ranges sent after them
+        self._sent = max(self._sent, end)
+
+    def _send_zero(self, sock, offset, length):
+        if self._tree is not None:
+            self._tree.feed_zero(offset, length)
+        # adjacent zero ranges go out as a single descriptor
+        if self._zero_range:
+            start, size = self._zero_range
+            if start + size == offset:
+                self._zero_range = (start, size + length)
+                return
+            self._flush_zero(sock)
+        self._zero_range = (offset, length)
+
+    def _flush_zero(self, sock):
+        if self._zero_range:
+            start, size = self._zero_range
+            sock.sendall(FRAME.pack(FRAME_ZERO, start, size))
+            self.bytes_skipped += size
+            self._advance(start + size)
+            self._zero_range = None
+
+    def _sync(self, sock):
+        """Ask for an acknowledgement now and then, without waiting."""
+        if self.position - self._synced >= CONF.block_sync_interval:
+            self._send_stats(sock)
+            sock.sendall(FRAME.pack(FRAME_SYNC, self.position,
+                                    self.position - self._synced))
+            self._synced = self.position
+        self._read_acks(sock)
+
+    def _send_stats(self, sock):
+        if not self.compressor:
+            return
+        spent = self.compressor.stats.compress_time - self._reported_time
+        self._reported_time += spent
+        sock.sendall(FRAME.pack(FRAME_STATS, int(spent * 1000000), 0))
+
+    def _read_acks(self, sock, until_end=False):
+        while until_end or select.select([sock], [], [], 0)[0]:
+            if not self._read_ack(sock):
+                return
+
+    def _read_offers(self, sock, limit):
+        """Handle answers until at most limit offers are unanswered."""
+        while len(self._offers) > limit:
+            self._read_ack(sock)
+
+    def _read_ack(self, sock):
+        """Handle one answer of the receiver, False once it is done."""
+        status, value = ACK.unpack(recv_exact(sock, ACK.size))
+        if status in (ACK_HAVE, ACK_NEED):
+            if not self._offers or self._offers[0][0] != value:
+                raise exception.DownLoadDataError(
+                    error="unexpected answer for chunk at %d" % value)
+            offset, length = self._offers.popleft()
+            if status == ACK_HAVE:
+                self.bytes_deduped += length
+            else:
+                self._resend(sock, offset, length)
+        elif status == ACK_SUM:
+            self._sums[value] = recv_exact(sock, chunk_index.DIGEST_SIZE)
+        elif status == ACK_SYNC:
+            self.committed = value
+        elif status == ACK_OK:
+            return False
+        else:
+            raise exception.DownLoadDataError(
+                error="receiver failed after %d bytes" % value)
+        return True
+
+    def _sendfile(self, sock, src, offset, length):
+        sent = 0
+        while sent < length:
+            n = os.sendfile(sock.fileno(), src.fileno(),
+                            offset + sent, length - sent)
+            if not n:
+                raise EOFError("Source %s ended early" %
+                               self.sender.src_dev)
+            sent += n
+
+    def _read_chunk(self, src, buf, offset, length):
+        src.seek(offset)
+        view = buf[:length]
+        read = 0
+        while read < length:
+            n = src.readinto(view[read:])
+            if not n:
+                raise EOFError("Source %s ended early" %
+                               self.sender.src_dev)
+            read += n
+        return view
+
+    def _sendbuf(self, sock, src, buf, zeros, offset, length):
+        view = self._read_chunk(src, buf, offset, length)
+        self._send_view(sock, view, zeros, offset, length)
+
+    def _request_sums(self, sock, offset, end):
+        """Keep the digests of the next chunks up to end on their way."""
+        chunk = chunk_size()
+        limit = min(end, offset + max(CONF.block_delta_window, 1) * chunk)
+        start = max(self._sums_requested, offset)
+        while start < limit:
+            length = min(chunk, end - start)
+            sock.sendall(FRAME.pack(FRAME_SUMS, start, length))
+            start += length
+        self._sums_requested = start
+
+    def _send_delta(self, sock, src, buf, zeros, offset, length):
+        view = self._read_chunk(src, buf, offset, length)
+        ours = chunk_index.digest(view)
+        while offset not in self._sums:
+            self._read_ack(sock)
+        if self._sums.pop(offset) == ours:
+            self._feed(offset, view)
+            self._flush_zero(sock)
+            self.bytes_matched += length
+            self._advance(offset + length)
+            return
+        self._send_view(sock, view, zeros, offset, length)
+
+    def _send_view(self, sock, view, zeros, offset, length):
+        if sparse.is_zero(view, zeros):
+            self._send_zero(sock, offset, length)
+            return
+
+        self._feed(offset, view)
+        if self.sender.dedup:
+            self._offer(sock, view, offset, length)
+        else:
+            self._send_chunk(sock, view, offset, length)
+
+    def _offer(self, sock, view, offset, length):
+        # the chunk is read again if the receiver needs it, answers come
+        # back in order while further offers go out
+        self._flush_zero(sock)
+        sock.sendall(FRAME.pack(FRAME_OFFER, offset, length) +
+                     chunk_index.digest(view))
+        self._offers.append((offset, length))
+        self._advance(offset + length)
+        self._read_offers(sock, max(CONF.block_dedup_window, 1) - 1)
+
+    def _resend(self, sock, offset, length):
+        if self._resend_buf is None:
+            self._resend_buf = memoryview(bytearray(chunk_size()))
+        view = self._read_chunk(self._src, self._resend_buf, offset, length)
+        self._send_chunk(sock, view, offset, length)
+
+    def _send_chunk(self, sock, view, offset, length):
+        payload = None
+        if self.compressor:
+            payload = self.compressor.compress(view)
+        if payload is None:
+            self._send_data_header(sock, offset, length)
+            self._send_payload(sock, view)
+        else:
+            self._flush_zero(sock)
+            self._shape(len(payload))
+            sock.sendall(FRAME.pack(FRAME_ZDATA, offset, len(payload)) +
+                         ZHEADER.pack(self.compressor.codec, length))
+            self._send_payload(sock, payload)
+            self.bytes_sent += len(payload)
+            self._advance(offset + length)
+
+    def _shape(self, length):
+        if self.sender.limiter:
+            self.sender.limiter.consume(length)
+
+    def _send_payload(self, sock, payload):
+        if not self.compressor:
+            sock.sendall(payload)
+            return
+        # the compression level follows the rate the link takes data at
+        start = time.time()
+        sock.sendall(payload)
+        self.compressor.record_send(len(payload), time.time() - start)
+
+
+class BlockReceiver(object):
+    """Accepts block streams and writes them to the destination device."""
+
+    def __init__(self, address, port, des_dev, fresh=False,
+                 compression_stats=None, chunk_index=None,
+                 checkpoint=None, verify=False, limiter=None,
+                 progress=None):
+        self.address = address
+        self.port = int(port)
+        self.des_dev = des_dev
+        # a freshly provisioned device already reads back as zeros
+        self.fresh = fresh
+        self.compression_stats = compression_stats
+        # shared by the receivers of the agent, answers FRAME_OFFER
+        self.chunk_index = chunk_index
+        # completion bitmap of the transfer, if it is kept
+        self.checkpoint = checkpoint
+        self.verify = verify
+        # Merkle tree of what was written, made once the size is known
+        self.tree = None
+        self._tree_lock = threading.Lock()
+        # throttle.Limiter the data received is drawn from
+        self.limiter = limiter
+        # progress.Progress of the bytes written, skipped ones included
+        self.progress = progress
+        self._progress_lock = threading.Lock()
+        self._sock = None
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        set_socket_buffers(sock)
+        sock.bind((self.address, self.port))
+        sock.listen(16)
+        # wake up now and then to notice stop()
+        sock.settimeout(1.0)
+        self._sock = sock
+        self.port = sock.getsockname()[1]
+
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        if self._sock:
+            self._sock.close()
+        if self.checkpoint:
+            self.checkpoint.close()
+
+    def _serve(self):
+        while not self._stopped:
+            try:
+                conn, peer = self._sock.accept()
+            except socket.timeout:
+                continue
+            except socket.error as e:
+                if not self._stopped:
+                    LOG.error("Block receiver on port %(port)s error: "
+                              "%(error)s", {'port': self.port, 'error': e})
+                break
+            handler = threading.Thread(target=self._receive,
+                                       args=(conn, peer))
+            handler.daemon = True
+            handler.start()
+
+    def _receive(self, conn, peer):
+        try:
+            conn.settimeout(CONF.block_socket_timeout)
+            written = self.receive(conn)
+            LOG.debug("Block receive from %(peer)s to %(des)s finished: "
+                      "%(written)s bytes",
+                      {'peer': peer, 'des': self.des_dev,
+                       'written': written})
+        except Exception as e:
+            LOG.error("Block receive from %(peer)s to %(des)s error: "
+                      "%(error)s",
+                      {'peer': peer, 'des': self.des_dev, 'error': e})
+        finally:
+            conn.close()
+
+    def receive(self, conn):
+        magic, version, size = HELLO.unpack(recv_exact(conn, HELLO.size))
+        if magic != MAGIC or version != VERSION:
+            raise exception.DownLoadDataError(error="bad block stream header")
+        if self.checkpoint:
+            self.checkpoint.prepare(size, chunk_size())
+        self._start_progress(size)
+        tree = self._get_tree(size)
+
+        buf = memoryview(bytearray(chunk_size()))
+        fd = os.open(self.des_dev, os.O_WRONLY)
+        written = 0
+        # offset -> (length, digest) of the offered chunks asked for
+        needed = {}
+        # files known chunks are copied from
+        sources = {}
+        # start of the range written but not recorded in the checkpoint
+        unrecorded = None
+        try:
+            while True:
+                ftype, offset, length = FRAME.unpack(
+                    recv_exact(conn, FRAME.size))
+                if ftype == FRAME_END:
+                    os.fsync(fd)
+                    self._record(unrecorded, offset, length)
+                    conn.sendall(ACK.pack(ACK_OK, written))
+                    return written
+                elif ftype == FRAME_DATA:
+                    self._receive_range(conn, fd, buf, offset, length, tree)
+                    written += length
+                    self._advance(length)
+                    if self.compression_stats:
+                        self.compression_stats.add(raw_bytes=length,
+                                                   wire_bytes=length)
+                    self._index_chunk(needed, offset, length)
+                elif ftype == FRAME_ZDATA:
+                    raw_length = self._receive_compressed(conn, fd, buf,
+                                                          offset, length,
+                                                          tree)
+                    written += raw_length
+                    self._advance(raw_length)
+                    self._index_chunk(needed, offset, raw_length)
+                elif ftype == FRAME_OFFER:
+                    key = recv_exact(conn, chunk_index.DIGEST_SIZE)
+                    if self._copy_known(fd, buf, sources, key, offset,
+                                        length, tree):
+                        written += length
+                        self._advance(length)
+                        conn.sendall(ACK.pack(ACK_HAVE, offset))
+                    else:
+                        needed[offset] = (length, key)
+                        conn.sendall(ACK.pack(ACK_NEED, offset))
+                elif ftype == FRAME_STATS:
+                    if self.compression_stats:
+                        self.compression_stats.add(
+                            compress_time=offset / 1000000.0)
+                elif ftype == FRAME_ZERO:
+                    if not self.fresh:
+                        sparse.zero_range(fd, offset, length)
+                    if tree:
+                        tree.feed_zero(offset, length)
+                    self._advance(length)
+                elif ftype == FRAME_SUMS:
+                    conn.sendall(ACK.pack(ACK_SUM, offset) +
+                                 self._checksum(buf, sources, offset, length,
+                                                tree))
+                elif ftype == FRAME_TREE:
+                    leaf_size = tree.leaf_size if tree else 0
+                    conn.sendall(ACK.pack(ACK_TREE, leaf_size))
+                elif ftype == FRAME_MISSING:
+                    conn.sendall(self._missing(offset, length))
+                elif ftype == FRAME_SYNC:
+                    if self.checkpoint and length:
+                        os.fsync(fd)
+                        unrecorded = self._record(unrecorded, offset, length)
+                    conn.sendall(ACK.pack(ACK_SYNC, offset))
+                else:
+                    raise exception.DownLoadDataError(
+                        error="unknown block frame %s" % ftype)
+        except Exception:
+            try:
+                conn.sendall(ACK.pack(ACK_ERROR, written))
+            except socket.error:
+                pass
+            raise
+        finally:
+            os.close(fd)
+            for source in sources.values():
+                source.close()
+
+    def _start_progress(self, size):
+        """Set the total of the progress, on the first stream."""
+        if self.progress is None:
+            return
+        with self._progress_lock:
+            if self.progress.total is not None:
+                return
+            self.progress.set_total(size)
+            missing = self.checkpoint and self.checkpoint.missing_bytes()
+            if missing is not None:
+                # written by the runs before
+                self.progress.start_at(size - missing)
+
+    def _advance(self, length):
+        if self.progress is not None:
+            self.progress.add(length)
+
+    def _record(self, unrecorded, end, length):
+        """Record the written [end - length, end) in the checkpoint.
+
+        Returns the start of the chunk end falls in, which the next range
+        of the stream completes.
+        """
+        if self.checkpoint is None:
+            return None
+        start = end - length
+        if unrecorded is not None:
+            start = min(start, unrecorded)
+        self.checkpoint.mark(start, end)
+        self.checkpoint.flush()
+        granularity = self.checkpoint.granularity or 1
+        return end - end % granularity
+
+    def _missing(self, offset, length):
+        if self.checkpoint is None:
+            extents = [(offset, length)]
+        else:
+            extents = self.checkpoint.missing(offset, offset + length)
+        answer = [ACK.pack(ACK_MISSING, start) + EXTENT.pack(size)
+                  for start, size in extents if size]
+        answer.append(ACK.pack(ACK_MISSING, offset + length) +
+                      EXTENT.pack(0))
+        return b''.join(answer)
+
+    def _open_source(self, sources, path):
+        source = sources.get(path)
+        if source is None:
+            source = sources[path] = io.open(path, 'rb', buffering=0)
+        return source
+
+    def _get_tree(self, size):
+        if not self.verify:
+            return None
+        with self._tree_lock:
+            if self.tree is None or self.tree.size != size:
+                self.tree = merkle.MerkleTree(size,
+                                              CONF.block_verify_leaf_size)
+            return self.tree
+
+    def _checksum(self, buf, sources, offset, length, tree=None):
+        """Digest of what the destination holds at [offset, offset+length).
+
+        A destination shorter than the range digests to what it has, which
+        never matches a full chunk of the source.
+        """
+        if length > len(buf):
+            buf = memoryview(bytearray(length))
+        view = buf[:length]
+        source = self._open_source(sources, self.des_dev)
+        source.seek(offset)
+        read = 0
+        while read < length:
+            n = source.readinto(view[read:])
+            if not n:
+                break
+            read += n
+        if tree:
+            # unchanged chunks are not sent but belong to the tree
+            tree.feed(offset, view[:read].tobytes())
+        return chunk_index.digest(view[:read])
+
+    def _copy_known(self, fd, buf, sources, key, offset, length,
+                    tree=None):
+        """Write the chunk with digest key from a known location, if any."""
+        if self.chunk_index is None or length > len(buf):
+            return False
+        location = self.chunk_index.lookup(key)
+        if location is None:
+            return False
+
+        path, src_offset, src_length = location
+        view = buf[:length]
+        try:
+            source = self._open_source(sources, path)
+            source.seek(src_offset)
+            read = 0
+            while src_length == length and read < length:
+                n = source.readinto(view[read:])
+                if not n:
+                    break
+                read += n
+        except (IOError, OSError) as e:
+            LOG.debug("Read known chunk from %(path)s failed: %(error)s",
+                      {'path': path, 'error': e})
+            read = 0
+
+        # the location may have been rewritten since it was indexed
+        if read != length or chunk_index.digest(view) != key:
+            self.chunk_index.discard(key)
+            return False
+        if (path, src_offset) != (self.des_dev, offset):
+            pwrite(fd, view, offset)
+        if tree:
+            tree.feed(offset, view.tobytes())
+        return True
+
+    def _index_chunk(self, needed, offset, length):
+        offered = needed.pop(offset, None)
+        if offered and offered[0] == length and self.chunk_index is not None:
+            self.chunk_index.add(offered[1], self.des_dev, offset, length)
+
+    def _receive_compressed(self, conn, fd, buf, offset, length, tree=None):
+        codec, raw_length = ZHEADER.unpack(recv_exact(conn, ZHEADER.size))
+        if length > len(buf):
+            buf = memoryview(bytearray(length))
+        view = buf[:length]
+        self._shape(length)
+        recv_into_exact(conn, view)
+
+        start = time.time()
+        data = compression.decompress(codec, view.tobytes())
+        if self.compression_stats:
+            self.compression_stats.add(raw_bytes=raw_length,
+                                       wire_bytes=length,
+                                       decompress_time=time.time() - start)
+        if len(data) != raw_length:
+            raise exception.DownLoadDataError(
+                error="chunk at %d decompressed to %d bytes instead of %d" %
+                      (offset, len(data), raw_length))
+        pwrite(fd, data, offset)
+        if tree:
+            tree.feed(offset, data)
+        return raw_length
+
+    def _shape(self, length):
+        if self.limiter:
+            self.limiter.consume(length)
+
+    def _receive_range(self, conn, fd, buf, offset, length, tree=None):
+        done = 0
+        while done < length:
+            view = buf[:min(len(buf), length - done)]
+            self._shape(len(view))
+            recv_into_exact(conn, view)
+            pwrite(fd, view, offset + done)
+            if tree:
+                tree.feed(offset + done, view.tobytes())
+            done += len(view)
+
+
+class BlockAgent(object):
+    """Transformer agent moving raw devices with BlockSender/BlockReceiver.
+
+    It exposes the same calls as the fillp agent so MigrationManager drives
+    both the same way, but runs entirely inside the agent process.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._lock = threading.Lock()
+        self._receivers = {}
+        self._senders = []
+        self._chunk_index = None
+        # (address, port) -> (src_dev, tree) of verified transfers, kept
+        # until their destination released them
+        self._trees = {}
+
+    def _get_chunk_index(self):
+        with self._lock:
+            if self._chunk_index is None:
+                self._chunk_index = chunk_index.ChunkIndex(
+                    path=CONF.block_dedup_index_path)
+                self._chunk_index.load()
+            return self._chunk_index
+
+    def start_fillp_server(self, address, port, des_dev, protocol,
+                           options=None):
+        options = options or {}
+        task_id = options.get('checkpoint')
+        bitmap = None
+        if task_id and CONF.block_checkpoint:
+            bitmap = checkpoint.Checkpoint(checkpoint.path_for(task_id))
+        receiver = BlockReceiver(
+            address, port, des_dev,
+            fresh=options.get('des_dev_fresh', False),
+            compression_stats=options.get('compression_stats'),
+            chunk_index=self._get_chunk_index(),
+            checkpoint=bitmap,
+            verify=options.get('verify', False),
+            limiter=options.get('limiter') or throttle.limiter(),
+            progress=options.get('progress'))
+        try:
+            receiver.start()
+        except Exception as e:
+            _msg = "Start block receiver failed: %s" % e
+            LOG.error(_msg)
+            raise exception.DownLoadDataError(error=_msg)
+
+        with self._lock:
+            old = self._receivers.pop(receiver.port, None)
+            self._receivers[receiver.port] = receiver
+        if old:
+            old.stop()
+        return receiver
+
+    def transformer_data(self, address, port, src_dev, des_dev, protocol,
+                         options=None):
+        options = options or {}
+        stream_count = options.get('stream_count') or CONF.block_stream_count
+        stream_count = min(int(stream_count), CONF.block_max_stream_count)
+        algorithm = options.get('compression')
+        if algorithm == compression.NONE:
+            algorithm = None
+        verify = options.get('verify', False)
+        tree = None
+        key = (address, int(port))
+        with self._lock:
+            kept = self._trees.pop(key, None)
+        if verify and kept and kept[0] == src_dev and (
+                options.get('resume') or options.get('ranges') is not None):
+            # more data for the same transfer
+            tree = kept[1].tree
+        sender = BlockSender(address, port, src_dev, des_dev,
+                             stream_count=stream_count,
+                             compression=algorithm,
+                             dedup=options.get('dedup', False),
+                             delta=options.get('delta', False),
+                             resume=options.get('resume', False),
+                             ranges=options.get('ranges'),
+                             verify=verify, tree=tree,
+                             limiter=throttle.limiter())
+        with self._lock:
+            # only running senders and the last finished one matter for
+            # the status
+            self._senders = [s for s in self._senders
+                             if s.state == STATUS_RUNNING]
+            self._senders.append(sender)
+            if verify:
+                self._trees[key] = (src_dev, sender)
+        try:
+            sender.start()
+        except Exception as e:
+            sender.state = STATUS_ERROR
+            _msg = "Block transformer data failed: %s" % e
+            LOG.error(_msg)
+            raise exception.DownLoadDataError(error=_msg)
+        return sender
+
+    def query_transformer_task_status(self, service_name, port=None):
+        with self._lock:
+            senders = [s for s in self._senders
+                       if port is None or s.port == int(port)]
+
+        if not senders:
+            return STATUS_FINISHED
+        if any(s.state == STATUS_RUNNING for s in senders):
+            return STATUS_RUNNING
+        return senders[-1].state
+
+    def missing_bytes(self, port):
+        """Bytes the checkpoint of the receiver on port still misses.
+
+        None when the receiver keeps no checkpoint or has not been reached
+        by any stream yet.
+        """
+        with self._lock:
+            receiver = self._receivers.get(int(port))
+        if receiver is None or receiver.checkpoint is None:
+            return None
+        return receiver.checkpoint.missing_bytes()
+
+    def compare_tree(self, port, remote, fetch):
+        """Ranges the receiver on port wrote differently from the source.
+
+        remote is the shape of the source tree, fetch(level, indexes)
+        returns the digests of its nodes.
+        """
+        with self._lock:
+            receiver = self._receivers.get(int(port))
+        if receiver is None or receiver.tree is None:
+            raise exception.DownLoadDataError(
+                error="no tree of the data received on port %s" % port)
+        tree = receiver.tree
+        if (remote.get('size') != tree.size or
+                remote.get('leaf_size') != tree.leaf_size):
+            raise exception.DownLoadDataError(
+                error="source tree of %(size)s bytes by %(leaf)s can not "
+                      "be compared with %(des)s" %
+                      {'size': remote.get('size'),
+                       'leaf': remote.get('leaf_size'),
+                       'des': receiver.des_dev})
+
+        tree.read_unknown(receiver.des_dev)
+        ranges = []
+        for index in merkle.differing_leaves(tree, fetch):
+            start, end = tree.leaf_range(index)
+            ranges.append([start, end - start])
+        return ranges
+
+    def get_sender_tree(self, address, port):
+        """Merkle tree of what was sent to address:port, all hashed."""
+        with self._lock:
+            kept = self._trees.get((address, int(port)))
+        if kept is None or kept[1].tree is None:
+            return None
+        src_dev, sender = kept
+        sender.tree.read_unknown(src_dev)
+        return sender.tree
+
+    def release_sender_tree(self, address, port):
+        with self._lock:
+            self._trees.pop((address, int(port)), None)
+
+    def remove_checkpoint(self, task_id):
+        checkpoint.remove(task_id)
+
+    def stop_fillp_server(self, service, protocol, port=None):
+        with self._lock:
+            if port is None:
+                receivers = list(self._receivers.values())
+                self._receivers.clear()
+            else:
+                receiver = self._receivers.pop(int(port), None)
+                receivers = [receiver] if receiver else []
+
+        for receiver in receivers:
+            receiver.stop()
+        # keep what this transfer wrote for the next agent run
+        if receivers and self._chunk_index is not None:
+            self._chunk_index.save()
@@ -0,0 +1,224 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Per chunk completion bitmap of a block transfer, kept on disk.
+
+The bitmap file is memory mapped, one bit per chunk, so even multi
+terabyte devices only need a few pages of memory. A bit is only set once
+the data of its chunk has been synced to the destination device.
+"""
+
+import mmap
+import os
+import struct
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+import six
+
+checkpoint_opts = [
+    cfg.BoolOpt('block_checkpoint',
+                default=True,
+                help='Keep a completion bitmap of block transfers so they '
+                     'can resume after a crash or a network failure'),
+    cfg.StrOpt('block_checkpoint_dir',
+               default='$state_path/block_checkpoints',
+               help='Directory of the completion bitmaps of block '
+                    'transfers'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(checkpoint_opts)
+
+LOG = logging.getLogger(__name__)
+
+_MAGIC = b'CVCP'
+_VERSION = 1
+# magic, version, device size, bytes per bit
+_HEADER = struct.Struct('!4sBQI')
+
+_BIT_COUNT = [bin(i).count('1') for i in range(256)]
+
+
+def path_for(task_id):
+    return os.path.join(CONF.block_checkpoint_dir, '%s.bitmap' % task_id)
+
+
+def remove(task_id):
+    try:
+        os.remove(path_for(task_id))
+    except OSError:
+        pass
+
+
+class Checkpoint(object):
+    """Thread safe completion bitmap of one transfer."""
+
+    def __init__(self, path):
+        self.path = path
+        self.size = None
+        self.granularity = None
+        self.count = 0
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def prepare(self, size, granularity):
+        """Open the bitmap of a size bytes device, keeping a matching one.
+
+        A bitmap left by an earlier attempt is only reused if it was made
+        for a device of the same size.
+        """
+        with self._lock:
+            if self._map is not None:
+                if self.size != size:
+                    raise ValueError("checkpoint of %d bytes, device of %d" %
+                                     (self.size, size))
+                return
+            header = self._read_header()
+            if header and header[0] == size:
+                size, granularity = header
+                LOG.info("Resume block transfer from checkpoint %s",
+                         self.path)
+            else:
+                self._create(size, granularity)
+            self._open(size, granularity)
+
+    def _read_header(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read(_HEADER.size)
+        except IOError:
+            return None
+        if len(data) != _HEADER.size:
+            return None
+        magic, version, size, granularity = _HEADER.unpack(data)
+        if magic != _MAGIC or version != _VERSION or not granularity:
+            return None
+        if (os.path.getsize(self.path) <
+                _HEADER.size + self._bitmap_size(size, granularity)):
+            return None
+        return size, granularity
+
+    @staticmethod
+    def _bitmap_size(size, granularity):
+        count = (size + granularity - 1) // granularity
+        return max((count + 7) // 8, 1)
+
+    def _create(self, size, granularity):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, size, granularity))
+            # a sparse run of zero bits
+            f.truncate(_HEADER.size + self._bitmap_size(size, granularity))
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def _open(self, size, granularity):
+        self._file = open(self.path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.size = size
+        self.granularity = granularity
+        self.count = (size + granularity - 1) // granularity
+
+    def _bit(self, index):
+        return six.indexbytes(self._map, _HEADER.size + index // 8) & (
+            1 << index % 8)
+
+    def mark(self, start, end):
+        """Record the chunks lying entirely in [start, end) as written."""
+        with self._lock:
+            if self._map is None:
+                return
+            g = self.granularity
+            first = (start + g - 1) // g
+            last = self.count if end >= self.size else end // g
+            index = first
+            while index < last:
+                pos = _HEADER.size + index // 8
+                if index % 8 == 0 and index + 8 <= last:
+                    # whole bytes at once
+                    n = (last - index) // 8
+                    self._map[pos:pos + n] = b'\xff' * n
+                    index += n * 8
+                    continue
+                byte = six.indexbytes(self._map, pos) | (1 << index % 8)
+                self._map[pos:pos + 1] = six.int2byte(byte)
+                index += 1
+
+    def missing(self, start, end):
+        """List (offset, length) of the unwritten parts of [start, end)."""
+        with self._lock:
+            if self._map is None:
+                return [(start, end - start)] if end > start else []
+            g = self.granularity
+            index = start // g
+            last = min((end + g - 1) // g, self.count)
+            extents = []
+            run = None
+            while index < last:
+                if (index % 8 == 0 and index + 8 <= last and
+                        six.indexbytes(self._map,
+                                       _HEADER.size + index // 8) == 0xff):
+                    written = 8
+                elif self._bit(index):
+                    written = 1
+                else:
+                    written = 0
+                    if run is None:
+                        run = index
+                if written and run is not None:
+                    extents.append(self._extent(run, index, start, end))
+                    run = None
+                index += written or 1
+            if run is not None:
+                extents.append(self._extent(run, last, start, end))
+            return extents
+
+    def _extent(self, first, last, start, end):
+        offset = max(first * self.granularity, start)
+        stop = min(last * self.granularity, end, self.size)
+        return offset, stop - offset
+
+    def missing_bytes(self):
+        """Bytes still to write, None until the device size is known."""
+        with self._lock:
+            if self._map is None:
+                return None
+            bitmap = bytearray(self._map[_HEADER.size:])
+            written = sum(_BIT_COUNT[b] for b in bitmap)
+            if self.count and self._bit(self.count - 1):
+                # the last chunk may be short
+                written_bytes = ((written - 1) * self.granularity +
+                                 self.size - (self.count - 1) *
+                                 self.granularity)
+            else:
+                written_bytes = written * self.granularity
+            return self.size - written_bytes
+
+    def flush(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._file.close()
+                self._map = None
+                self._file = None
@@ -0,0 +1,180 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Content addressed index of the chunks written by the block receiver.
+
+Each entry maps the digest of a chunk to a place it was written to on a
+destination device. Devices are rewritten behind the index's back, so an
+entry is only a hint: callers check the digest of the data they read at
+the location before using it.
+"""
+
+import collections
+import hashlib
+import os
+import struct
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+chunk_index_opts = [
+    cfg.IntOpt('block_dedup_index_size',
+               default=256 * 1024,
+               help='Number of chunk digests the block receiver remembers '
+                    'for deduplication, the least recently used ones are '
+                    'forgotten first'),
+    cfg.StrOpt('block_dedup_index_path',
+               default='$state_path/block_chunk_index',
+               help='File the block deduplication index is saved to '
+                    'between transfers'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(chunk_index_opts)
+
+LOG = logging.getLogger(__name__)
+
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+# file layout: header, the device paths each prefixed by its length, then
+# the entries from the least to the most recently used
+_MAGIC = b'CVCI'
+_VERSION = 1
+_HEADER = struct.Struct('!4sBII')
+_PATH = struct.Struct('!H')
+_ENTRY = struct.Struct('!%dsIQI' % DIGEST_SIZE)
+
+
+def digest(data):
+    return hashlib.sha256(data).digest()
+
+
+class ChunkIndex(object):
+    """Bounded, thread safe digest -> (path, offset, length) mapping."""
+
+    def __init__(self, max_entries=None, path=None):
+        if max_entries is None:
+            max_entries = CONF.block_dedup_index_size
+        self.max_entries = max(int(max_entries), 0)
+        self.path = path
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        with self._lock:
+            location = self._entries.pop(key, None)
+            if location is not None:
+                self._entries[key] = location
+            return location
+
+    def add(self, key, path, offset, length):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (path, offset, length)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def discard(self, key):
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._dirty = True
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                entries = self._read(f)
+        except Exception as e:
+            LOG.warning("Ignore block chunk index %(path)s: %(error)s",
+                        {'path': self.path, 'error': e})
+            return
+
+        with self._lock:
+            for key, location in entries:
+                self._entries[key] = location
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        LOG.debug("Loaded %(count)s block chunk digests from %(path)s",
+                  {'count': len(entries), 'path': self.path})
+
+    def save(self):
+        """Write the index out if it changed, keeping the old one on error.
+
+        The index only saves network traffic, so failing to persist it is
+        logged and otherwise ignored.
+        """
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = list(self._entries.items())
+            self._dirty = False
+
+        tmp_path = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp_path, 'wb') as f:
+                self._write(f, entries)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self.path)
+        except Exception as e:
+            with self._lock:
+                self._dirty = True
+            LOG.warning("Save block chunk index %(path)s failed: %(error)s",
+                        {'path': self.path, 'error': e})
+
+    @staticmethod
+    def _write(f, entries):
+        paths = {}
+        for _key, (path, _offset, _length) in entries:
+            paths.setdefault(path, len(paths))
+
+        f.write(_HEADER.pack(_MAGIC, _VERSION, len(paths), len(entries)))
+        for path in sorted(paths, key=paths.get):
+            encoded = path.encode('utf-8')
+            f.write(_PATH.pack(len(encoded)) + encoded)
+        for key, (path, offset, length) in entries:
+            f.write(_ENTRY.pack(key, paths[path], offset, length))
+
+    @staticmethod
+    def _read(f):
+        magic, version, path_count, count = _HEADER.unpack(
+            f.read(_HEADER.size))
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("unknown index format")
+
+        paths = []
+        for _i in range(path_count):
+            size, = _PATH.unpack(f.read(_PATH.size))
+            paths.append(f.read(size).decode('utf-8'))
+
+        data = f.read(count * _ENTRY.size)
+        if len(data) != count * _ENTRY.size:
+            raise ValueError("truncated index")
+        entries = []
+        for pos in range(0, len(data), _ENTRY.size):
+            key, path, offset, length = _ENTRY.unpack_from(data, pos)
+            entries.append((key, (paths[path], offset, length)))
+        return entries
@@ -0,0 +1,244 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Merkle tree of a device, built from the data of a transfer.
+
+Both ends feed the tree with the ranges they send or write, the hashing
+itself runs on a worker thread. A leaf covers leaf_size bytes and is the
+sha256 of them; a parent is the sha256 of its two children, a lone child
+being its own parent. Leaves no data flowed for are read back from the
+device before the tree is compared.
+"""
+
+import hashlib
+import io
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from six.moves import queue
+
+merkle_opts = [
+    cfg.IntOpt('block_verify_leaf_size',
+               default=4 * 1024 * 1024,
+               help='Bytes covered by a leaf of the Merkle tree verifying a '
+                    'block transfer'),
+    cfg.IntOpt('block_verify_queue_size',
+               default=16,
+               help='Ranges waiting to be hashed before a verified block '
+                    'transfer waits for the hashing thread'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(merkle_opts)
+
+LOG = logging.getLogger(__name__)
+
+# seconds the hashing thread waits for more data before it ends
+_IDLE_TIMEOUT = 1.0
+
+
+def _hash(data):
+    return hashlib.sha256(data).digest()
+
+
+def _parent(left, right):
+    if right is None:
+        return left
+    return _hash(left + right)
+
+
+class _OpenLeaf(object):
+    """A leaf being filled, piece by piece and in any order."""
+
+    def __init__(self, length):
+        self.data = bytearray(length)
+        self.covered = []
+
+    def add(self, start, end):
+        covered = []
+        for s, e in sorted(self.covered + [(start, end)]):
+            if covered and s <= covered[-1][1]:
+                covered[-1] = (covered[-1][0], max(covered[-1][1], e))
+            else:
+                covered.append((s, e))
+        self.covered = covered
+
+    def complete(self):
+        return self.covered == [(0, len(self.data))]
+
+
+class MerkleTree(object):
+    """Tree of a size bytes device, fed from the data path."""
+
+    def __init__(self, size, leaf_size):
+        self.size = size
+        self.leaf_size = max(int(leaf_size), 1)
+        self.count = max((size + self.leaf_size - 1) // self.leaf_size, 1)
+        self.leaves = [None] * self.count
+        self._open = {}
+        self._zero_digests = {}
+        self._queue = queue.Queue(max(CONF.block_verify_queue_size, 1))
+        self._lock = threading.Lock()
+        self._worker = None
+        self._levels = None
+
+    def leaf_range(self, index):
+        start = index * self.leaf_size
+        return start, min(start + self.leaf_size, self.size)
+
+    def feed(self, offset, data):
+        """Queue data written at offset; data must not change afterwards."""
+        self._submit((offset, len(data), data))
+
+    def feed_zero(self, offset, length):
+        self._submit((offset, length, None))
+
+    def _submit(self, item):
+        self._queue.put(item)
+        with self._lock:
+            self._levels = None
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._work)
+                self._worker.daemon = True
+                self._worker.start()
+
+    def wait(self):
+        """Wait for everything fed so far to be hashed."""
+        self._queue.join()
+
+    def _work(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=_IDLE_TIMEOUT)
+            except queue.Empty:
+                with self._lock:
+                    if self._queue.empty():
+                        self._worker = None
+                        return
+                continue
+            try:
+                self._add(*item)
+            except Exception as e:
+                LOG.error("Hash range at %(offset)s error: %(error)s",
+                          {'offset': item[0], 'error': e})
+            finally:
+                self._queue.task_done()
+
+    def _add(self, offset, length, data):
+        end = min(offset + length, self.size)
+        pos = offset
+        while pos < end:
+            index = pos // self.leaf_size
+            leaf_start, leaf_end = self.leaf_range(index)
+            piece_end = min(end, leaf_end)
+            if (data is None and pos == leaf_start and
+                    piece_end == leaf_end):
+                # the whole leaf is zero, hashed once per length
+                self._open.pop(index, None)
+                self.leaves[index] = self._zero_digest(leaf_end - pos)
+            else:
+                leaf = self._open.get(index)
+                if leaf is None:
+                    leaf = self._open[index] = _OpenLeaf(
+                        leaf_end - leaf_start)
+                if data is not None:
+                    leaf.data[pos - leaf_start:piece_end - leaf_start] = (
+                        data[pos - offset:piece_end - offset])
+                else:
+                    leaf.data[pos - leaf_start:piece_end - leaf_start] = (
+                        bytearray(piece_end - pos))
+                leaf.add(pos - leaf_start, piece_end - leaf_start)
+                if leaf.complete():
+                    del self._open[index]
+                    self.leaves[index] = _hash(leaf.data)
+            pos = piece_end
+
+    def _zero_digest(self, length):
+        digest = self._zero_digests.get(length)
+        if digest is None:
+            digest = self._zero_digests[length] = _hash(b'\0' * length)
+        return digest
+
+    def unknown_leaves(self):
+        return [i for i, leaf in enumerate(self.leaves) if leaf is None]
+
+    def read_unknown(self, path):
+        """Hash the leaves no data was fed for from the device itself."""
+        self.wait()
+        unknown = self.unknown_leaves()
+        if not unknown:
+            return 0
+        LOG.debug("Read back %(count)s leaves of %(path)s",
+                  {'count': len(unknown), 'path': path})
+        with io.open(path, 'rb') as f:
+            for index in unknown:
+                start, end = self.leaf_range(index)
+                f.seek(start)
+                data = f.read(end - start)
+                if len(data) < end - start:
+                    # a device shorter than its source
+                    data += b'\0' * (end - start - len(data))
+                self.leaves[index] = _hash(data)
+        self._levels = None
+        return len(unknown)
+
+    def levels(self):
+        """Levels from the leaves up to the root, computed on demand."""
+        self.wait()
+        with self._lock:
+            if self._levels is None:
+                missing = self.unknown_leaves()
+                if missing:
+                    raise ValueError("%d leaves are not hashed" %
+                                     len(missing))
+                levels = [list(self.leaves)]
+                while len(levels[-1]) > 1:
+                    below = levels[-1]
+                    levels.append([_parent(below[i],
+                                           below[i + 1]
+                                           if i + 1 < len(below) else None)
+                                   for i in range(0, len(below), 2)])
+                self._levels = levels
+            return self._levels
+
+    @property
+    def depth(self):
+        return len(self.levels()) - 1
+
+    def root(self):
+        return self.levels()[-1][0]
+
+    def nodes(self, level, indexes):
+        nodes = self.levels()[level]
+        return [nodes[i] if 0 <= i < len(nodes) else None for i in indexes]
+
+
+def differing_leaves(tree, fetch):
+    """Indexes of the leaves of tree differing from a remote tree.
+
+    fetch(level, indexes) returns the digests of the remote nodes; only the
+    children of differing nodes are fetched, level by level from the root.
+    """
+    levels = tree.levels()
+    indexes = [0]
+    for level in range(len(levels) - 1, -1, -1):
+        remote = fetch(level, indexes)
+        differ = [i for i, ours, theirs
+                  in zip(indexes, tree.nodes(level, indexes), remote)
+                  if ours != theirs]
+        if not level or not differ:
+            return differ
+        below = len(levels[level - 1])
+        indexes = [child for i in differ for child in (2 * i, 2 * i + 1)
+                   if child < below]
+    return []
@@ -0,0 +1,121 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Helpers to find and to reproduce zero regions of a device."""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import stat
+import struct
+
+from oslo_log import log as logging
+import six
+
+LOG = logging.getLogger(__name__)
+
+# python 2 does not define these, the values are the linux ones
+SEEK_DATA = getattr(os, 'SEEK_DATA', 3)
+SEEK_HOLE = getattr(os, 'SEEK_HOLE', 4)
+
+# linux/fs.h
+BLKZEROOUT = 0x127f
+
+# linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_ZERO_WRITE_SIZE = 1024 * 1024
+
+_libc = None
+
+
+def _fallocate():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                    ctypes.c_int64, ctypes.c_int64]
+    return _libc.fallocate
+
+
+def seek_data_supported(fd):
+    """Whether holes of fd can be found with SEEK_DATA/SEEK_HOLE."""
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return False
+    try:
+        os.lseek(fd, 0, SEEK_DATA)
+    except OSError as e:
+        # ENXIO only means there is no data at all
+        return e.errno == errno.ENXIO
+    return True
+
+
+def extents(fd, start, end):
+    """Yield (offset, length, is_data) covering [start, end) of a file."""
+    pos = start
+    while pos < end:
+        try:
+            data = min(os.lseek(fd, pos, SEEK_DATA), end)
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            data = end
+        if data > pos:
+            yield pos, data - pos, False
+        if data >= end:
+            break
+        hole = min(os.lseek(fd, data, SEEK_HOLE), end)
+        yield data, hole - data, True
+        pos = hole
+
+
+def is_zero(buf, zeros):
+    """Whether the memoryview buf only holds zero bytes.
+
+    zeros is a bytes object of zeros at least as long as buf; both checks
+    end up in a memcmp instead of comparing item by item.
+    """
+    if six.PY2:
+        return buf == zeros[:len(buf)]
+    return zeros.startswith(buf)
+
+
+def zero_range(fd, offset, length):
+    """Make [offset, offset + length) of fd read back as zeros.
+
+    Block devices are asked to zero the range themselves and files get a
+    hole punched, so no zeros cross the bus unless both are unsupported.
+    """
+    mode = os.fstat(fd).st_mode
+    try:
+        if stat.S_ISBLK(mode):
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+            return
+        if stat.S_ISREG(mode):
+            fallocate = _fallocate()
+            if fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                         offset, length) == 0:
+                return
+            LOG.debug("Punch hole not supported: %s",
+                      os.strerror(ctypes.get_errno()))
+    except (IOError, OSError) as e:
+        LOG.debug("Zero range offload not supported: %s", e)
+
+    zeros = b'\0' * min(length, _ZERO_WRITE_SIZE)
+    done = 0
+    while done < length:
+        size = min(len(zeros), length - done)
+        os.lseek(fd, offset + done, os.SEEK_SET)
+        done += os.write(fd, zeros[:size])
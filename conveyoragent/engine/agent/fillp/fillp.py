@@ -31,7 +31,8 @@ class FillAgent(object):
         root_helper = utils.get_root_helper()
         self.cmd_process = base.MigrationCmd(root_helper)
 
-    def start_fillp_server(self, address, port, des_dev, protocol):
+    def start_fillp_server(self, address, port, des_dev, protocol,
+                           options=None):
         try:
             args = [address, port, des_dev, protocol]
             fillp_thread = AgentThread(self._start_fillp_server, *args)
@@ -51,7 +52,8 @@ class FillAgent(object):
             LOG.error(_msg)
             raise exception.DownLoadDataError(error=_msg)
 
-    def transformer_data(self, address, port, src_dev, des_dev, protocol):
+    def transformer_data(self, address, port, src_dev, des_dev, protocol,
+                         options=None):
         try:
             args = [address, port, src_dev, des_dev, protocol]
             fillp_thread = AgentThread(self._transformer_data, *args)
@@ -72,18 +74,22 @@ class FillAgent(object):
             LOG.error(_msg)
             raise exception.DownLoadDataError(error=_msg)
 
-    def query_transformer_task_status(self, protocol):
+    def query_transformer_task_status(self, protocol, port=None):
         try:
-            status = self.cmd_process.fillp_query_status(protocol)
+            status = self.cmd_process.fillp_query_status(protocol, port=port)
             return status
         except Exception as e:
             _msg = "Fillp query transfer data failed: %s" % unicode(e)
             LOG.error(_msg)
             raise exception.DownLoadDataError(error=_msg)
 
-    def stop_fillp_server(self, service, protocol):
+    def query_transformer_process(self, protocol, port=None):
+        return self.cmd_process.fillp_query_process(protocol, port=port)
+
+    def stop_fillp_server(self, service, protocol, port=None):
         try:
-            self.cmd_process.fillp_close_connect(service, protocol)
+            self.cmd_process.fillp_close_connect(service, protocol,
+                                                 port=port)
         except Exception as e:
             _msg = "Fillp stop server errror: %s" % unicode(e)
             LOG.error(_msg)
@@ -91,10 +97,19 @@ class FillAgent(object):
 
 
 class AgentThread(threading.Thread):
+    """Runs a fillp process the other end waits on.
+
+    Not queued on the executor: the tasks waiting on the process may hold
+    all of its workers.
+    """
+
     def __init__(self, fun, *args):
         threading.Thread.__init__(self)
+        self.daemon = True
         self.fun = fun
         self.args = args
+        # what the operator raised, None until it failed
+        self.error = None
 
     def run(self):
         args = self.args
@@ -102,7 +117,6 @@ class AgentThread(threading.Thread):
             try:
                 self.fun(*args)
             except Exception as e:
-                LOG.error("Conveyor agent operator %(ops)s error: %(error)s",
-                          {'ops': self.fun, 'error': e})
-                msg = 'Operator %s error' % self.fun
-                raise exception.V2vException(message=msg)
+                self.error = e
+                LOG.exception("Conveyor agent operator %(ops)s error: "
+                              "%(error)s", {'ops': self.fun, 'error': e})
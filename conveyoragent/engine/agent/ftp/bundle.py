@@ -0,0 +1,331 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Small files of a directory tree sent as one tar stream.
+
+Copying a tree file by file costs a few control round trips per file,
+which is most of the time spent on trees of tiny files. The source agent
+instead sends the files below a size, along with every directory and
+link, as a tar stream over a single connection to the destination agent,
+which extracts it as it comes. Modes, numeric owners and mtimes are kept.
+The larger files are then downloaded over ftp as usual, skipping the
+extracted ones.
+
+The stream ends with a trailer member holding the count of files sent, so
+that a stream cut short is told from a complete one. It starts with the
+token the destination made for it: a peer not knowing it is dropped and
+the destination waits on for the source.
+"""
+
+import binascii
+import copy
+import hmac
+import io
+import os
+import socket
+import stat
+import tarfile
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+from conveyoragent.engine.common import throttle
+from conveyoragent import exception
+
+ftp_bundle_opts = [
+    cfg.IntOpt('ftp_bundle_max_file_size',
+               default=256 * 1024,
+               help='Files smaller than this are sent in the bundle of a '
+                    'tree instead of one by one over ftp'),
+    cfg.IntOpt('ftp_bundle_port',
+               default=0,
+               help='Port the destination listens on for bundles, 0 for '
+                    'any free port'),
+    cfg.IntOpt('ftp_bundle_timeout',
+               default=120,
+               help='Seconds to wait for the source to connect, or for '
+                    'data of a bundle once connected'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_bundle_opts)
+
+LOG = logging.getLogger(__name__)
+
+TRAILER = '.conveyor-bundle-trailer'
+
+_BUFSIZE = 64 * 1024
+
+
+class _Writer(object):
+
+    def __init__(self, sock, limiter):
+        self.sock = sock
+        self.limiter = limiter
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        self.sock.sendall(data)
+
+
+class _Reader(object):
+
+    def __init__(self, fileobj, limiter):
+        self.fileobj = fileobj
+        self.limiter = limiter
+
+    def read(self, size):
+        data = self.fileobj.read(size)
+        if self.limiter is not None:
+            self.limiter.consume(len(data))
+        return data
+
+
+def send(host, port, root, token, max_size=None, limiter=None):
+    """Send the small files of root to a Receiver listening on host."""
+    if max_size is None:
+        max_size = CONF.ftp_bundle_max_file_size
+    sock = socket.create_connection((host, port), CONF.ftp_bundle_timeout)
+    try:
+        sock.sendall(token.encode('ascii') + b'\n')
+        counts = _write(_Writer(sock, limiter or throttle.limiter()), root,
+                        max_size)
+    finally:
+        sock.close()
+    LOG.debug("Bundle of %(root)s sent: %(files)s files, %(bytes)s bytes",
+              dict(counts, root=root))
+    return counts
+
+
+def _write(out, root, max_size):
+    counts = {'files': 0, 'bytes': 0}
+    # on errors the stream is left without end blocks nor trailer
+    tar = tarfile.open(fileobj=out, mode='w|', bufsize=_BUFSIZE)
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root)
+        if rel_dir != os.curdir:
+            _add(tar, dirpath, rel_dir)
+        # links to directories are listed along with the directories
+        for name in sorted(set(dirnames + filenames)):
+            path = os.path.join(dirpath, name)
+            arcname = os.path.normpath(os.path.join(rel_dir, name))
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                if st.st_size >= max_size or arcname == TRAILER:
+                    continue
+            elif not stat.S_ISLNK(st.st_mode):
+                continue
+            size = _add(tar, path, arcname)
+            if size is not None:
+                counts['files'] += 1
+                counts['bytes'] += size
+
+    data = jsonutils.dumps(counts).encode('utf-8')
+    info = tarfile.TarInfo(TRAILER)
+    info.size = len(data)
+    tar.addfile(info, io.BytesIO(data))
+    tar.close()
+    return counts
+
+
+def _add(tar, path, arcname):
+    """Add path, None if it could not be read."""
+    data = None
+    try:
+        if os.path.isfile(path) and not os.path.islink(path):
+            # read first: a file changing under tar would break the stream
+            with open(path, 'rb') as f:
+                data = f.read()
+        info = tar.gettarinfo(path, arcname)
+    except (IOError, OSError) as e:
+        LOG.warning("Skip %(path)s from the bundle: %(error)s",
+                    {'path': path, 'error': e})
+        return None
+    # owners go by number, the names are the ones of the source system
+    info.uname = info.gname = ''
+    if info.isreg():
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    else:
+        tar.addfile(info)
+    return info.size if info.isreg() else 0
+
+
+class Receiver(object):
+    """Extracts the bundle a source knowing token sends to root.
+
+    extracted holds the local paths of the files and links written.
+    """
+
+    def __init__(self, root, limiter=None):
+        self.root = root
+        self.limiter = limiter
+        self.token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.extracted = set()
+        self.files = 0
+        self.bytes = 0
+        self.error = None
+        self._sock = None
+        self._thread = None
+
+    def start(self, host='', port=None):
+        """Listen for the source, returns the port."""
+        if port is None:
+            port = CONF.ftp_bundle_port
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(1)
+        self._sock.settimeout(CONF.ftp_bundle_timeout)
+        port = self._sock.getsockname()[1]
+        self._thread = threading.Thread(target=self._run,
+                                        name='ftp-bundle-receiver')
+        self._thread.daemon = True
+        self._thread.start()
+        return port
+
+    def stop(self):
+        """Give up waiting for a source that did not connect yet."""
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def wait(self):
+        self._thread.join()
+        if self.error is not None:
+            raise exception.DownLoadDataError(
+                error="bundle of %(root)s: %(error)s" %
+                      {'root': self.root, 'error': self.error})
+
+    def _run(self):
+        try:
+            try:
+                conn, reader = self._accept()
+            finally:
+                self._sock.close()
+            try:
+                conn.settimeout(CONF.ftp_bundle_timeout)
+                try:
+                    self._extract(_Reader(reader, self.limiter))
+                finally:
+                    reader.close()
+            finally:
+                conn.close()
+        except Exception as e:
+            LOG.error("Receive bundle of %(root)s error: %(error)s",
+                      {'root': self.root, 'error': e})
+            self.error = e
+        LOG.debug("Bundle of %(root)s received: %(files)s files, "
+                  "%(bytes)s bytes",
+                  {'root': self.root, 'files': self.files,
+                   'bytes': self.bytes})
+
+    def _accept(self):
+        """The connection of the first peer sending the token, and its
+        reader.
+        """
+        token = self.token.encode('ascii')
+        deadline = time.time() + CONF.ftp_bundle_timeout
+        while True:
+            left = deadline - time.time()
+            if left <= 0:
+                raise socket.timeout("no source sent the bundle token")
+            self._sock.settimeout(left)
+            conn, addr = self._sock.accept()
+            reader = None
+            try:
+                conn.settimeout(left)
+                reader = conn.makefile('rb')
+                line = reader.readline(len(token) + 1)
+            except socket.error:
+                line = b''
+            if hmac.compare_digest(line.rstrip(b'\n'), token):
+                return conn, reader
+            LOG.warning("Drop bundle connection of %(addr)s to %(root)s: "
+                        "bad token", {'addr': addr[0], 'root': self.root})
+            if reader is not None:
+                reader.close()
+            conn.close()
+
+    def _extract(self, fileobj):
+        tar = tarfile.open(fileobj=fileobj, mode='r|', bufsize=_BUFSIZE)
+        trailer = None
+        dirs = []
+        try:
+            for member in tar:
+                if member.name == TRAILER:
+                    trailer = jsonutils.loads(tar.extractfile(member).read())
+                    break
+                self._check(member)
+                path = os.path.join(self.root, member.name)
+                if os.path.islink(path):
+                    # written through, the link would lead where it points
+                    os.unlink(path)
+                if member.isdir():
+                    # written to until the end, its attributes come last
+                    dirs.append(member)
+                    member = copy.copy(member)
+                    member.mode = 0o700
+                    tar.extract(member, self.root)
+                    continue
+                tar.extract(member, self.root)
+                self.extracted.add(path)
+                self.files += 1
+                self.bytes += member.size if member.isreg() else 0
+        finally:
+            for member in sorted(dirs, key=lambda m: m.name, reverse=True):
+                self._set_attributes(member)
+
+        if trailer is None:
+            raise IOError("bundle ended after %d files" % self.files)
+        if trailer.get('files') != self.files:
+            raise IOError("bundle has %(files)d files of %(sent)s sent" %
+                          {'files': self.files, 'sent': trailer.get('files')})
+
+    def _check(self, member):
+        """Refuse members that would be written outside of root.
+
+        The directory a member goes to is resolved, through the links
+        extracted before it, the way writing it would.
+        """
+        root = os.path.realpath(self.root)
+        names = [member.name]
+        if member.islnk():
+            names.append(member.linkname)
+        for name in names:
+            path = os.path.normpath(name)
+            parent = os.path.realpath(
+                os.path.dirname(os.path.join(self.root, name)))
+            if (os.path.isabs(path) or path == os.pardir or
+                    path.startswith(os.pardir + os.sep) or
+                    (parent != root and
+                     not parent.startswith(root + os.sep))):
+                raise IOError("bundle member %s out of %s" %
+                              (member.name, self.root))
+
+    def _set_attributes(self, member):
+        path = os.path.join(self.root, member.name)
+        try:
+            if hasattr(os, 'geteuid') and os.geteuid() == 0:
+                os.chown(path, member.uid, member.gid)
+            os.chmod(path, member.mode)
+            os.utime(path, (member.mtime, member.mtime))
+        except OSError as e:
+            LOG.warning("Set attributes of %(path)s error: %(error)s",
+                        {'path': path, 'error': e})
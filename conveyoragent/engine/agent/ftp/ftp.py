@@ -14,13 +14,24 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import os
 import time
+import zlib
 
 from oslo_config import cfg
 from oslo_log import log as logging
 
 from conveyoragent.engine.agent.ftp import ftplib
+from conveyoragent.engine.agent.ftp import green
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.engine.agent.ftp import segmented
+from conveyoragent.engine.agent.ftp import stream
+from conveyoragent.engine.agent.ftp import sync as ftp_sync
+from conveyoragent.engine.agent.ftp import tree
+from conveyoragent.engine.agent.ftp import upload
+from conveyoragent.engine.common import compression
+from conveyoragent.engine.common import throttle
 
 
 ftp_paras = [
@@ -54,19 +65,23 @@ LOG = logging.getLogger(__name__)
 
 
 class FtpAgent(object):
+    """Moves files over ftp sessions taken from the shared pool.
+
+    Each call runs on a session of its own, bound to the calling thread, or
+    green thread with the green ftp client, so that the calls it makes in
+    turn use the same session.
+    """
 
     def __init__(self, host=None, port=None, user=None, passwd=None,
                  timeout=-999):
 
-        self.ftp = ftplib.FTP()
-
         self.host = host
         self.port = port
         self.user = user
         self.passwd = passwd
         self.timeout = timeout
 
-        self.connect = None
+        self._local = green.local()
 
         if not host:
             self.host = CONF.ftp_host
@@ -80,160 +95,256 @@ class FtpAgent(object):
         if not passwd:
             self.passwd = CONF.user_passwd
 
-        # self.connect = self.connectFtp(host, port, user, passwd, timeout)
+        # remembers the link rate the MODE Z level is chosen from
+        self.compressor = compression.AdaptiveCompressor(compression.ZLIB)
 
-    def connectFtp(self, host, port, user, passwd, timeout):
-        '''set up connection to ftp server'''
+    @property
+    def ftp(self):
+        """Ftp connection of the session of the calling thread."""
+        session = getattr(self._local, 'session', None)
+        return session.ftp if session else None
+
+    @contextlib.contextmanager
+    def _session(self, host=None, wait=True):
+        """Session of the calling thread, None if none can be opened.
+
+        Always on the ftp port of the agent, the port callers give is the
+        one of the api of the source agent. Unless wait, None as well when
+        all the sessions to the server are busy.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is not None:
+            yield session
+            return
+
+        sessions = pool.get_pool()
         try:
-            self.ftp.connect(host, port, timeout)
+            session = sessions.acquire(host or self.host, self.port,
+                                       self.user, self.passwd, self.timeout,
+                                       wait=wait)
         except Exception as e:
-            LOG.error("Ftp connect error: %s", e)
-            return None
-        else:
-            try:
-                self.ftp.login(user, passwd)
-            except Exception as e:
-                LOG.error("Ftp login error: %s", e)
+            LOG.error("Ftp session error: %s", e)
+            yield None
+            return
+        if session is None:
+            yield None
+            return
+
+        self._local.session = session
+        broken = False
+        try:
+            yield session
+        except pool.SESSION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self._local.session = None
+            sessions.release(session, broken=broken)
+
+    def connectFtp(self, host, port, user, passwd, timeout):
+        '''check a session to the ftp server can be opened'''
+        with self._session(host) as session:
+            if session is None:
                 return None
-            else:
-                LOG.debug("ftp login success")
-                self.connect = True
+            LOG.debug("ftp login success")
+            return True
 
-    def downLoadFile(self, localpath, remotepath):
+    def downLoadFile(self, localpath, remotepath,
+                     compression_stats=None, limiter=None):
         """down file.
 
         :param localpath: storage file in local path
                remotepath: file in remote host path
+               compression_stats: CompressionStats, ask the server for
+                                  MODE Z and account the transfer in it
+               limiter: throttle.Limiter the data is drawn from, the one of
+                        the agent by default
         """
         LOG.debug("ftp down load file start")
-        if not self.connect:
-            self.connectFtp(self.host, self.port, self.user, self.passwd,
-                            self.timeout)
-
-            # reconnect policy add later
-            if not self.connect:
+        with self._session() as session:
+            if session is None:
                 LOG.error("connect ftp failed")
                 return
+            try:
+                self._downLoadFile(localpath, remotepath, compression_stats,
+                                   limiter)
+            except Exception as e:
+                LOG.error("ftp down load file error: %s", e)
+
+    def _downLoadFile(self, localpath, remotepath, compression_stats,
+                      limiter, rest=0):
+        '''down load remotepath, from the offset rest if given'''
+        limiter = limiter or throttle.limiter()
+        if (not rest and compression_stats is not None and
+                self._enable_mode_z()):
+            try:
+                self._downLoadFileZ(localpath, remotepath, compression_stats,
+                                    limiter)
+            finally:
+                self._disable_mode_z()
+            LOG.debug("ftp down load file end")
+            return
 
-        bufsize = CONF.ftp_buffersize
+        received = [0]
+        start = time.time()
         try:
-            fp = open(localpath, 'wb')
-            self.ftp.retrbinary('RETR ' + remotepath, fp.write, bufsize)
-        except Exception as e:
-            LOG.error("ftp down load file error: %s", e)
+            with open(localpath, 'r+b' if rest else 'wb') as fp:
+                if rest:
+                    fp.seek(rest)
+                    fp.truncate()
+
+                def write(data):
+                    limiter.consume(len(data))
+                    received[0] += len(data)
+                    fp.write(data)
+                self.ftp.retrbinary('RETR ' + remotepath, write,
+                                    rest=rest or None, buf=stream.buffer())
         finally:
-            fp.close()
+            stream.get_counters().add(received[0], time.time() - start)
 
         LOG.debug("ftp down load file end")
 
-    def downLoadDirTree(self, host, port, localpath, remotepath):
-        ''''''
-        LOG.debug("Ftp down directory start")
-        if not host:
-            host = self.host
-
-        if not port:
-            self.port = port
-
-        if not self.connect:
-            self.connectFtp(host, self.port, self.user, self.passwd,
-                            self.timeout)
+    def _downLoadFileZ(self, localpath, remotepath, stats, limiter):
+        '''down load file sent deflated by the server in MODE Z'''
+        decompressor = zlib.decompressobj()
+        counts = {'raw': 0, 'wire': 0, 'time': 0.0}
 
-            # reconnect policy add later
-            if not self.connect:
-                LOG.error("connect ftp failed")
-                return
-
-        if not os.path.isdir(localpath):
-            os.makedirs(localpath)
+        def write(data):
+            limiter.consume(len(data))
+            counts['wire'] += len(data)
+            start = time.time()
+            data = decompressor.decompress(data)
+            counts['time'] += time.time() - start
+            counts['raw'] += len(data)
+            fp.write(data)
 
-        self.ftp.cwd(remotepath)
-
-        # list all dir or file in remote device
-        remoteNames = self.ftp.nlst()
+        bufsize = CONF.ftp_buffersize
+        start = time.time()
+        try:
+            with open(localpath, 'wb') as fp:
+                self.ftp.retrbinary('RETR ' + remotepath, write, bufsize)
+                fp.write(decompressor.flush())
+        finally:
+            stream.get_counters().add(counts['wire'], time.time() - start)
+            self.compressor.record_send(counts['wire'], time.time() - start)
+            stats.add(raw_bytes=counts['raw'], wire_bytes=counts['wire'],
+                      decompress_time=counts['time'])
 
-        for remote in remoteNames:
-            local = os.path.join(localpath, remote)
-            if self._isDir(remote):
-                self.downLoadDirTree(host, self.port, local, remote)
-            else:
-                self.downLoadFile(local, remote)
+    def _enable_mode_z(self):
+        """Switch the data connections of the session to MODE Z.
 
-        self.ftp.cwd("..")
+        Listings are affected by MODE Z as well, so it is only kept on for
+        a single RETR.
+        """
+        level = self.compressor.choose_level()
+        if level is None:
+            # the link is faster than deflate
+            return False
+        try:
+            self.ftp.voidcmd('MODE Z')
+        except ftplib.all_errors as e:
+            LOG.warning("Ftp server refuses MODE Z, transfer uncompressed: "
+                        "%s", e)
+            return False
+        try:
+            self.ftp.voidcmd('OPTS MODE Z LEVEL %d' % level)
+        except ftplib.all_errors as e:
+            LOG.debug("Ftp server refuses MODE Z level %(level)s: %(error)s",
+                      {'level': level, 'error': e})
+        return True
 
+    def _disable_mode_z(self):
+        try:
+            self.ftp.voidcmd('MODE S')
+        except ftplib.all_errors as e:
+            LOG.error("Ftp restore MODE S error: %s", e)
+
+    def downLoadDirTree(self, host, port, localpath, remotepath,
+                        compression_stats=None, limiter=None, workers=None,
+                        skip=None, sync=False):
+        '''down load a directory tree, workers files at a time
+
+        With sync, the files an earlier sync download of the tree wrote
+        are skipped when unchanged and resumed when partial.
+        '''
+        LOG.debug("Ftp down directory start")
+        host = host or self.host
+        port = self.port
+        with self._session(host) as session:
+            if session is None:
+                LOG.error("connect ftp failed")
+                return
+            manifest = None
+            if sync:
+                manifest = ftp_sync.Manifest(ftp_sync.manifest_path(
+                    host, port, remotepath, localpath)).load()
+            try:
+                download = tree.TreeDownload(
+                    self, host, port, localpath, remotepath,
+                    compression_stats=compression_stats, limiter=limiter,
+                    workers=workers, skip=skip, sync=manifest)
+                download.run()
+            finally:
+                if manifest is not None:
+                    manifest.close()
         LOG.debug("Ftp down directory end")
-        return
 
     def upLoadFile(self, localpath, remotepath):
-        if not self.connect:
-            self.connectFtp(self.host, self.port, self.user, self.passwd,
-                            self.timeout)
-
-            # reconnect policy add later
-            if not self.connect:
+        with self._session() as session:
+            if session is None:
                 LOG.error("connect ftp failed")
                 return
-
-        bufsize = CONF.ftp_buffersize
-
-        try:
-            fp = open(localpath, 'rb')
-            self.ftp.storbinary('STOR ' + remotepath, fp, bufsize)
-        except Exception:
-            LOG.error("")
-        finally:
-            fp.close()
-
-    def upLoadDirTree(self, localDir, remoteDir):
-        ''''''
-        if not self.connect:
-            self.connectFtp(self.host, self.port, self.user, self.passwd,
-                            self.timeout)
-
-            # reconnect policy add later
-            if not self.connect:
+            try:
+                self._upLoadFile(localpath, remotepath)
+            except Exception as e:
+                LOG.error("ftp up load file error: %s", e)
+
+    def _upLoadFile(self, localpath, remotepath, limiter=None):
+        limiter = limiter or throttle.limiter()
+        with open(localpath, 'rb') as fp:
+            self.ftp.storbinary('STOR ' + remotepath, fp,
+                                CONF.ftp_buffersize ** 2,
+                                callback=lambda buf: limiter.consume(len(buf)))
+
+    def upLoadDirTree(self, host, port, localDir, remoteDir, limiter=None,
+                      workers=None):
+        '''up load a directory tree, workers files at a time'''
+        if not os.path.isdir(localDir):
+            return False
+        LOG.debug("Ftp up directory start")
+        with self._session(host) as session:
+            if session is None:
                 LOG.error("connect ftp failed")
                 return
-
-        if os.path.isdir(localDir) is False:
-            return False
-
-        localNames = os.listdir(localDir)
-
-        # cd to remote dir
-        self.ftp.cwd(remoteDir)
-
-        for local in localNames:
-
-            src = os.path.join(localDir, local)
-
-            if os.path.isdir(src):
-
-                self.ftp.mkd(local)
-
-                self.upLoadDirTree(src, local)
-            else:
-                self.upLoadFile(src, local)
-
-        self.ftp.cwd("..")
-        return
+            upload.TreeUpload(self, host or self.host, self.port,
+                              localDir, remoteDir, limiter=limiter,
+                              workers=workers).run()
+        LOG.debug("Ftp up directory end")
 
     def downLoadFileExt(self, host, port, localpath, remotepath):
         '''Down load file include resuming broken transfer'''
-        if not host:
-            host = self.host
-
-        if not port:
-            self.port = port
-
-        if not self.connect:
-            self.connectFtp(host, self.port, self.user, self.passwd,
-                            self.timeout)
-
-            # reconnect policy add later
-            if not self.connect:
+        with self._session(host) as session:
+            if session is None:
                 LOG.error("connect ftp failed")
                 return
+            return self._downLoadFileExt(host or self.host, self.port,
+                                         localpath, remotepath)
+
+    def _downLoadFileExt(self, host, port, localpath, remotepath):
+        # large files come in segments over several sessions, a retry
+        # only fetches the segments missing from the sidecar
+        self.ftp.voidcmd('TYPE I')
+        fsize = self.ftp.size(remotepath)
+        if fsize and segmented.should_segment(fsize):
+            if (not segmented.is_pending(localpath) and
+                    os.path.exists(localpath) and
+                    os.stat(localpath).st_size >= fsize):
+                return 0
+            download = segmented.SegmentedDownload(self, host, port,
+                                                   localpath, remotepath,
+                                                   fsize)
+            download.run()
+            return 0
 
         # set active mode for data transfers
         self.ftp.set_pasv(0)
@@ -260,10 +371,7 @@ class FtpAgent(object):
         # if local device file size larger than remote
         if lsize >= fsize:
             LOG.debug("")
-            return
-
-        # Each transmission file size
-        blocksize = CONF.ftp_buffersize ** 2
+            return 0
 
         # set file transmission as binary
         self.ftp.voidcmd('TYPE I')
@@ -272,38 +380,29 @@ class FtpAgent(object):
         # broken transfer
         conn = self.ftp.transfercmd('RETR ' + remotefile, lsize)
 
-        lwrite = open(localpath, 'ab')
-
-        # Here can be changed to transmission some times
-        while True:
-            time.sleep(3)
-            data = conn.recv(blocksize)
-            if not data:
-                break
-            lwrite.write(data)
-        lwrite.close()
         try:
-            self.ftp.voidcmd('NOOP')
+            with open(localpath, 'ab') as lwrite:
+                stream.receive(conn, lwrite.write, throttle.limiter())
+        finally:
+            conn.close()
+        try:
             self.ftp.voidresp()
         except Exception as e:
+            # the session is dropped instead of going back to the pool
             LOG.error("down load ext error: %s", e)
-            self.ftp.disconnect()
-            self.connect = None
-        conn.close()
+            raise
 
         return 0
 
     def upLoadFileExt(self, localpath, remotepath, callback=None):
         '''Up load file include resuming broken transfer'''
-        if not self.connect:
-            self.connectFtp(self.host, self.port, self.user, self.passwd,
-                            self.timeout)
-
-            # reconnect policy add later
-            if not self.connect:
+        with self._session() as session:
+            if session is None:
                 LOG.error("connect ftp failed")
                 return
+            self._upLoadFileExt(localpath, remotepath, callback)
 
+    def _upLoadFileExt(self, localpath, remotepath, callback):
         remote = self._splitpath(remotepath)
 
         self.ftp.cwd(remote[0])
@@ -335,11 +434,13 @@ class FtpAgent(object):
 
             cmpsize = rsize
             blocksize = CONF.ftp_buffersize ** 2
+            limiter = throttle.limiter()
 
             while True:
                 buf = localf.read(blocksize)
                 if not len(buf):
                     break
+                limiter.consume(len(buf))
                 datasock.sendall(buf)
                 if callback:
                     callback(buf)
@@ -352,28 +453,8 @@ class FtpAgent(object):
             self.ftp.voidresp()
 
     def destoryConnection(self):
-
-        if self.connect is None:
-            return
-        try:
-            self.ftp.quit()
-            self.connect = None
-
-        except Exception:
-            LOG.error("")
-
-    def _show(self, pathList):
-
-        result = pathList.lower().split(" ")
-
-        if self.path in result and result[0][0] == 'd':
-            self.bIsDir = True
-
-    def _isDir(self, path):
-        self.bIsDir = False
-        self.path = path
-        self.ftp.retrlines('LIST', self._show)
-        return self.bIsDir
+        '''close the idle sessions to the ftp server'''
+        pool.get_pool().close_idle((self.host, int(self.port), self.user))
 
     def _splitpath(self, path):
 
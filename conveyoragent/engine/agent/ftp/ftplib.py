@@ -135,6 +135,9 @@ class FTP(object):
     file = None
     welcome = None
     passiveserver = 1
+    # SO_RCVBUF and SO_SNDBUF of data connections, 0 for the defaults
+    rcvbuf = 0
+    sndbuf = 0
 
     # Initialization method (called by class instantiation).
     # Initialize host to localhost, port to standard ftp port
@@ -334,6 +337,8 @@ class FTP(object):
             break
         if not sock:
             raise socket.error(msg)
+        # accepted connections inherit the buffers of the listening socket
+        self.size_buffers(sock)
         sock.listen(1)
         port = sock.getsockname()[1]  # Get proper port
         host = self.sock.getsockname()[0]  # Get proper host
@@ -353,6 +358,36 @@ class FTP(object):
                                   self.sock.getpeername())
         return host, port
 
+    def size_buffers(self, sock):
+        '''Apply rcvbuf and sndbuf to a data socket not connected yet.'''
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+
+    def connect_data(self, host, port):
+        '''Connect a data socket, its buffers sized before the handshake
+        so that the window scale it announces fits them.
+        '''
+        if not (self.rcvbuf or self.sndbuf):
+            return socket.create_connection((host, port), self.timeout)
+        msg = "getaddrinfo returns an empty list"
+        for res in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            af, socktype, proto, canonname, sa = res
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                self.size_buffers(sock)
+                if self.timeout is not _GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(self.timeout)
+                sock.connect(sa)
+                return sock
+            except socket.error as e:
+                msg = e
+                if sock is not None:
+                    sock.close()
+        raise socket.error(msg)
+
     def ntransfercmd(self, cmd, rest=None):
         """Initiate a transfer over the data connection.
 
@@ -371,7 +406,7 @@ class FTP(object):
         size = None
         if self.passiveserver:
             host, port = self.makepasv()
-            conn = socket.create_connection((host, port), self.timeout)
+            conn = self.connect_data(host, port)
             if rest is not None:
                 self.sendcmd("REST %s" % rest)
             resp = self.sendcmd(cmd)
@@ -433,7 +468,8 @@ class FTP(object):
             raise error_reply(resp)
         return resp
 
-    def retrbinary(self, cmd, callback, blocksize=8192, rest=None):
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None,
+                   buf=None):
         """Retrieve data in binary mode.  A new port is created for you.
 
         Args:
@@ -443,17 +479,28 @@ class FTP(object):
           blocksize: The maximum number of bytes to read from the
                      socket at one time.  [default: 8192]
           rest: Passed to transfercmd().  [default: None]
+          buf: A bytearray to receive into instead of a new string per
+               block, callback is then given memoryview slices of it
+               valid until it returns.  [default: None]
 
         Returns:
           The response code.
         """
         self.voidcmd('TYPE I')
         conn = self.transfercmd(cmd, rest)
-        while 1:
-            data = conn.recv(blocksize)
-            if not data:
-                break
-            callback(data)
+        if buf is None:
+            while 1:
+                data = conn.recv(blocksize)
+                if not data:
+                    break
+                callback(data)
+        else:
+            view = memoryview(buf)
+            while 1:
+                n = conn.recv_into(view)
+                if not n:
+                    break
+                callback(view[:n])
         conn.close()
         return self.voidresp()
 
@@ -0,0 +1,141 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Green ftp sessions, many of them driven by the hub of one thread.
+
+With ftp_client set to 'green', sessions are made with a copy of the
+vendored ftplib whose sockets are the ones of eventlet, and the workers of
+tree, upload and segmented transfers are green threads of the thread that
+runs the transfer rather than threads of their own. A transfer over dozens
+of control and data connections then costs a single thread, its workers
+switching while they wait on the network.
+
+Workers only switch in socket calls and while they wait for a queue, a
+worker or a session, so the locks and the per thread receive buffers they
+use are never held across a switch.
+"""
+
+import threading
+
+import eventlet
+from eventlet import corolocal
+from eventlet import queue as green_queue
+from oslo_config import cfg
+from oslo_log import log as logging
+from six.moves import queue
+
+from conveyoragent.engine.agent.ftp import ftplib
+
+ftp_green_opts = [
+    cfg.StrOpt('ftp_client',
+               default='thread',
+               choices=('thread', 'green'),
+               help='How ftp sessions are driven: thread runs the workers '
+                    'of a transfer each in a thread of its own, green runs '
+                    'them as green threads over eventlet sockets'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_green_opts)
+
+LOG = logging.getLogger(__name__)
+
+THREAD = 'thread'
+GREEN = 'green'
+
+QUEUE_FULL = (queue.Full, green_queue.Full)
+QUEUE_EMPTY = (queue.Empty, green_queue.Empty)
+
+# seconds between two looks at a condition a green thread waits for
+_POLL = 0.05
+
+# the names ftplib raises, kept the same in the green copy so that the
+# errors it raises are caught as the ones of ftplib
+_ERRORS = ('Error', 'error_reply', 'error_temp', 'error_perm',
+           'error_proto', 'all_errors')
+
+_ftplib = None
+_lock = threading.Lock()
+
+
+def enabled():
+    return CONF.ftp_client == GREEN
+
+
+def ftplib_module():
+    """The vendored ftplib, its sockets green when enabled."""
+    if not enabled():
+        return ftplib
+    global _ftplib
+    with _lock:
+        if _ftplib is None:
+            module = eventlet.import_patched(ftplib.__name__)
+            for name in _ERRORS:
+                setattr(module, name, getattr(ftplib, name))
+            _ftplib = module
+    return _ftplib
+
+
+def local():
+    """Storage of each worker, green thread or thread."""
+    if enabled():
+        return corolocal.local()
+    return threading.local()
+
+
+def priority_queue(maxsize):
+    if enabled():
+        return green_queue.PriorityQueue(maxsize)
+    return queue.PriorityQueue(maxsize)
+
+
+def wait(cond, timeout):
+    """Wait on the held threading.Condition cond for timeout at most.
+
+    A green thread can not block its thread, the others waking it up run
+    in it as well: it polls instead.
+    """
+    if not enabled():
+        cond.wait(timeout)
+        return
+    cond.release()
+    try:
+        eventlet.sleep(min(timeout, _POLL))
+    finally:
+        cond.acquire()
+
+
+class _GreenWorker(object):
+
+    def __init__(self, target, name):
+        self.name = name
+        self._thread = eventlet.spawn(target)
+
+    def join(self):
+        try:
+            self._thread.wait()
+        except Exception as e:
+            LOG.error("Ftp worker %(name)s error: %(error)s",
+                      {'name': self.name, 'error': e})
+
+
+def start(target, name):
+    """Run target in a worker, returns it to be joined.
+
+    Green workers run in the thread of the caller, once it waits.
+    """
+    if enabled():
+        return _GreenWorker(target, name)
+    thread = threading.Thread(target=target, name=name)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,214 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Typed listings of ftp directories.
+
+A directory is listed in one pass with MLSD when the server knows it, and
+with LIST otherwise, whose unix or DOS style lines are parsed. Each entry
+comes with its type, size and modification time.
+"""
+
+import calendar
+import collections
+import re
+import time
+
+from oslo_log import log as logging
+
+from conveyoragent.engine.agent.ftp import ftplib
+
+LOG = logging.getLogger(__name__)
+
+ENTRY_TYPES = (DIR, FILE, LINK, OTHER) = ('dir', 'file', 'link', 'other')
+
+# mtime is seconds since the epoch, None when the server did not say
+Entry = collections.namedtuple('Entry', ['name', 'type', 'size', 'mtime'])
+
+_MONTHS = dict((name, index + 1) for index, name in
+               enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                          'jul', 'aug', 'sep', 'oct', 'nov', 'dec']))
+
+# drwxr-xr-x 2 owner group 4096 Jan 01 12:00 name, group being optional
+_UNIX_LINE = re.compile(
+    r'^([-dlbcps])\S{9}\S?\s+\d+\s+(?:\S+\s+){1,2}(\d+)\s+'
+    r'([A-Za-z]{3})\s+(\d{1,2})\s+(\d{1,2}:\d{2}|\d{4})\s(.*)$')
+# 01-31-20  09:15PM       <DIR>          name
+_DOS_LINE = re.compile(
+    r'^(\d{2})-(\d{2})-(\d{2,4})\s+(\d{1,2}):(\d{2})([AP]M)\s+'
+    r'(<DIR>|\d+)\s+(.*)$', re.IGNORECASE)
+
+_UNIX_TYPES = {'d': DIR, '-': FILE, 'l': LINK}
+
+# replies of servers not knowing MLSD
+_UNSUPPORTED = ('500', '501', '502', '504')
+
+
+def parse_mlsd_line(line):
+    facts, _sep, name = line.partition(' ')
+    if not name:
+        return None
+    values = {}
+    for fact in facts.split(';'):
+        key, _sep, value = fact.partition('=')
+        if key:
+            values[key.lower()] = value
+    kind = values.get('type', '').lower()
+    if kind in ('cdir', 'pdir'):
+        return None
+    if kind == 'dir':
+        kind = DIR
+    elif kind == 'file':
+        kind = FILE
+    elif kind.startswith('os.unix=slink') or kind == 'os.unix=symlink':
+        kind = LINK
+    else:
+        kind = OTHER
+    size = values.get('size') or values.get('sizd')
+    return Entry(name, kind, int(size) if size and size.isdigit() else 0,
+                 _parse_mlsd_time(values.get('modify')))
+
+
+def _parse_mlsd_time(value):
+    if not value or len(value) < 14:
+        return None
+    try:
+        return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+    except ValueError:
+        return None
+
+
+def parse_mdtm(resp):
+    """Seconds since the epoch of a 213 reply to MDTM, None if invalid."""
+    code, _sep, value = resp.partition(' ')
+    if code != '213':
+        return None
+    return _parse_mlsd_time(value.strip())
+
+
+def parse_list_line(line, now=None):
+    """Entry of a line of LIST output, None for lines that are not one."""
+    match = _UNIX_LINE.match(line)
+    if match:
+        kind, size, month, day, stamp, name = match.groups()
+        kind = _UNIX_TYPES.get(kind, OTHER)
+        if kind == LINK:
+            name = name.split(' -> ', 1)[0]
+        return Entry(name, kind, int(size),
+                     _unix_time(month, day, stamp, now))
+
+    match = _DOS_LINE.match(line)
+    if match:
+        month, day, year, hour, minute, half, size, name = match.groups()
+        year = int(year)
+        if year < 100:
+            year += 2000 if year < 70 else 1900
+        hour = int(hour) % 12 + (12 if half.upper() == 'PM' else 0)
+        try:
+            mtime = calendar.timegm((year, int(month), int(day), hour,
+                                     int(minute), 0, 0, 0, 0))
+        except ValueError:
+            mtime = None
+        if size.upper() == '<DIR>':
+            return Entry(name, DIR, 0, mtime)
+        return Entry(name, FILE, int(size), mtime)
+    return None
+
+
+def _unix_time(month, day, stamp, now=None):
+    month = _MONTHS.get(month.lower())
+    if month is None:
+        return None
+    if ':' in stamp:
+        # within the last six months, the year is left out
+        hour, minute = [int(v) for v in stamp.split(':')]
+        now = time.time() if now is None else now
+        year = time.gmtime(now).tm_year
+        mtime = calendar.timegm((year, month, int(day), hour, minute, 0,
+                                 0, 0, 0))
+        if mtime > now + 86400:
+            mtime = calendar.timegm((year - 1, month, int(day), hour,
+                                     minute, 0, 0, 0, 0))
+        return mtime
+    return calendar.timegm((int(stamp), month, int(day), 0, 0, 0, 0, 0, 0))
+
+
+class Lister(object):
+    """Lists directories of one session, each of them once.
+
+    Listings are kept for the life of the lister, a tree walk.
+    """
+
+    def __init__(self, ftp):
+        self.ftp = ftp
+        # None until the server answered MLSD once
+        self.mlsd = None
+        self._cache = {}
+
+    def list(self, path):
+        """Entries of the directory path, which becomes the current one."""
+        self.ftp.cwd(path)
+        entries = self._cache.get(path)
+        if entries is None:
+            entries = self._cache[path] = self._list()
+        return entries
+
+    def resolve(self, path):
+        """Type of what the link path points to, DIR or FILE."""
+        try:
+            self.ftp.cwd(path)
+        except ftplib.error_perm:
+            return FILE
+        return DIR
+
+    def mtime(self, path, entry=None):
+        """Modification time of the file path, None if the server can not
+        tell it to the second.
+
+        MLSD listings have it, otherwise MDTM is asked.
+        """
+        if self.mlsd and entry is not None and entry.mtime is not None:
+            return entry.mtime
+        try:
+            return parse_mdtm(self.ftp.sendcmd('MDTM ' + path))
+        except ftplib.error_perm as e:
+            LOG.debug("Ftp MDTM %(path)s error: %(error)s",
+                      {'path': path, 'error': e})
+            return None
+
+    def _list(self):
+        if self.mlsd is not False:
+            lines = []
+            try:
+                self.ftp.retrlines('MLSD', lines.append)
+            except ftplib.error_perm as e:
+                if not str(e).startswith(_UNSUPPORTED):
+                    raise
+                LOG.debug("Ftp server does not know MLSD: %s", e)
+                self.mlsd = False
+            else:
+                self.mlsd = True
+                return [entry for entry in map(parse_mlsd_line, lines)
+                        if entry and entry.name not in ('.', '..')]
+
+        lines = []
+        self.ftp.retrlines('LIST', lines.append)
+        now = time.time()
+        entries = []
+        for line in lines:
+            entry = parse_list_line(line, now)
+            if entry is None:
+                if not line.lower().startswith('total'):
+                    LOG.debug("Skip unknown ftp listing line: %s", line)
+                continue
+            if entry.name not in ('.', '..'):
+                entries.append(entry)
+        return entries
@@ -0,0 +1,222 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Pool of logged in ftp sessions.
+
+Sessions are kept per (host, port, user). An idle session is checked with
+NOOP before it is handed out again and closed once it stayed idle too
+long; a caller asking for a session of a server with max_per_host of them
+busy waits for one to come back, unless it would rather do without.
+"""
+
+import socket
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from conveyoragent.engine.agent.ftp import ftplib
+from conveyoragent.engine.agent.ftp import green
+from conveyoragent.engine.agent.ftp import stream
+from conveyoragent import exception
+
+ftp_pool_opts = [
+    cfg.IntOpt('ftp_pool_max_per_host',
+               default=8,
+               help='Ftp sessions opened at most to one server and user, '
+                    'a tree download takes one more than its workers'),
+    cfg.IntOpt('ftp_pool_idle_timeout',
+               default=300,
+               help='Seconds an unused ftp session is kept open'),
+    cfg.IntOpt('ftp_pool_acquire_timeout',
+               default=600,
+               help='Seconds to wait for a busy server to free an ftp '
+                    'session'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_pool_opts)
+
+LOG = logging.getLogger(__name__)
+
+# errors after which a session is not reused
+SESSION_ERRORS = ftplib.all_errors + (socket.error, EOFError)
+
+
+class Session(object):
+    """A logged in ftp connection and the directory it started in."""
+
+    def __init__(self, key, ftp, home):
+        self.key = key
+        self.ftp = ftp
+        self.home = home
+        self.last_used = time.time()
+
+    def reset(self):
+        """Undo what a user of the session changed."""
+        self.ftp.set_pasv(True)
+        if self.ftp.pwd() != self.home:
+            self.ftp.cwd(self.home)
+
+    def close(self):
+        try:
+            self.ftp.quit()
+        except SESSION_ERRORS:
+            self.ftp.close()
+
+
+class SessionPool(object):
+
+    def __init__(self, max_per_host=None, idle_timeout=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._idle = {}
+        self._open = {}
+        self._cond = threading.Condition()
+
+    def _limit(self):
+        limit = self.max_per_host
+        if limit is None:
+            limit = CONF.ftp_pool_max_per_host
+        return max(limit, 1)
+
+    def _timeout(self):
+        if self.idle_timeout is None:
+            return CONF.ftp_pool_idle_timeout
+        return self.idle_timeout
+
+    def acquire(self, host, port, user, passwd, timeout=-999, wait=True):
+        """A session of the server, None if all are busy and not wait."""
+        key = (host, int(port), user)
+        deadline = time.time() + CONF.ftp_pool_acquire_timeout
+        while True:
+            for session in self._evict():
+                session.close()
+            with self._cond:
+                idle = self._idle.get(key)
+                if idle:
+                    session = idle.pop()
+                elif self._open.get(key, 0) < self._limit():
+                    self._open[key] = self._open.get(key, 0) + 1
+                    session = None
+                elif not wait:
+                    return None
+                else:
+                    left = deadline - time.time()
+                    if left <= 0:
+                        raise exception.DownLoadDataError(
+                            error="no free ftp session to %s:%s" %
+                                  (host, port))
+                    green.wait(self._cond, min(left, 1.0))
+                    continue
+
+            if session is None:
+                return self._connect(key, passwd, timeout)
+            if self._alive(session):
+                return session
+            self._discard(session)
+
+    def release(self, session, broken=False):
+        if not broken:
+            try:
+                session.reset()
+            except SESSION_ERRORS as e:
+                LOG.debug("Reset ftp session to %(host)s failed: %(error)s",
+                          {'host': session.key[0], 'error': e})
+                broken = True
+        if broken:
+            self._discard(session)
+            return
+        session.last_used = time.time()
+        with self._cond:
+            self._idle.setdefault(session.key, []).append(session)
+            self._cond.notify()
+
+    def close_idle(self, key=None):
+        """Close the idle sessions, of the server key only if given."""
+        with self._cond:
+            if key is None:
+                keys = list(self._idle)
+            else:
+                keys = [key]
+            sessions = []
+            for k in keys:
+                sessions.extend(self._idle.pop(k, []))
+            for session in sessions:
+                self._open[session.key] -= 1
+            self._cond.notify_all()
+        for session in sessions:
+            session.close()
+
+    def _connect(self, key, passwd, timeout):
+        host, port, user = key
+        ftp = green.ftplib_module().FTP()
+        stream.configure(ftp)
+        try:
+            ftp.connect(host, port, timeout)
+            ftp.login(user, passwd)
+            home = ftp.pwd()
+        except Exception as e:
+            ftp.close()
+            with self._cond:
+                self._open[key] -= 1
+                self._cond.notify()
+            LOG.error("Ftp connect %(host)s:%(port)s error: %(error)s",
+                      {'host': host, 'port': port, 'error': e})
+            raise
+        LOG.debug("Ftp login %(user)s@%(host)s:%(port)s success",
+                  {'user': user, 'host': host, 'port': port})
+        return Session(key, ftp, home)
+
+    def _alive(self, session):
+        try:
+            session.ftp.voidcmd('NOOP')
+            return True
+        except SESSION_ERRORS as e:
+            LOG.debug("Drop dead ftp session to %(host)s: %(error)s",
+                      {'host': session.key[0], 'error': e})
+            return False
+
+    def _discard(self, session):
+        with self._cond:
+            self._open[session.key] -= 1
+            self._cond.notify()
+        session.close()
+
+    def _evict(self):
+        """Take the sessions idle for too long out of the pool."""
+        expired = []
+        limit = time.time() - self._timeout()
+        with self._cond:
+            for key, idle in self._idle.items():
+                keep = [s for s in idle if s.last_used >= limit]
+                if len(keep) != len(idle):
+                    expired.extend(s for s in idle if s.last_used < limit)
+                    self._open[key] -= len(idle) - len(keep)
+                    self._idle[key] = keep
+            if expired:
+                self._cond.notify_all()
+        return expired
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The pool shared by every FtpAgent of the process."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SessionPool()
+        return _pool
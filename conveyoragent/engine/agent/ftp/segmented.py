@@ -0,0 +1,249 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Download of a large ftp file in segments over several sessions.
+
+The local file is allocated at its full size, then sessions each RETR a
+segment from its REST offset and write it in place: the one of the caller
+and the ones the pool has free, so that downloads of one server never wait
+on each other's sessions. A sidecar file next to the local one lists the
+segments already written, so that a retry only fetches the others.
+"""
+
+import os
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+from conveyoragent.engine.agent.ftp import ftplib
+from conveyoragent.engine.agent.ftp import green
+from conveyoragent.engine.agent.ftp import stream
+from conveyoragent.engine.common import throttle
+from conveyoragent import exception
+
+ftp_segment_opts = [
+    cfg.IntOpt('ftp_segment_sessions',
+               default=4,
+               help='Sessions a large ftp file is downloaded over, 1 to '
+                    'download every file over a single one'),
+    cfg.IntOpt('ftp_segment_size',
+               default=256 * 1024 * 1024,
+               help='Bytes of each segment of a large ftp file'),
+    cfg.IntOpt('ftp_segment_min_file_size',
+               default=1024 * 1024 * 1024,
+               help='Files from this size on are downloaded in segments'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_segment_opts)
+
+LOG = logging.getLogger(__name__)
+
+_SUFFIX = '.segments'
+
+
+def should_segment(size):
+    return (CONF.ftp_segment_sessions > 1 and CONF.ftp_segment_size > 0 and
+            size >= max(CONF.ftp_segment_min_file_size, 1))
+
+
+def state_path(localpath):
+    return localpath + _SUFFIX
+
+
+class SegmentState(object):
+    """Sidecar of a local file listing the segments written to it."""
+
+    def __init__(self, localpath):
+        self.path = state_path(localpath)
+        self.size = None
+        self.segment_size = None
+        self.done = set()
+
+    def load(self, size, segment_size):
+        """Read the sidecar, False if there is none for this download."""
+        try:
+            with open(self.path) as f:
+                record = jsonutils.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return False
+        if (record.get('size') != size or
+                record.get('segment_size') != segment_size):
+            LOG.info("Ftp segments of %s are of another download, start "
+                     "over", self.path)
+            return False
+        self.size = size
+        self.segment_size = segment_size
+        self.done = set(record.get('done', []))
+        return True
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(jsonutils.dumps({'size': self.size,
+                                     'segment_size': self.segment_size,
+                                     'done': sorted(self.done)}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class SegmentedDownload(object):
+    """Downloads remotepath of size bytes with sessions of an FtpAgent."""
+
+    def __init__(self, agent, host, port, localpath, remotepath, size,
+                 limiter=None, sessions=None):
+        self.agent = agent
+        self.host = host
+        self.port = port
+        self.localpath = localpath
+        self.remotepath = remotepath
+        self.size = size
+        self.limiter = limiter or throttle.limiter()
+        if sessions is None:
+            sessions = CONF.ftp_segment_sessions
+        # the other downloads of the server need sessions as well
+        self.sessions = max(min(int(sessions),
+                                CONF.ftp_pool_max_per_host - 1), 1)
+        self.segment_size = max(CONF.ftp_segment_size, 1)
+        self.count = max((size + self.segment_size - 1) //
+                         self.segment_size, 1)
+        self.state = SegmentState(localpath)
+        self.errors = []
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        self._prepare()
+        self._pending = [index for index in range(self.count)
+                         if index not in self.state.done]
+        LOG.debug("Ftp download %(remote)s: %(missing)s of %(count)s "
+                  "segments to fetch",
+                  {'remote': self.remotepath,
+                   'missing': len(self._pending), 'count': self.count})
+
+        threads = []
+        for index in range(min(self.sessions, len(self._pending)) - 1):
+            threads.append(green.start(self._work,
+                                       'ftp-segment-%d' % index))
+        try:
+            self._fetch_pending(self.agent.ftp)
+        finally:
+            for thread in threads:
+                thread.join()
+
+        if len(self.state.done) < self.count:
+            raise exception.DownLoadDataError(
+                error="%(missing)d of %(count)d segments of %(remote)s "
+                      "failed: %(error)s" %
+                      {'missing': self.count - len(self.state.done),
+                       'count': self.count, 'remote': self.remotepath,
+                       'error': self.errors[0] if self.errors else None})
+        self.state.remove()
+
+    def _prepare(self):
+        """Allocate the local file unless an earlier attempt did."""
+        if (self.state.load(self.size, self.segment_size) and
+                os.path.exists(self.localpath)):
+            return
+        self.state.size = self.size
+        self.state.segment_size = self.segment_size
+        self.state.done = set()
+        # the sidecar comes first: a full size file without one is taken
+        # for a complete download
+        self.state.save()
+        fd = os.open(self.localpath, os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, self.size)
+        finally:
+            os.close(fd)
+
+    def _next(self):
+        with self._lock:
+            if self._pending:
+                return self._pending.pop(0)
+            return None
+
+    def _work(self):
+        with self.agent._session(self.host, wait=False) as session:
+            if session is None:
+                LOG.debug("No free ftp session to %(host)s:%(port)s for a "
+                          "segment of %(remote)s",
+                          {'host': self.host, 'port': self.port,
+                           'remote': self.remotepath})
+                return
+            self._fetch_pending(session.ftp)
+
+    def _fetch_pending(self, ftp):
+        index = None
+        try:
+            ftp.voidcmd('TYPE I')
+            while True:
+                index = self._next()
+                if index is None:
+                    return
+                self._fetch(ftp, index)
+                with self._lock:
+                    self.state.done.add(index)
+                    self.state.save()
+                index = None
+        except Exception as e:
+            # the segment is left to the next attempt
+            self._fail("segment %s: %s" % (index, e))
+
+    def _fetch(self, ftp, index):
+        offset = index * self.segment_size
+        length = min(self.segment_size, self.size - offset)
+        last = offset + length >= self.size
+        fd = os.open(self.localpath, os.O_WRONLY)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            conn = ftp.transfercmd('RETR ' + self.remotepath, offset)
+            try:
+                received = stream.receive(conn, stream.fd_writer(fd),
+                                          self.limiter, length=length)
+            finally:
+                conn.close()
+            if received < length:
+                raise EOFError("%s ended at %d" %
+                               (self.remotepath, offset + received))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        if last:
+            ftp.voidresp()
+            return
+        # the server notices the data connection closed before the end
+        try:
+            ftp.voidresp()
+        except ftplib.error_temp:
+            pass
+
+    def _fail(self, error):
+        LOG.error("Ftp segmented download of %(remote)s error: %(error)s",
+                  {'remote': self.remotepath, 'error': error})
+        with self._lock:
+            self.errors.append(error)
+
+
+def is_pending(localpath):
+    """Whether a segmented download of localpath was left unfinished."""
+    return os.path.exists(state_path(localpath))
@@ -0,0 +1,135 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Receive side of ftp data connections.
+
+Data is read with recv_into into a buffer each thread allocates once and
+handed on as memoryview slices of it, so that no string is built per
+chunk. Bytes and seconds of every transfer add up in agent wide counters.
+"""
+
+import os
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+ftp_stream_opts = [
+    cfg.IntOpt('ftp_receive_buffer_size',
+               default=1024 * 1024,
+               help='Bytes read from an ftp data connection at once, into '
+                    'a buffer each thread reuses'),
+    cfg.IntOpt('ftp_socket_receive_buffer',
+               default=0,
+               help='SO_RCVBUF of ftp data connections, 0 to leave it to '
+                    'the kernel'),
+    cfg.IntOpt('ftp_socket_send_buffer',
+               default=0,
+               help='SO_SNDBUF of ftp data connections, 0 to leave it to '
+                    'the kernel'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_stream_opts)
+
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class TransferCounters(object):
+    """Thread safe totals of the ftp transfers of the agent."""
+
+    def __init__(self):
+        self.transfers = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.last_rate = None
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, seconds):
+        with self._lock:
+            self.transfers += 1
+            self.bytes += nbytes
+            self.seconds += seconds
+            if seconds > 0:
+                self.last_rate = nbytes / seconds
+
+    def to_dict(self):
+        with self._lock:
+            rate = None
+            if self.seconds > 0:
+                rate = int(self.bytes / self.seconds)
+            return {'transfers': self.transfers,
+                    'bytes': self.bytes,
+                    'seconds': round(self.seconds, 3),
+                    'rate': rate,
+                    'last_rate': (int(self.last_rate)
+                                  if self.last_rate is not None else None)}
+
+
+_counters = TransferCounters()
+
+
+def get_counters():
+    return _counters
+
+
+def configure(ftp):
+    """Size the sockets of the data connections of an ftplib.FTP."""
+    ftp.rcvbuf = max(CONF.ftp_socket_receive_buffer, 0)
+    ftp.sndbuf = max(CONF.ftp_socket_send_buffer, 0)
+
+
+def buffer():
+    """The receive buffer of the calling thread."""
+    size = max(CONF.ftp_receive_buffer_size, 4096)
+    buf = getattr(_local, 'buf', None)
+    if buf is None or len(buf) != size:
+        buf = _local.buf = bytearray(size)
+    return buf
+
+
+def fd_writer(fd):
+    """Write function of receive() for the file descriptor fd."""
+    def write(view):
+        written = 0
+        while written < len(view):
+            written += os.write(fd, view[written:])
+    return write
+
+
+def receive(conn, write, limiter=None, length=None):
+    """Pass what conn sends to write, up to length bytes if given.
+
+    write is given memoryview slices of the buffer of the thread, valid
+    until it returns. Returns the bytes received.
+    """
+    view = memoryview(buffer())
+    size = len(view)
+    received = 0
+    start = time.time()
+    try:
+        while length is None or received < length:
+            if length is not None:
+                size = min(len(view), length - received)
+            n = conn.recv_into(view[:size])
+            if not n:
+                break
+            if limiter is not None:
+                limiter.consume(n)
+            write(view[:n])
+            received += n
+    finally:
+        _counters.add(received, time.time() - start)
+    return received
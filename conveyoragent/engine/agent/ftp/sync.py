@@ -0,0 +1,161 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Manifest of the files a tree download already wrote.
+
+For each file the remote size and mtime it was downloaded at are kept,
+along with whether it was written completely. A later download of the same
+tree skips the files whose remote size and mtime did not change, and
+resumes the partial ones from the size they have locally.
+
+The manifest is a file of records 'flag size mtime path' each ended by a
+NUL byte, which no path contains. Records are appended as files start and
+finish, the last record of a path being the one that counts, and the file
+is rewritten with one record per path once a download is over. Loading it
+keeps a short string per path.
+"""
+
+import hashlib
+import os
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+import six
+
+ftp_sync_opts = [
+    cfg.StrOpt('ftp_sync_manifest_dir',
+               default='$state_path/sync',
+               help='Directory the manifests of synced ftp trees are kept '
+                    'in'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_sync_opts)
+
+LOG = logging.getLogger(__name__)
+
+COMPLETE = 'C'
+PARTIAL = 'P'
+
+ACTIONS = (SKIP, RESUME, FETCH) = ('skip', 'resume', 'fetch')
+
+_END = '\0'
+
+
+def _encode(text):
+    if six.PY2:
+        return text
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def _decode(data):
+    if six.PY2:
+        return data
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def manifest_path(host, port, remotepath, localpath):
+    key = '%s:%s:%s:%s' % (host, port, remotepath, localpath)
+    return os.path.join(CONF.ftp_sync_manifest_dir,
+                        hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+class Manifest(object):
+    """Thread safe manifest of the tree kept in the file path."""
+
+    def __init__(self, path):
+        self.path = path
+        # relative path: 'flag size mtime'
+        self._entries = {}
+        self._log = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Read the manifest, empty if there is none, and open it for
+        appending.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = b''
+        entries = self._entries
+        for record in _decode(data).split(_END):
+            parts = record.split(' ', 3)
+            if len(parts) != 4:
+                # a record cut by a crash
+                continue
+            entries[parts[3]] = ' '.join(parts[:3])
+        LOG.debug("Ftp sync manifest %(path)s: %(count)s files",
+                  {'path': self.path, 'count': len(entries)})
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._log = open(self.path, 'ab')
+        return self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def known(self, rel):
+        return rel in self._entries
+
+    def check(self, rel, size, mtime, local_size):
+        """What to do with the file rel the server now lists with size
+        and mtime, local_size being its size here, None if missing.
+
+        Returns the action and the offset to resume from.
+        """
+        head = self._entries.get(rel)
+        if head is None or mtime is None or local_size is None:
+            return FETCH, 0
+        flag, old_size, old_mtime = head.split(' ')
+        if int(old_size) != size or int(old_mtime) != mtime:
+            return FETCH, 0
+        if flag == COMPLETE and local_size == size:
+            return SKIP, 0
+        if flag == PARTIAL and 0 < local_size < size:
+            return RESUME, local_size
+        return FETCH, 0
+
+    def record(self, flag, rel, size, mtime):
+        head = '%s %d %d' % (flag, size, mtime)
+        line = _encode(head + ' ' + rel + _END)
+        with self._lock:
+            self._entries[rel] = head
+            self._log.write(line)
+            if flag == COMPLETE:
+                # a crash loses a few records at most, which are fetched
+                # again
+                self._log.flush()
+
+    def close(self):
+        """Rewrite the manifest with the last record of each path."""
+        with self._lock:
+            if self._log is None:
+                return
+            self._log.close()
+            self._log = None
+            tmp_path = self.path + '.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for rel, head in self._entries.items():
+                        f.write(_encode(head + ' ' + rel + _END))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(tmp_path, self.path)
+            except (IOError, OSError) as e:
+                # the records appended are still there
+                LOG.warning("Compact ftp sync manifest %(path)s error: "
+                            "%(error)s", {'path': self.path, 'error': e})
@@ -0,0 +1,260 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Parallel download of an ftp directory tree.
+
+The calling thread walks the remote tree on its session, listing every
+directory once, and queues the files it finds; workers, each on a session
+of its own, download them concurrently. Queued files are taken largest
+first so that the long transfers start early instead of trailing at the
+end. Links to directories are not followed, and local paths in skip, such
+as the ones a bundle brought, are left as they are.
+
+A worker only takes a session the pool has free and the walker downloads
+what the workers left, so that the trees of one server never wait on each
+other's sessions.
+
+Given the sync manifest of an earlier download of the tree, the files it
+wrote that did not change since are skipped and the partial ones resumed.
+"""
+
+import itertools
+import os
+import posixpath
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from conveyoragent.engine.agent.ftp import green
+from conveyoragent.engine.agent.ftp import listing
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.engine.agent.ftp import sync as ftp_sync
+from conveyoragent import exception
+
+ftp_tree_opts = [
+    cfg.IntOpt('ftp_download_workers',
+               default=4,
+               help='Files of an ftp directory tree downloaded at once, '
+                    'each over its own session'),
+    cfg.IntOpt('ftp_download_queue_size',
+               default=10000,
+               help='Files listed ahead of the workers of an ftp tree '
+                    'download, the largest of them being fetched first'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_tree_opts)
+
+LOG = logging.getLogger(__name__)
+
+# sorts after every file
+_DONE = (float('inf'), 0, None, None, 0, None, 0)
+
+
+class TreeDownload(object):
+    """Downloads remotepath to localpath with workers of an FtpAgent."""
+
+    def __init__(self, agent, host, port, localpath, remotepath,
+                 compression_stats=None, limiter=None, workers=None,
+                 skip=None, sync=None):
+        self.agent = agent
+        self.host = host
+        self.port = port
+        self.localpath = localpath
+        self.remotepath = remotepath
+        self.compression_stats = compression_stats
+        self.limiter = limiter
+        if workers is None:
+            workers = CONF.ftp_download_workers
+        # the walker holds a session of the server as well
+        self.workers = max(min(int(workers),
+                               CONF.ftp_pool_max_per_host - 1), 1)
+        self.skip = skip or set()
+        self.sync = sync
+        self.files = 0
+        self.bytes = 0
+        self.unchanged = 0
+        self.errors = []
+        self._queue = green.priority_queue(
+            max(CONF.ftp_download_queue_size, 1))
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._alive = 0
+
+    def run(self):
+        """Walk and download the tree, on the session of the caller."""
+        threads = []
+        with self._lock:
+            self._alive = self.workers
+        for index in range(self.workers):
+            threads.append(green.start(self._work, 'ftp-tree-%d' % index))
+
+        try:
+            self._walk()
+        finally:
+            for _thread in threads:
+                self._put(_DONE)
+            for thread in threads:
+                thread.join()
+        # the files of workers that got no session
+        while self._download_next():
+            pass
+
+        LOG.debug("Ftp tree %(remote)s downloaded: %(files)s files, "
+                  "%(bytes)s bytes, %(unchanged)s unchanged, %(errors)s "
+                  "errors",
+                  {'remote': self.remotepath, 'files': self.files,
+                   'bytes': self.bytes, 'unchanged': self.unchanged,
+                   'errors': len(self.errors)})
+        if self.errors:
+            raise exception.DownLoadDataError(
+                error="%(count)d files of %(remote)s failed: %(error)s" %
+                      {'count': len(self.errors), 'remote': self.remotepath,
+                       'error': self.errors[0]})
+
+    def _walk(self):
+        ftp = self.agent.ftp
+        ftp.cwd(self.remotepath)
+        lister = listing.Lister(ftp)
+        pending = [(ftp.pwd(), self.localpath)]
+        while pending:
+            remote_dir, local_dir = pending.pop()
+            if not os.path.isdir(local_dir):
+                os.makedirs(local_dir)
+            for entry in lister.list(remote_dir):
+                remote = posixpath.join(remote_dir, entry.name)
+                local = os.path.join(local_dir, entry.name)
+                if local in self.skip:
+                    continue
+                kind = entry.type
+                if kind == listing.LINK:
+                    kind = lister.resolve(remote)
+                if entry.type == listing.DIR:
+                    pending.append((remote, local))
+                elif kind == listing.FILE:
+                    self._queue_file(lister, remote, local, entry)
+                else:
+                    LOG.debug("Skip ftp entry %(remote)s of type "
+                              "%(type)s", {'remote': remote,
+                                           'type': entry.type})
+
+    def _queue_file(self, lister, remote, local, entry):
+        # the size of a link is the one of the link itself
+        mtime = None
+        rest = 0
+        if self.sync is not None:
+            rel = os.path.relpath(local, self.localpath)
+            if self.sync.known(rel):
+                mtime = lister.mtime(remote, entry)
+                action, rest = self.sync.check(rel, entry.size, mtime,
+                                               _local_size(local))
+                if action == ftp_sync.SKIP:
+                    self.unchanged += 1
+                    return
+            elif lister.mlsd:
+                mtime = entry.mtime
+        self._put((-entry.size, next(self._seq), remote, local, entry.size,
+                   mtime, rest))
+
+    def _put(self, item):
+        while True:
+            try:
+                self._queue.put(item, timeout=1.0)
+                return
+            except green.QUEUE_FULL:
+                with self._lock:
+                    alive = self._alive
+                if not alive:
+                    if item is _DONE:
+                        return
+                    # no worker is left, make room on the walker session
+                    self._download_next()
+
+    def _work(self):
+        try:
+            while True:
+                try:
+                    with self.agent._session(self.host,
+                                             wait=False) as session:
+                        if session is None:
+                            LOG.debug("No free ftp session to "
+                                      "%(host)s:%(port)s for a worker of "
+                                      "%(remote)s",
+                                      {'host': self.host, 'port': self.port,
+                                       'remote': self.remotepath})
+                            return
+                        self._download_queued()
+                        return
+                except pool.SESSION_ERRORS as e:
+                    # the file is counted failed, carry on with a new
+                    # session
+                    LOG.warning("Ftp worker session broke: %s", e)
+        finally:
+            with self._lock:
+                self._alive -= 1
+
+    def _download_queued(self):
+        while True:
+            item = self._queue.get()
+            if item[2] is None:
+                return
+            self._download(item)
+
+    def _download_next(self):
+        """Download the next queued file on the session of the caller,
+        False if none is queued.
+        """
+        try:
+            item = self._queue.get_nowait()
+        except green.QUEUE_EMPTY:
+            return False
+        if item[2] is not None:
+            self._download(item)
+        return True
+
+    def _download(self, item):
+        _priority, _seq, remote, local, size, mtime, rest = item
+        rel = None
+        try:
+            if self.sync is not None:
+                if mtime is None:
+                    mtime = listing.Lister(self.agent.ftp).mtime(remote)
+                if mtime is not None:
+                    rel = os.path.relpath(local, self.localpath)
+                    self.sync.record(ftp_sync.PARTIAL, rel, size, mtime)
+            self.agent._downLoadFile(local, remote,
+                                     self.compression_stats,
+                                     self.limiter, rest=rest)
+        except pool.SESSION_ERRORS as e:
+            self._fail("%s: %s" % (remote, e))
+            raise
+        except Exception as e:
+            self._fail("%s: %s" % (remote, e))
+            return
+        if rel is not None:
+            self.sync.record(ftp_sync.COMPLETE, rel, size, mtime)
+        with self._lock:
+            self.files += 1
+            self.bytes += size - rest
+
+    def _fail(self, error):
+        LOG.error("Ftp tree download error: %s", error)
+        with self._lock:
+            self.errors.append(error)
+
+
+def _local_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
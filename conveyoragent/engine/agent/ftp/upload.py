@@ -0,0 +1,228 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Parallel upload of a local directory tree over ftp.
+
+The whole local tree is listed first. The remote directories are then
+created on the session of the caller in one pass, the MKD commands being
+sent ahead of their replies, and the files are uploaded by workers each on
+a session of its own, the largest first. Links to directories are not
+followed.
+"""
+
+import os
+import posixpath
+import stat
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from conveyoragent.engine.agent.ftp import ftplib
+from conveyoragent.engine.agent.ftp import green
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent import exception
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        # python 2 without the scandir package
+        scandir = None
+
+ftp_upload_opts = [
+    cfg.IntOpt('ftp_upload_workers',
+               default=4,
+               help='Files of a directory tree uploaded over ftp at once, '
+                    'each over its own session'),
+    cfg.IntOpt('ftp_mkd_window',
+               default=32,
+               help='MKD commands sent ahead of their replies when the '
+                    'remote directories of a tree are created'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(ftp_upload_opts)
+
+LOG = logging.getLogger(__name__)
+
+# reply of servers to MKD of a directory that exists
+_EXISTS = '550'
+
+
+def _entries(path):
+    """(name, is_dir, is_file, size) of the entries of directory path."""
+    if scandir is not None:
+        for entry in scandir(path):
+            is_dir = entry.is_dir(follow_symlinks=False)
+            is_file = not is_dir and entry.is_file()
+            yield (entry.name, is_dir, is_file,
+                   entry.stat().st_size if is_file else 0)
+        return
+    for name in os.listdir(path):
+        full = os.path.join(path, name)
+        st = os.lstat(full)
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if stat.S_ISLNK(st.st_mode):
+            try:
+                st = os.stat(full)
+            except OSError:
+                yield name, False, False, 0
+                continue
+        is_file = stat.S_ISREG(st.st_mode)
+        yield name, is_dir, is_file, st.st_size if is_file else 0
+
+
+def manifest(localpath):
+    """Directories and (path, size) files under localpath.
+
+    Paths are relative to localpath with '/' separators, directories come
+    after their parent.
+    """
+    dirs = []
+    files = []
+    pending = ['']
+    while pending:
+        rel = pending.pop()
+        for name, is_dir, is_file, size in _entries(
+                os.path.join(localpath, rel)):
+            child = posixpath.join(rel, name)
+            if is_dir:
+                dirs.append(child)
+                pending.append(child)
+            elif is_file:
+                files.append((child, size))
+            else:
+                LOG.debug("Skip local entry %s that is not a file", child)
+    return dirs, files
+
+
+class TreeUpload(object):
+    """Uploads localpath to remotepath with workers of an FtpAgent."""
+
+    def __init__(self, agent, host, port, localpath, remotepath,
+                 limiter=None, workers=None):
+        self.agent = agent
+        self.host = host
+        self.port = port
+        self.localpath = localpath
+        self.remotepath = remotepath
+        self.limiter = limiter
+        if workers is None:
+            workers = CONF.ftp_upload_workers
+        self.workers = max(int(workers), 1)
+        self.files = 0
+        self.bytes = 0
+        self.errors = []
+        self._pending = []
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Create the directories on the session of the caller, then
+        upload the files.
+        """
+        dirs, files = manifest(self.localpath)
+        LOG.debug("Ftp upload %(local)s: %(dirs)s directories, %(files)s "
+                  "files", {'local': self.localpath, 'dirs': len(dirs),
+                            'files': len(files)})
+        self._make_dirs([''] + dirs)
+
+        # popped from the end, the largest last
+        self._pending = sorted(files, key=lambda f: f[1])
+        threads = []
+        for index in range(min(self.workers, len(self._pending))):
+            threads.append(green.start(self._work,
+                                       'ftp-upload-%d' % index))
+        for thread in threads:
+            thread.join()
+
+        LOG.debug("Ftp tree %(local)s uploaded: %(files)s files, "
+                  "%(bytes)s bytes, %(errors)s errors",
+                  {'local': self.localpath, 'files': self.files,
+                   'bytes': self.bytes, 'errors': len(self.errors)})
+        if self.errors:
+            raise exception.UpLoadDataError(
+                error="%(count)d files of %(local)s failed: %(error)s" %
+                      {'count': len(self.errors), 'local': self.localpath,
+                       'error': self.errors[0]})
+
+    def _remote(self, rel):
+        if not rel:
+            return self.remotepath
+        return posixpath.join(self.remotepath, rel)
+
+    def _make_dirs(self, dirs):
+        """MKD every directory, keeping window commands in flight.
+
+        The server answers commands in order, and parents come first.
+        """
+        ftp = self.agent.ftp
+        window = max(CONF.ftp_mkd_window, 1)
+        sent = 0
+        answered = 0
+        while answered < len(dirs):
+            while sent < len(dirs) and sent - answered < window:
+                ftp.putcmd('MKD ' + self._remote(dirs[sent]))
+                sent += 1
+            try:
+                ftp.getresp()
+            except ftplib.error_perm as e:
+                if not str(e).startswith(_EXISTS):
+                    raise
+            answered += 1
+
+    def _next(self):
+        with self._lock:
+            if self._pending:
+                return self._pending.pop()
+            return None
+
+    def _work(self):
+        while True:
+            try:
+                with self.agent._session(self.host) as session:
+                    if session is None:
+                        self._fail("no ftp session to %s:%s" %
+                                   (self.host, self.port))
+                        return
+                    self._upload_pending()
+                    return
+            except pool.SESSION_ERRORS as e:
+                # the file is counted failed, carry on with a new session
+                LOG.warning("Ftp worker session broke: %s", e)
+
+    def _upload_pending(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            rel, size = item
+            remote = self._remote(rel)
+            try:
+                self.agent._upLoadFile(os.path.join(self.localpath, rel),
+                                       remote, self.limiter)
+            except pool.SESSION_ERRORS as e:
+                self._fail("%s: %s" % (remote, e))
+                raise
+            except Exception as e:
+                self._fail("%s: %s" % (remote, e))
+                continue
+            with self._lock:
+                self.files += 1
+                self.bytes += size
+
+    def _fail(self, error):
+        LOG.error("Ftp tree upload error: %s", error)
+        with self._lock:
+            self.errors.append(error)
@@ -0,0 +1,151 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Connection of a destination to the FileServer of a source."""
+
+import collections
+import socket
+import threading
+
+import six
+
+from conveyoragent.engine.agent.pull import server
+from conveyoragent import exception
+
+_BUFSIZE = 1024 * 1024
+
+_local = threading.local()
+
+Entry = collections.namedtuple('Entry',
+                               'kind size mtime mode uid gid path')
+
+
+def _buffer():
+    buf = getattr(_local, 'buf', None)
+    if buf is None:
+        buf = _local.buf = bytearray(_BUFSIZE)
+    return buf
+
+
+def _entry(record):
+    fields = record.split(b' ', 6)
+    path = fields[6]
+    if not six.PY2:
+        path = path.decode('utf-8', 'surrogateescape')
+    return Entry(fields[0].decode('ascii'),
+                 *([int(field) for field in fields[1:6]] + [path]))
+
+
+class FileClient(object):
+    """Requests of one connection to a FileServer, one at a time."""
+
+    def __init__(self, host, port, token, timeout=None):
+        self.host = host
+        self.port = int(port)
+        self.token = token
+        self.timeout = timeout
+        self._sock = None
+        # received past the end of the last reply line
+        self._pending = b''
+
+    def __enter__(self):
+        return self.connect()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        self._sock = socket.create_connection((self.host, self.port),
+                                              self.timeout)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._pending = b''
+        return self
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _recv(self):
+        data = self._sock.recv(_BUFSIZE)
+        if not data:
+            raise IOError("pull server %s:%s closed the connection" %
+                          (self.host, self.port))
+        return data
+
+    def _request(self, verb, *args):
+        """Send a request, returns the number of its OK reply."""
+        line = ' '.join((self.token, verb) + args) + '\n'
+        self._sock.sendall(server.encode(line))
+        while b'\n' not in self._pending:
+            self._pending += self._recv()
+        reply, self._pending = self._pending.split(b'\n', 1)
+        if not reply.startswith(b'OK '):
+            raise exception.DownLoadDataError(
+                error="pull %(verb)s %(args)s: %(reply)s" %
+                      {'verb': verb, 'args': ' '.join(args),
+                       'reply': reply.decode('utf-8', 'replace')})
+        return int(reply[3:])
+
+    def walk(self, path=''):
+        """Entries of the tree under path, paths relative to the root.
+
+        The reply has to be read to the end before another request.
+        """
+        self._request('WALK', server.quote(path))
+        buf = self._pending
+        self._pending = b''
+        while True:
+            start = 0
+            while True:
+                end = buf.find(server.END, start)
+                if end < 0:
+                    break
+                if end == start:
+                    self._pending = buf[end + 1:]
+                    return
+                yield _entry(buf[start:end])
+                start = end + 1
+            buf = buf[start:] + self._recv()
+
+    def get(self, path, offset, length, write, limiter=None):
+        """Pass length bytes of path from offset to write, all of the rest
+        of the file if length is -1.
+
+        write is given memoryview slices of a buffer of the thread. Returns
+        the bytes received, less than length if the file is shorter.
+        """
+        expected = self._request('GET', str(offset), str(length),
+                                 server.quote(path))
+        received = 0
+        if self._pending:
+            head = self._pending[:expected]
+            self._pending = self._pending[expected:]
+            if limiter is not None:
+                limiter.consume(len(head))
+            write(memoryview(head))
+            received = len(head)
+
+        view = memoryview(_buffer())
+        while received < expected:
+            n = self._sock.recv_into(view[:min(len(view),
+                                               expected - received)])
+            if not n:
+                raise IOError("pull of %(path)s cut after %(received)s of "
+                              "%(expected)s bytes" %
+                              {'path': path, 'received': received,
+                               'expected': expected})
+            if limiter is not None:
+                limiter.consume(n)
+            write(view[:n])
+            received += n
+        return received
@@ -0,0 +1,264 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Transfers the destination pulls from a file server of the source agent.
+
+Unlike ftp, no daemon has to be set up on the source: its agent serves the
+mount point of the migration itself for as long as the transfer runs. The
+destination lists the tree over one connection, then workers each on a
+connection of their own pull the files, the largest first, files larger
+than a range being pulled in ranges by several workers at once. Modes,
+numeric owners and mtimes are kept.
+"""
+
+import os
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+
+from conveyoragent.engine.agent.ftp import stream
+from conveyoragent.engine.agent.pull import client
+from conveyoragent.engine.agent.pull import server
+from conveyoragent import exception
+
+pull_opts = [
+    cfg.IntOpt('pull_workers',
+               default=8,
+               help='Connections the files of a pulled tree are '
+                    'transferred over at once'),
+    cfg.IntOpt('pull_range_size',
+               default=256 * 1024 * 1024,
+               help='Files larger than this are pulled in ranges of this '
+                    'size, over several connections at once'),
+    cfg.IntOpt('pull_timeout',
+               default=120,
+               help='Seconds to wait for the file server of the source to '
+                    'connect or to send data'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(pull_opts)
+
+LOG = logging.getLogger(__name__)
+
+
+class PullAgent(object):
+    """Serves trees on the source and pulls them on the destination."""
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def start_server(self, path):
+        """Serve path, returns the port and token of the server."""
+        file_server = server.start(path)
+        return {'port': file_server.port, 'token': file_server.token}
+
+    def stop_server(self, port):
+        return server.stop(port)
+
+    def downLoadDirTree(self, host, port, token, localpath, remotepath='',
+                        limiter=None, workers=None):
+        """Pull remotepath of the server on host:port to localpath."""
+        download = TreeDownload(host, port, token, localpath, remotepath,
+                                limiter=limiter, workers=workers)
+        download.run()
+        return download
+
+
+class TreeDownload(object):
+    """Pulls remotepath, relative to the root of a server, to localpath."""
+
+    def __init__(self, host, port, token, localpath, remotepath='',
+                 limiter=None, workers=None):
+        self.host = host
+        self.port = port
+        self.token = token
+        self.localpath = localpath
+        self.remotepath = remotepath.strip('/')
+        self.limiter = limiter
+        if workers is None:
+            workers = CONF.pull_workers
+        self.workers = max(int(workers), 1)
+        self.files = 0
+        self.bytes = 0
+        self.errors = []
+        # (entry, offset, length), popped from the end
+        self._jobs = []
+        # path: ranges of the file still to pull
+        self._left = {}
+        self._lock = threading.Lock()
+
+    def _client(self):
+        return client.FileClient(self.host, self.port, self.token,
+                                 timeout=CONF.pull_timeout).connect()
+
+    def _local(self, entry):
+        """Local path of entry, which the server may not lead out of
+        localpath.
+        """
+        rel = entry.path
+        if self.remotepath:
+            rel = os.path.relpath(rel, self.remotepath)
+        rel = os.path.normpath(rel)
+        local = os.path.join(self.localpath, rel)
+        root = os.path.realpath(self.localpath)
+        # through the links of the local tree as well
+        real = os.path.realpath(local)
+        if (os.path.isabs(rel) or rel == os.pardir or
+                rel.startswith(os.pardir + os.sep) or
+                (real != root and not real.startswith(root + os.sep))):
+            raise exception.DownLoadDataError(
+                error="pulled path %(path)s out of %(local)s" %
+                      {'path': entry.path, 'local': self.localpath})
+        return local
+
+    def run(self):
+        with self._client() as conn:
+            entries = list(conn.walk(self.remotepath))
+        # nothing is written from a walk leading out of localpath
+        for entry in entries:
+            self._local(entry)
+        dirs = [e for e in entries if e.kind == server.DIR]
+        files = [e for e in entries if e.kind == server.FILE]
+        if self.limiter is not None and self.limiter.progress is not None:
+            self.limiter.progress.set_total(sum(e.size for e in files))
+        LOG.debug("Pull %(remote)s from %(host)s:%(port)s: %(dirs)s "
+                  "directories, %(files)s files",
+                  {'remote': self.remotepath or '/', 'host': self.host,
+                   'port': self.port, 'dirs': len(dirs),
+                   'files': len(files)})
+
+        for entry in dirs:
+            path = self._local(entry)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        try:
+            self._queue(files)
+            threads = []
+            for index in range(min(self.workers, len(self._jobs))):
+                thread = threading.Thread(target=self._work,
+                                          name='pull-%d' % index)
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        finally:
+            # written to until now, children first
+            for entry in sorted(dirs, key=lambda e: e.path, reverse=True):
+                _set_attributes(self._local(entry), entry)
+
+        LOG.debug("Pulled %(remote)s: %(files)s files, %(bytes)s bytes, "
+                  "%(errors)s errors",
+                  {'remote': self.remotepath or '/', 'files': self.files,
+                   'bytes': self.bytes, 'errors': len(self.errors)})
+        if self.errors:
+            raise exception.DownLoadDataError(
+                error="%(count)d files of %(remote)s failed: %(error)s" %
+                      {'count': len(self.errors),
+                       'remote': self.remotepath or '/',
+                       'error': self.errors[0]})
+
+    def _queue(self, files):
+        range_size = max(CONF.pull_range_size, 1)
+        jobs = []
+        for entry in sorted(files, key=lambda e: e.size):
+            local = self._local(entry)
+            if entry.size <= range_size:
+                jobs.append((entry, 0, entry.size))
+                continue
+            # sized first, so that ranges can be written in any order
+            with open(local, 'wb') as f:
+                f.truncate(entry.size)
+            ranges = [(entry, offset, min(range_size, entry.size - offset))
+                      for offset in range(0, entry.size, range_size)]
+            self._left[entry.path] = len(ranges)
+            # popped from the end, the first range first
+            jobs.extend(reversed(ranges))
+        self._jobs = jobs
+
+    def _next(self):
+        with self._lock:
+            if self._jobs:
+                return self._jobs.pop()
+            return None
+
+    def _work(self):
+        conn = None
+        try:
+            while True:
+                job = self._next()
+                if job is None:
+                    return
+                entry, offset, length = job
+                try:
+                    if conn is None:
+                        conn = self._client()
+                    self._pull(conn, entry, offset, length)
+                except Exception as e:
+                    self._fail("%s: %s" % (entry.path, e))
+                    if conn is not None:
+                        # a reply may be left half read
+                        conn.close()
+                        conn = None
+                    continue
+                self._done(entry, length)
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def _pull(self, conn, entry, offset, length):
+        local = self._local(entry)
+        whole = entry.path not in self._left
+        flags = os.O_WRONLY
+        if whole:
+            flags |= os.O_CREAT | os.O_TRUNC
+        fd = os.open(local, flags, 0o600)
+        try:
+            if offset:
+                os.lseek(fd, offset, os.SEEK_SET)
+            received = conn.get(entry.path, offset, length,
+                                stream.fd_writer(fd), limiter=self.limiter)
+        finally:
+            os.close(fd)
+        if received != length:
+            raise IOError("changed on the source, %d bytes of %d" %
+                          (received, length))
+
+    def _done(self, entry, length):
+        with self._lock:
+            self.bytes += length
+            left = self._left.get(entry.path)
+            if left is not None:
+                left -= 1
+                self._left[entry.path] = left
+                if left:
+                    return
+            self.files += 1
+        _set_attributes(self._local(entry), entry)
+
+    def _fail(self, error):
+        LOG.error("Pull tree error: %s", error)
+        with self._lock:
+            self.errors.append(error)
+
+
+def _set_attributes(path, entry):
+    try:
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            os.chown(path, entry.uid, entry.gid)
+        os.chmod(path, entry.mode)
+        os.utime(path, (entry.mtime, entry.mtime))
+    except OSError as e:
+        LOG.warning("Set attributes of %(path)s error: %(error)s",
+                    {'path': path, 'error': e})
@@ -0,0 +1,384 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""File server the source agent runs for destinations pulling a tree.
+
+A server is started on demand for the mount point of a migration and
+serves the files under it, and only those, to any number of readers at
+once, each connection on a thread of its own. Clients keep a connection
+open and send one request line after another:
+
+    <token> WALK <path>
+    <token> GET <offset> <length> <path>
+
+paths being quoted and relative to the root, a length of -1 reading to the
+end of the file. A reply starts with a line 'OK <n>' or 'ERR <message>'.
+WALK sends records 'type size mtime mode uid gid path' each ended by a NUL
+byte, type being 'd' or 'f', and an empty record last. GET sends the n
+bytes asked for, with sendfile where the platform has it, straight from the
+page cache of the volume.
+
+A server stops when asked to or once no client used it for a while.
+"""
+
+import binascii
+import errno
+import hmac
+import os
+import select
+import socket
+import stat
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+import six
+from six.moves import socketserver
+from six.moves.urllib import parse
+
+try:
+    from os import sendfile as _sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile as _sendfile
+    except ImportError:
+        # python 2 without the pysendfile package
+        _sendfile = None
+
+pull_server_opts = [
+    cfg.StrOpt('pull_server_host',
+               default='0.0.0.0',
+               help='Address the file servers of pull transfers listen on'),
+    cfg.IntOpt('pull_server_port',
+               default=0,
+               help='Port of the file server of a pull transfer, 0 for any '
+                    'free port'),
+    cfg.IntOpt('pull_server_idle_timeout',
+               default=600,
+               help='Seconds a file server of pull transfers without '
+                    'clients waits before it stops'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(pull_server_opts)
+
+LOG = logging.getLogger(__name__)
+
+DIR = 'd'
+FILE = 'f'
+
+END = b'\0'
+_MAX_LINE = 64 * 1024
+_BUFSIZE = 1024 * 1024
+# bytes sendfile is asked for at once
+_SENDFILE_CHUNK = 64 * 1024 * 1024
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def encode(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8', 'surrogateescape')
+
+
+def quote(path):
+    if six.PY2:
+        return parse.quote(path, safe='/')
+    return parse.quote(path, safe='/', errors='surrogateescape')
+
+
+def unquote(text):
+    if six.PY2:
+        return parse.unquote(text)
+    return parse.unquote(text, errors='surrogateescape')
+
+
+def _send_range(sock, f, offset, length):
+    """Send length bytes of f from offset, returns the bytes sent.
+
+    Less than length is sent if the file got shorter.
+    """
+    sent = 0
+    if _sendfile is not None:
+        out_fd = sock.fileno()
+        in_fd = f.fileno()
+        while sent < length:
+            try:
+                n = _sendfile(out_fd, in_fd, offset + sent,
+                              min(length - sent, _SENDFILE_CHUNK))
+            except (OSError, IOError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.EAGAIN:
+                    raise
+                # the socket has a timeout, so it does not block
+                if not select.select([], [out_fd], [],
+                                     sock.gettimeout())[1]:
+                    raise socket.timeout("send timed out")
+                continue
+            if not n:
+                break
+            sent += n
+        return sent
+
+    f.seek(offset)
+    while sent < length:
+        data = f.read(min(length - sent, _BUFSIZE))
+        if not data:
+            break
+        sock.sendall(data)
+        sent += len(data)
+    return sent
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.request.settimeout(CONF.pull_server_idle_timeout)
+        self.file_server = self.server.file_server
+
+    def handle(self):
+        self.file_server.enter()
+        try:
+            while True:
+                line = self.rfile.readline(_MAX_LINE)
+                if not line:
+                    return
+                self.file_server.touch()
+                line = line.rstrip(b'\r\n')
+                if not six.PY2:
+                    line = line.decode('utf-8', 'surrogateescape')
+                if not self._request(line):
+                    return
+        except (socket.error, IOError, OSError) as e:
+            LOG.debug("Pull client %(client)s left: %(error)s",
+                      {'client': self.client_address, 'error': e})
+        finally:
+            self.file_server.leave()
+
+    def _reply(self, line):
+        self.wfile.write(encode(line.replace('\n', ' ')) + b'\n')
+
+    def _request(self, line):
+        """Serve a request, False when the connection has to be closed."""
+        parts = line.split(' ')
+        if len(parts) < 3 or not self.file_server.check_token(parts[0]):
+            self._reply('ERR denied')
+            return False
+        verb = parts[1]
+        if verb == 'WALK' and len(parts) == 3:
+            method, args = self._walk, (parts[2],)
+        elif verb == 'GET' and len(parts) == 5:
+            method, args = self._get, (parts[4], parts[2], parts[3])
+        else:
+            self._reply('ERR bad request')
+            return False
+        try:
+            send = method(*args)
+        except (ValueError, IOError, OSError) as e:
+            self._reply('ERR %s' % e)
+            return True
+        # errors past the reply line leave the client a cut reply
+        return send()
+
+    def _walk(self, path):
+        top = self.file_server.resolve(unquote(path))
+        if not os.path.isdir(top):
+            raise IOError(errno.ENOTDIR, "not a directory")
+
+        def send():
+            self._reply('OK 0')
+            out = []
+            size = 0
+            for record in self._records(top):
+                out.append(record)
+                size += len(record)
+                if size >= _BUFSIZE:
+                    self.wfile.write(b''.join(out))
+                    out = []
+                    size = 0
+            out.append(END)
+            self.wfile.write(b''.join(out))
+            return True
+        return send
+
+    def _records(self, top):
+        root = self.file_server.root
+        for dirpath, dirnames, filenames in os.walk(top):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                rel = os.path.relpath(path, root)
+                try:
+                    st = os.lstat(path)
+                    if stat.S_ISLNK(st.st_mode):
+                        # links to files under root are served as the file,
+                        # links to directories are not followed
+                        self.file_server.resolve(rel)
+                        st = os.stat(path)
+                        if not stat.S_ISREG(st.st_mode):
+                            continue
+                except (OSError, ValueError):
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    kind = DIR
+                elif stat.S_ISREG(st.st_mode):
+                    kind = FILE
+                else:
+                    continue
+                yield encode('%s %d %d %d %d %d ' % (
+                    kind, st.st_size if kind == FILE else 0,
+                    int(st.st_mtime), stat.S_IMODE(st.st_mode), st.st_uid,
+                    st.st_gid)) + encode(rel) + END
+
+    def _get(self, path, offset, length):
+        path = self.file_server.resolve(unquote(path))
+        offset = int(offset)
+        length = int(length)
+        f = open(path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                raise IOError(errno.EISDIR, "not a file")
+            if offset < 0 or offset > st.st_size:
+                raise ValueError("offset %d out of the file" % offset)
+        except Exception:
+            f.close()
+            raise
+        available = st.st_size - offset
+        length = available if length < 0 else min(length, available)
+
+        def send():
+            try:
+                self._reply('OK %d' % length)
+                sent = _send_range(self.request, f, offset, length)
+            finally:
+                f.close()
+            self.file_server.add_sent(sent)
+            if sent < length:
+                # the file got shorter, the client sees the connection end
+                LOG.warning("Pull file %(path)s ended %(missing)s bytes "
+                            "early", {'path': path, 'missing': length - sent})
+                return False
+            return True
+        return send
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 64
+
+
+class FileServer(object):
+    """Serves the files under root to the clients knowing token."""
+
+    def __init__(self, root, host=None, port=None):
+        self.root = os.path.realpath(root)
+        self.host = CONF.pull_server_host if host is None else host
+        self.port = CONF.pull_server_port if port is None else port
+        self.token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.sent = 0
+        self._clients = 0
+        self._last_used = time.time()
+        self._lock = threading.Lock()
+        self._server = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Listen and serve in threads, returns the port."""
+        self._server = _TCPServer((self.host, self.port), _Handler)
+        self._server.file_server = self
+        self.port = self._server.server_address[1]
+        for target, name in ((self._server.serve_forever, 'serve'),
+                             (self._watch, 'watch')):
+            thread = threading.Thread(target=target,
+                                      name='pull-%s-%d' % (name, self.port))
+            thread.daemon = True
+            thread.start()
+        LOG.info("Pull file server of %(root)s listening on %(port)s",
+                 {'root': self.root, 'port': self.port})
+        return self.port
+
+    def stop(self):
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._server.shutdown()
+        self._server.server_close()
+        with _servers_lock:
+            if _servers.get(self.port) is self:
+                del _servers[self.port]
+        LOG.info("Pull file server of %(root)s on %(port)s stopped, "
+                 "%(sent)s bytes sent",
+                 {'root': self.root, 'port': self.port, 'sent': self.sent})
+
+    def check_token(self, token):
+        return hmac.compare_digest(encode(token), encode(self.token))
+
+    def resolve(self, rel):
+        """Local path of rel, which has to be under root."""
+        path = os.path.realpath(os.path.join(self.root, rel.lstrip('/')))
+        if path != self.root and not path.startswith(self.root + os.sep):
+            raise ValueError("%s out of the served tree" % rel)
+        return path
+
+    def touch(self):
+        self._last_used = time.time()
+
+    def enter(self):
+        with self._lock:
+            self._clients += 1
+        self.touch()
+
+    def leave(self):
+        with self._lock:
+            self._clients -= 1
+        self.touch()
+
+    def add_sent(self, nbytes):
+        with self._lock:
+            self.sent += nbytes
+
+    def _watch(self):
+        timeout = CONF.pull_server_idle_timeout
+        if timeout <= 0:
+            return
+        while not self._stopped.wait(min(timeout, 10)):
+            if (not self._clients and
+                    time.time() - self._last_used > timeout):
+                LOG.info("Pull file server on %s idle", self.port)
+                self.stop()
+                return
+
+
+def start(root, host=None, port=None):
+    """Start a FileServer for root, returns it."""
+    server = FileServer(root, host=host, port=port)
+    server.start()
+    with _servers_lock:
+        _servers[server.port] = server
+    return server
+
+
+def stop(port):
+    """Stop the server on port, False if there is none."""
+    with _servers_lock:
+        server = _servers.get(port)
+    if server is None:
+        return False
+    server.stop()
+    return True
@@ -14,12 +14,16 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from webob import exc
+
 from oslo_log import log as logging
 
 from conveyoragent import context
 from conveyoragent.engine.api import extensions
 from conveyoragent.engine.api.wsgi import wsgi
 from conveyoragent.engine.server import manager
+from conveyoragent import exception
+from conveyoragent.i18n import _
 
 LOG = logging.getLogger(__name__)
 
@@ -149,27 +153,158 @@ class MigrationActionController(wsgi.Controller):
         src_disk = data_body.get('src_disk')
         des_disk = data_body.get('des_disk')
         protocol = data_body.get('protocol')
+        options = data_body.get('options')
 
-        self.migration_manager.start_transformer_data(trans_ip,
-                                                      trans_port,
-                                                      src_disk,
-                                                      des_disk,
-                                                      protocol=protocol)
-        resp = {"code": "200"}
+        callback = self.migration_manager.start_transformer_data(
+            trans_ip, trans_port, src_disk, des_disk, protocol=protocol,
+            options=options)
+        # the end of the transfer is pushed to the destination
+        resp = {"code": "200", "callback": callback}
         LOG.debug("End send data to clone vm")
         return resp
 
+    @wsgi.action('getTransformerTree')
+    def _get_transformer_tree(self, req, id, body):
+        LOG.debug("Start query transformer data tree")
+        data_body = body['getTransformerTree']
+        try:
+            resp = self.migration_manager.get_transformer_tree(
+                data_body.get('trans_ip'),
+                data_body.get('trans_port'),
+                data_body.get('protocol'),
+                level=data_body.get('level'),
+                indexes=data_body.get('indexes'),
+                release=data_body.get('release', False))
+        except Exception as e:
+            LOG.error("Query transformer data tree error: %s", e)
+            msg = _("query transformer data tree failed")
+            raise exc.HTTPBadRequest(explanation=msg)
+        LOG.debug("End query transformer data tree")
+        return resp
+
+    @wsgi.action('resumeCloneVolume')
+    def _resume_clone_volume(self, req, id, body):
+        LOG.debug("Resume clone volume task start: %s", id)
+        try:
+            task_id = self.migration_manager.resume_clone_volume(id)
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        except exception.TransferQueueFull as e:
+            raise exc.HTTPTooManyRequests(explanation=e.msg)
+        except Exception as e:
+            LOG.error("Resume clone volume task %(task_id)s error: "
+                      "%(error)s", {'task_id': id, 'error': e})
+            msg = _("resume clone volume failed")
+            raise exc.HTTPBadRequest(explanation=msg)
+        resp = {"task_id": task_id}
+        LOG.debug("Resume clone volume task end: %s", id)
+        return resp
+
+    @wsgi.action('setBandwidthLimit')
+    def _set_bandwidth_limit(self, req, id, body):
+        LOG.debug("Set bandwidth limit start")
+        data_body = body['setBandwidthLimit']
+        task_id = data_body.get('task_id')
+        try:
+            limit = self.migration_manager.set_bandwidth_limit(
+                data_body.get('limit'), task_id=task_id)
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        except Exception as e:
+            LOG.error("Set bandwidth limit error: %s", e)
+            msg = _("set bandwidth limit failed")
+            raise exc.HTTPBadRequest(explanation=msg)
+        resp = {'task_id': task_id, 'limit': limit}
+        LOG.debug("Set bandwidth limit end: %s", resp)
+        return resp
+
+    @wsgi.action('sendBundle')
+    def _send_bundle(self, req, id, body):
+        LOG.debug("Send bundle start")
+        data_body = body['sendBundle']
+        try:
+            self.migration_manager.send_bundle(
+                data_body.get('trans_ip'),
+                data_body.get('trans_port'),
+                data_body.get('path'),
+                data_body.get('token'),
+                max_size=data_body.get('max_size'))
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        resp = {"code": "200"}
+        LOG.debug("Send bundle end")
+        return resp
+
+    @wsgi.action('startFileServer')
+    def _start_file_server(self, req, id, body):
+        LOG.debug("Start file server start")
+        data_body = body['startFileServer']
+        try:
+            resp = self.migration_manager.start_file_server(
+                data_body.get('path'))
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        LOG.debug("Start file server end: port %s", resp['port'])
+        return resp
+
+    @wsgi.action('stopFileServer')
+    def _stop_file_server(self, req, id, body):
+        LOG.debug("Stop file server start")
+        data_body = body['stopFileServer']
+        try:
+            self.migration_manager.stop_file_server(data_body.get('port'))
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        resp = {"code": "200"}
+        LOG.debug("Stop file server end")
+        return resp
+
+    @wsgi.action('transferDone')
+    def _transfer_done(self, req, id, body):
+        LOG.debug("Transfer done start")
+        data_body = body['transferDone']
+        try:
+            self.migration_manager.transfer_done(
+                data_body.get('callback_id'),
+                data_body.get('status'),
+                error=data_body.get('error'))
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        resp = {"code": "200"}
+        LOG.debug("Transfer done end")
+        return resp
+
+    @wsgi.action('getTransferStats')
+    def _get_transfer_stats(self, req, id, body):
+        LOG.debug("Query transfer stats start")
+        resp = {'stats': self.migration_manager.get_transfer_stats()}
+        LOG.debug("Query transfer stats end: %s", resp)
+        return resp
+
+    @wsgi.action('getFtpStats')
+    def _get_ftp_stats(self, req, id, body):
+        LOG.debug("Query ftp stats start")
+        resp = {'stats': self.migration_manager.get_ftp_stats()}
+        LOG.debug("Query ftp stats end: %s", resp)
+        return resp
+
     @wsgi.action("fillpTransFormerStatus")
     def _fillp_trans_status(self, req, id, body):
         LOG.debug("Start query transformer data status")
         data_body = body['fillpTransFormerStatus']
         protocol = data_body.get('protocol')
+        port = data_body.get('port')
         try:
             out = self.migration_manager.fillp_transformer_data_status(
-                protocol)
+                protocol, port=port)
         except Exception:
             out = -1
         resp = {"status": out}
+        try:
+            resp['process'] = self.migration_manager.fillp_transformer_process(
+                protocol, port=port)
+        except Exception as e:
+            LOG.warning("Query transformer process error: %s", e)
         LOG.debug("End query transformer data status: %s", out)
         return resp
 
@@ -39,5 +39,5 @@ class APIRouter(wsgi.APIRouter):
             v2vgatewayservices.create_resource(ext_mgr)
         mapper.resource("v2vGateWayService", "v2vGateWayServices",
                         controller=self.resources['v2vGateWayServices'],
-                        collection={'detail': 'GET'},
+                        collection={'detail': 'GET', 'events': 'GET'},
                         member={'action': 'POST'})
@@ -15,15 +15,22 @@
 
 """The conveyoragent api."""
 
+import webob
 from webob import exc
 
+from oslo_config import cfg
 from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import encodeutils
 
 from conveyoragent.engine.api.view import v2vgatewayservices as services_view
 from conveyoragent.engine.api.wsgi import wsgi
 from conveyoragent.engine.server import manager
+from conveyoragent import exception
 from conveyoragent.i18n import _
 
+CONF = cfg.CONF
+
 LOG = logging.getLogger(__name__)
 
 
@@ -35,15 +42,34 @@ class V2vGateWayServiceController(wsgi.Controller):
         self.viewBulid = services_view.ViewBuilder()
         self.migration_manager = manager.MigrationManager()
         super(V2vGateWayServiceController, self).__init__()
+        if CONF.resume_tasks_on_start:
+            self.migration_manager.resume_clone_volumes()
 
     def show(self, req, id):
-        """Return data about the given resource."""
+        """Return data about the given resource.
+
+        With wait=<seconds>, a task is returned once it changed past its
+        version since=<version>, or the one it has, or once wait ran out.
+        """
         LOG.debug("Query task state start: %s", id)
 
+        job = self.migration_manager.get_clone_job(id)
+        if job is not None:
+            LOG.debug("Query clone job end: %s", id)
+            return self.viewBulid.show_job(job)
+        wait = req.GET.get('wait')
+        if wait is not None:
+            try:
+                self.migration_manager.wait_task(id, wait,
+                                                 since=req.GET.get('since'))
+            except exception.InvalidInput as e:
+                raise exc.HTTPBadRequest(explanation=e.msg)
         try:
             state = self.migration_manager.query_data_transformer_state(id)
+            details = self.migration_manager.query_data_transformer_details(
+                id)
             LOG.debug("Query task state end: %s", id)
-            return self.viewBulid.show(state)
+            return self.viewBulid.show(state, details)
         except Exception as e:
             LOG.error("Query task %(task_id)s state error: %(error)s",
                       {'task_id': id, 'error': e})
@@ -64,9 +90,37 @@ class V2vGateWayServiceController(wsgi.Controller):
         LOG.debug("detail test!")
         return
 
+    def events(self, req):
+        """Stream the changes of tasks, one JSON object a line.
+
+        tasks=<id>,<id> limits the stream to these tasks, which ends once
+        they all ended, since=<version> skips what did not change past it
+        and timeout=<seconds> ends the stream. An empty line is sent while
+        nothing changes.
+        """
+        task_ids = [task_id for task_id in
+                    req.GET.get('tasks', '').split(',') if task_id]
+        try:
+            events = self.migration_manager.task_events(
+                task_ids or None, since=req.GET.get('since'),
+                timeout=req.GET.get('timeout'))
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+
+        def lines():
+            for event in events:
+                line = '' if event is None else jsonutils.dumps(event)
+                yield encodeutils.safe_encode(line + '\n')
+
+        LOG.debug("Stream task events: %s", task_ids or 'all')
+        return webob.Response(content_type='application/x-ndjson',
+                              app_iter=lines())
+
     def create(self, req, body):
         """DownLoad data from source volume"""
 
+        if self.is_valid_body(body, 'clone_volumes'):
+            return self._clone_volumes(body['clone_volumes'])
         if not self.is_valid_body(body, 'clone_volume'):
             LOG.debug("V2v gateway download data request not key:clone_volume")
             raise exc.HTTPUnprocessableEntity()
@@ -77,11 +131,29 @@ class V2vGateWayServiceController(wsgi.Controller):
 
             return self.viewBulid.create(state)
 
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        except exception.TransferQueueFull as e:
+            raise exc.HTTPTooManyRequests(explanation=e.msg)
         except Exception as e:
             LOG.error("Clone volume data error: %s", e)
             msg = _("clone volume data failed")
             raise exc.HTTPBadRequest(explanation=msg)
 
+    def _clone_volumes(self, batch):
+        LOG.debug("Clone volumes start: %s", batch)
+        try:
+            job_id, task_ids = self.migration_manager.clone_volumes(
+                batch.get('volumes'), policy=batch.get('policy'))
+        except exception.InvalidInput as e:
+            raise exc.HTTPBadRequest(explanation=e.msg)
+        except Exception as e:
+            LOG.error("Clone volumes error: %s", e)
+            msg = _("clone volumes failed")
+            raise exc.HTTPBadRequest(explanation=msg)
+        LOG.debug("Clone volumes end: job %s", job_id)
+        return self.viewBulid.create_job(job_id, task_ids)
+
     def update(self, req, id, body):
         """Update a resource."""
 
@@ -25,10 +25,20 @@ class ViewBuilder(ViewBuilder):
     def list(self, results):
         pass
 
-    def show(self, result):
+    def show(self, result, details=None):
         rsp = {'body': {'task_state': result}}
+        if details:
+            rsp['body'].update(details)
         return rsp
 
     def create(self, result):
         rsp = {'body': {'task_id': result}}
         return rsp
+
+    def create_job(self, job_id, task_ids):
+        rsp = {'body': {'job_id': job_id, 'task_ids': task_ids}}
+        return rsp
+
+    def show_job(self, job):
+        rsp = {'body': job}
+        return rsp
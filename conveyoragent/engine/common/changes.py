@@ -0,0 +1,118 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Changes of tasks, for green threads to wait on.
+
+Tasks change in the threads of their transfers, while the requests waiting
+for them are green threads of the hub of the api. A change bumps a version
+and wakes every hub with waiters through a pipe, a green thread of the hub
+then wakes all of its waiters at once: a waiting request only costs its
+place among the waiters of one event.
+"""
+
+import errno
+import fcntl
+import os
+import threading
+import time
+
+import eventlet
+from eventlet import event
+from eventlet import hubs
+
+_lock = threading.Lock()
+_version = 0
+# hub: _Hub of the green threads waiting in it
+_hubs = {}
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class _Hub(object):
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        _set_nonblocking(self.read_fd)
+        _set_nonblocking(self.write_fd)
+        self.event = event.Event()
+        eventlet.spawn(self._run)
+
+    def wake(self):
+        try:
+            os.write(self.write_fd, b'x')
+        except OSError as e:
+            # the pipe is full, the hub wakes up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _run(self):
+        while True:
+            hubs.trampoline(self.read_fd, read=True)
+            try:
+                while os.read(self.read_fd, 4096):
+                    pass
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+            woken, self.event = self.event, event.Event()
+            woken.send()
+
+
+def _hub():
+    hub = hubs.get_hub()
+    with _lock:
+        waiters = _hubs.get(hub)
+        if waiters is None:
+            waiters = _hubs[hub] = _Hub()
+    return waiters
+
+
+def version():
+    """Version of the last change."""
+    return _version
+
+
+def changed(task=None):
+    """Count a change of task, which takes the new version, and wake the
+    waiters. Returns the version.
+    """
+    global _version
+    with _lock:
+        _version += 1
+        if task is not None:
+            task.version = _version
+        current = _version
+        waiting = list(_hubs.values())
+    for hub in waiting:
+        hub.wake()
+    return current
+
+
+def wait(since, timeout):
+    """Wait timeout seconds at most for a change past version since.
+
+    Returns the version then. Only the green thread calling it waits, the
+    other green threads of its thread keep running.
+    """
+    deadline = time.time() + timeout
+    hub = _hub()
+    while _version <= since:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        # no switch since the check: a change past it sends this event
+        with eventlet.Timeout(remaining, False):
+            hub.event.wait()
+    return _version
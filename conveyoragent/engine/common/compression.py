@@ -0,0 +1,188 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Adaptive inline compression of transferred data.
+
+Every chunk is first sampled at the cheapest level. Chunks that barely
+compress are sent as they are; for the others the level is picked so that
+compression time plus the time to send the result over the measured link
+is the lowest.
+"""
+
+import threading
+import time
+import zlib
+
+from oslo_config import cfg
+
+try:
+    import lzma
+except ImportError:
+    # python 2 ships zlib only
+    lzma = None
+
+compression_opts = [
+    cfg.IntOpt('compression_sample_size',
+               default=64 * 1024,
+               help='Bytes of each chunk compressed at the lowest level to '
+                    'estimate how well the chunk compresses'),
+    cfg.FloatOpt('compression_min_saving',
+                 default=0.1,
+                 help='Fraction of its size a chunk must shrink by to be '
+                      'sent compressed'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(compression_opts)
+
+ALGORITHMS = (NONE, ZLIB, LZMA) = ('none', 'zlib', 'lzma')
+
+# codec ids used on the wire
+CODECS = {ZLIB: 1, LZMA: 2}
+
+# levels tried for each algorithm, with a first guess of their speed in
+# bytes per second until it has been measured
+_LEVELS = {
+    ZLIB: [(1, 80e6), (3, 50e6), (6, 25e6), (9, 8e6)],
+    LZMA: [(0, 15e6), (1, 8e6), (3, 3e6), (6, 1.5e6)],
+}
+
+# weight of the newest sample in moving averages
+_SMOOTHING = 0.2
+
+
+def supported_algorithms():
+    if lzma is None:
+        return (NONE, ZLIB)
+    return ALGORITHMS
+
+
+def _compress(algorithm, data, level):
+    if algorithm == ZLIB:
+        return zlib.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+
+def decompress(codec, payload):
+    if codec == CODECS[ZLIB]:
+        return zlib.decompress(payload)
+    if codec == CODECS[LZMA] and lzma is not None:
+        return lzma.decompress(payload)
+    raise ValueError("Unsupported compression codec %s" % codec)
+
+
+def _average(old, new):
+    if old is None:
+        return new
+    return old + _SMOOTHING * (new - old)
+
+
+class CompressionStats(object):
+    """Thread safe totals of one task, reported with its status."""
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, raw_bytes=0, wire_bytes=0, compress_time=0.0,
+            decompress_time=0.0):
+        with self._lock:
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.compress_time += compress_time
+            self.decompress_time += decompress_time
+
+    def to_dict(self):
+        with self._lock:
+            ratio = None
+            if self.raw_bytes:
+                ratio = round(float(self.wire_bytes) / self.raw_bytes, 4)
+            return {'algorithm': self.algorithm,
+                    'raw_bytes': self.raw_bytes,
+                    'wire_bytes': self.wire_bytes,
+                    'ratio': ratio,
+                    'compress_cpu_time': round(self.compress_time, 3),
+                    'decompress_cpu_time': round(self.decompress_time, 3)}
+
+
+class AdaptiveCompressor(object):
+    """Compresses the chunks of one stream. Not thread safe."""
+
+    def __init__(self, algorithm, stats=None):
+        if algorithm not in CODECS:
+            raise ValueError("Unsupported compression %s" % algorithm)
+        self.algorithm = algorithm
+        self.codec = CODECS[algorithm]
+        self.stats = stats or CompressionStats(algorithm)
+        self.link_rate = None
+        self.ratio = None
+        self._levels = [level for level, _speed in _LEVELS[algorithm]]
+        self._speed = dict(_LEVELS[algorithm])
+        # how much better than the sample level each level does
+        self._gain = dict((level, 1.0) for level in self._levels)
+
+    def record_send(self, nbytes, seconds):
+        """Feed the time the link took to take nbytes."""
+        if seconds > 0.001:
+            self.link_rate = _average(self.link_rate, nbytes / seconds)
+
+    def choose_level(self, ratio=None):
+        """Level giving the fastest delivery, None when sending raw is."""
+        if ratio is None:
+            ratio = self.ratio if self.ratio is not None else 0.5
+        if not self.link_rate:
+            return self._levels[0]
+
+        best = None
+        best_cost = 1.0 / self.link_rate
+        for level in self._levels:
+            expected = min(ratio * self._gain[level], 1.0)
+            cost = 1.0 / self._speed[level] + expected / self.link_rate
+            if cost < best_cost:
+                best, best_cost = level, cost
+        return best
+
+    def compress(self, data):
+        """Return the compressed payload, or None to send data raw."""
+        if not len(data):
+            return None
+        data = data.tobytes() if isinstance(data, memoryview) else data
+        start = time.time()
+        try:
+            sample = data[:CONF.compression_sample_size]
+            sample_ratio = (len(zlib.compress(sample, 1)) /
+                            float(len(sample)))
+            if sample_ratio > 1 - CONF.compression_min_saving:
+                return None
+
+            level = self.choose_level(sample_ratio)
+            if level is None:
+                return None
+
+            level_start = time.time()
+            payload = _compress(self.algorithm, data, level)
+            elapsed = max(time.time() - level_start, 1e-6)
+            ratio = len(payload) / float(len(data))
+            self._speed[level] = _average(self._speed[level],
+                                          len(data) / elapsed)
+            self._gain[level] = _average(self._gain[level],
+                                         ratio / sample_ratio)
+            self.ratio = _average(self.ratio, ratio)
+            if ratio > 1 - CONF.compression_min_saving:
+                return None
+            return payload
+        finally:
+            self.stats.add(compress_time=time.time() - start)
@@ -0,0 +1,174 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Workers the transfers of the agent run on.
+
+A fixed number of worker threads take the transfers from a bounded queue,
+the ones of a higher priority first: the transfers of a cutover, which
+someone waits on, before the others and these before the pre-copies of
+bulk data. A transfer submitted while the queue is full is refused rather
+than queued without end.
+"""
+
+import itertools
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from six.moves import queue
+
+from conveyoragent import exception
+
+PRIORITIES = (CUTOVER, NORMAL, PRECOPY) = ('cutover', 'normal', 'precopy')
+
+executor_opts = [
+    cfg.IntOpt('transfer_workers',
+               default=16,
+               help='Transfers running at once on the agent'),
+    cfg.IntOpt('transfer_queue_size',
+               default=256,
+               help='Transfers waiting for a worker at most, more are '
+                    'refused'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(executor_opts)
+
+LOG = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class Work(object):
+    """A transfer submitted, to be joined like a thread."""
+
+    def __init__(self, fn, args, priority, name):
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.name = name
+        self.submitted = time.time()
+        # what fn raised, None unless it failed
+        self.error = None
+        self._done = threading.Event()
+
+    def join(self, timeout=None):
+        self._done.wait(timeout)
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+
+class Executor(object):
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = max(CONF.transfer_workers if workers is None
+                           else workers, 1)
+        self.queue_size = max(CONF.transfer_queue_size if queue_size is None
+                              else queue_size, 1)
+        self._queue = queue.PriorityQueue(self.queue_size)
+        self._seq = itertools.count()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = 0
+        self._counters = dict.fromkeys(
+            ('submitted', 'rejected', 'finished', 'failed'), 0)
+        self._times = dict.fromkeys(
+            ('wait_seconds', 'wait_seconds_max', 'run_seconds',
+             'run_seconds_max'), 0.0)
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args), returns its Work.
+
+        Takes priority and name as keywords. Raises TransferQueueFull when
+        the queue is.
+        """
+        priority = kwargs.pop('priority', None) or NORMAL
+        name = kwargs.pop('name', None) or getattr(fn, '__name__', 'work')
+        if priority not in PRIORITIES:
+            msg = "Input priority error: %s" % priority
+            raise exception.InvalidInput(reason=msg)
+        self._start_workers()
+        work = Work(fn, args, priority, name)
+        try:
+            self._queue.put_nowait((PRIORITIES.index(priority),
+                                    next(self._seq), work))
+        except queue.Full:
+            with self._lock:
+                self._counters['rejected'] += 1
+            LOG.warning("Transfer queue full, %s refused", name)
+            raise exception.TransferQueueFull(size=self.queue_size)
+        with self._lock:
+            self._counters['submitted'] += 1
+        return work
+
+    def stats(self):
+        """Queue depth, workers busy and the times transfers waited and
+        ran, in seconds.
+        """
+        with self._lock:
+            stats = dict(self._counters, **self._times)
+            stats.update(workers=self.workers, running=self._running,
+                         queued=self._queue.qsize(),
+                         queue_size=self.queue_size)
+        return stats
+
+    def _start_workers(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work,
+                                          name='transfer-%d' % index)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            _rank, _seq, work = self._queue.get()
+            self._run(work)
+
+    def _run(self, work):
+        started = time.time()
+        waited = started - work.submitted
+        with self._lock:
+            self._running += 1
+            self._add_time('wait_seconds', waited)
+        try:
+            work.fn(*work.args)
+        except Exception as e:
+            work.error = e
+            LOG.exception("Transfer %(name)s error: %(error)s",
+                          {'name': work.name, 'error': e})
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._counters['failed' if work.error else 'finished'] += 1
+                self._add_time('run_seconds', time.time() - started)
+            work._done.set()
+
+    def _add_time(self, name, seconds):
+        self._times[name] += seconds
+        self._times[name + '_max'] = max(self._times[name + '_max'],
+                                         seconds)
+
+
+def get_executor():
+    """The executor of the agent."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = Executor()
+        return _executor
@@ -0,0 +1,202 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Ends of transfers, pushed rather than polled for.
+
+The destination agent asks the source to tell it when the data it sends
+is all sent: it expects a callback id, passes it along with its own url,
+and waits for the source to push the status back on it. It still asks the
+source now and then, should the push be lost.
+
+When a clone gives a callback_url, the destination posts the state of its
+task there once the task ends.
+"""
+
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+from oslo_utils import uuidutils
+import requests
+
+from conveyoragent.conveyoragentclient.v1 import client as agentclient
+
+notify_opts = [
+    cfg.BoolOpt('trans_callback',
+                default=True,
+                help='Have the source agent push the end of a transfer '
+                     'rather than be polled for it'),
+    cfg.IntOpt('trans_callback_poll_interval',
+               default=60,
+               help='Seconds between the polls of the source a transfer '
+                    'whose end is pushed still makes, in case the push '
+                    'is lost'),
+    cfg.IntOpt('trans_callback_retries',
+               default=3,
+               help='Times the push of the end of a transfer, or of a '
+                    'task to the webhook of its clone, is tried again'),
+    cfg.IntOpt('webhook_timeout',
+               default=10,
+               help='Seconds to wait for the webhook of a clone to answer'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(notify_opts)
+
+LOG = logging.getLogger(__name__)
+
+# as the status of a transfer the source agent reports
+RUNNING = 0
+FINISHED = 1
+FAILED = -1
+
+# seconds between two tries of a push
+_RETRY_INTERVAL = 5
+# looks of the source at a process left running after its sender ended
+_SETTLE_CHECKS = 60
+
+_waiters = {}
+_waiters_lock = threading.Lock()
+
+
+class _Waiter(object):
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.status = None
+        self.error = None
+
+
+def expect():
+    """A new callback id for the end of a transfer to be pushed on."""
+    callback_id = uuidutils.generate_uuid()
+    with _waiters_lock:
+        _waiters[callback_id] = _Waiter()
+    return callback_id
+
+
+def deliver(callback_id, status, error=None):
+    """Wake up the wait on callback_id, False if nobody waits on it."""
+    with _waiters_lock:
+        waiter = _waiters.get(callback_id)
+    if waiter is None:
+        return False
+    waiter.status = status
+    waiter.error = error
+    waiter.event.set()
+    return True
+
+
+def wait(callback_id, timeout):
+    """(status, error) pushed on callback_id, None if none came in
+    timeout seconds.
+    """
+    with _waiters_lock:
+        waiter = _waiters.get(callback_id)
+    if waiter is None or not waiter.event.wait(timeout):
+        return None
+    return waiter.status, waiter.error
+
+
+def forget(callback_id):
+    with _waiters_lock:
+        _waiters.pop(callback_id, None)
+
+
+def watch(sender, status_fn, agent_url, callback_id):
+    """Push the end of the transfer of thread sender to the agent on
+    agent_url, host:port.
+
+    status_fn, if any, is the status of the transfer on this agent, for
+    senders whose transfer may outlive them.
+    """
+    thread = threading.Thread(target=_watch,
+                              args=(sender, status_fn, agent_url,
+                                    callback_id),
+                              name='notify-%s' % callback_id)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _watch(sender, status_fn, agent_url, callback_id):
+    sender.join()
+    error = getattr(sender, 'error', None)
+    if error is not None:
+        status = FAILED
+    elif status_fn is None:
+        status = FINISHED
+    else:
+        for check in range(_SETTLE_CHECKS):
+            status = status_fn()
+            if status != RUNNING:
+                break
+            time.sleep(1)
+        else:
+            # the destination polls for it
+            LOG.warning("Transfer of callback %s still running, end not "
+                        "pushed", callback_id)
+            return
+        if status != FINISHED:
+            error = "transformer process error"
+    _push(agent_url, callback_id, status,
+          None if error is None else str(error))
+
+
+def _push(agent_url, callback_id, status, error):
+    host, _sep, port = agent_url.rpartition(':')
+    for attempt in range(max(CONF.trans_callback_retries, 0) + 1):
+        if attempt:
+            time.sleep(_RETRY_INTERVAL)
+        try:
+            cls = agentclient.get_birdiegateway_client(host, port)
+            cls.vservices.transfer_done(callback_id, status, error=error)
+            LOG.debug("End of transfer pushed to %(agent)s: %(status)s",
+                      {'agent': agent_url, 'status': status})
+            return True
+        except Exception as e:
+            LOG.warning("Push end of transfer to %(agent)s error: "
+                        "%(error)s", {'agent': agent_url, 'error': e})
+    return False
+
+
+def task_ended(task_id, task_state, url):
+    """Post the state of an ended task to the webhook url of its clone."""
+    if not url:
+        return None
+    thread = threading.Thread(target=_post_webhook,
+                              args=(url, {'task_id': task_id,
+                                          'task_state': task_state}),
+                              name='webhook-%s' % task_id)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _post_webhook(url, body):
+    data = jsonutils.dumps(body)
+    for attempt in range(max(CONF.trans_callback_retries, 0) + 1):
+        if attempt:
+            time.sleep(_RETRY_INTERVAL)
+        try:
+            resp = requests.post(url, data=data,
+                                 headers={'Content-Type':
+                                          'application/json'},
+                                 timeout=CONF.webhook_timeout)
+            resp.raise_for_status()
+            return True
+        except Exception as e:
+            LOG.warning("Post task %(task)s to %(url)s error: %(error)s",
+                        {'task': body['task_id'], 'url': url, 'error': e})
+    return False
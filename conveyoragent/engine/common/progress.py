@@ -0,0 +1,93 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Bytes a task moved, its rate and when it should be done.
+
+The data path adds what it moved chunk by chunk: a counter and, once a
+second, a sample of the rate. Everything else is worked out when the task
+is looked at.
+"""
+
+import threading
+import time
+
+# seconds between two samples of the rate
+_TICK = 1.0
+# weight of the last sample in the smoothed rate
+_SMOOTHING = 0.3
+
+
+class Progress(object):
+
+    def __init__(self, total=None):
+        self.total = total
+        self.done = 0
+        # of done, what an earlier run moved
+        self._base = 0
+        self.started = time.time()
+        # smoothed rate, bytes per second
+        self._rate = None
+        self._tick = self.started
+        self._tick_done = 0
+        self._lock = threading.Lock()
+
+    def set_total(self, total):
+        self.total = total
+
+    def start_at(self, done):
+        """Count done bytes moved by an earlier run, not in the rates."""
+        with self._lock:
+            self.done += done
+            self._tick_done += done
+            self._base += done
+
+    def add(self, amount):
+        now = time.time()
+        with self._lock:
+            self.done += amount
+            elapsed = now - self._tick
+            if elapsed < _TICK:
+                return
+            rate = (self.done - self._tick_done) / elapsed
+            if self._rate is None:
+                self._rate = rate
+            else:
+                self._rate += _SMOOTHING * (rate - self._rate)
+            self._tick = now
+            self._tick_done = self.done
+
+    def to_dict(self):
+        now = time.time()
+        with self._lock:
+            done = self.done
+            rate = self._rate
+            idle = now - self._tick
+            if idle >= 2 * _TICK:
+                # stalled since the last sample
+                rate = (done - self._tick_done) / idle
+        elapsed = now - self.started
+        moved = done - self._base
+        average = moved / elapsed if elapsed > 0 else 0.0
+        if rate is None:
+            rate = average
+        progress = {'bytes_done': done,
+                    'bytes_total': self.total,
+                    'rate': int(rate),
+                    'average_rate': int(average),
+                    'eta': None}
+        if self.total is not None:
+            left = max(self.total - done, 0)
+            if not left:
+                progress['eta'] = 0
+            elif rate > 0:
+                progress['eta'] = int(left / rate)
+        return progress
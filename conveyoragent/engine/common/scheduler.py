@@ -0,0 +1,242 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Batches of clones, started a few at a time.
+
+Every volume of a batch gets its task at once, queued, and the batch a job
+id. Queued clones start as the clones running allow it: at most so many on
+the agent, reading the same source device and coming from the same source
+agent. Jobs start in the order they came, and the volumes of a job by size,
+largest or smallest first, or in the order they were given. Once all of
+its volumes ended a job is only kept among the last ones finished.
+"""
+
+import collections
+import itertools
+import threading
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_utils import uuidutils
+
+from conveyoragent.engine.common import notify
+from conveyoragent.engine.common import task_status
+from conveyoragent.engine.common import transformer
+from conveyoragent.engine.common import transformer_state
+from conveyoragent import exception
+
+POLICIES = (LARGEST_FIRST, SHORTEST_FIRST, FIFO) = (
+    'largest_first', 'shortest_first', 'fifo')
+
+clone_scheduler_opts = [
+    cfg.IntOpt('clone_max_running',
+               default=4,
+               help='Clones of batches running at once on the agent'),
+    cfg.IntOpt('clone_max_per_device',
+               default=1,
+               help='Clones of batches reading the same source device at '
+                    'once'),
+    cfg.IntOpt('clone_max_per_peer',
+               default=2,
+               help='Clones of batches coming from the same source agent '
+                    'at once'),
+    cfg.StrOpt('clone_schedule_policy',
+               default=LARGEST_FIRST,
+               choices=POLICIES,
+               help='Order the volumes of a batch start in: largest_first '
+                    'starts the long transfers early, shortest_first '
+                    'finishes the most volumes early, fifo keeps the order '
+                    'of the request'),
+    cfg.IntOpt('clone_finished_jobs',
+               default=100,
+               help='Batches kept to be queried once all of their volumes '
+                    'ended, the oldest being forgotten first'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(clone_scheduler_opts)
+
+LOG = logging.getLogger(__name__)
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+class _Clone(object):
+
+    def __init__(self, job, task_id, volume, size, seq):
+        self.job = job
+        self.task_id = task_id
+        self.volume = volume
+        self.size = size
+        self.seq = seq
+        self.peer = (volume.get('src_gw_url') or '').split(':')[0]
+        self.device = (self.peer, volume.get('src_dev_name'))
+
+    def key(self):
+        if self.job.policy == LARGEST_FIRST:
+            order = -self.size
+        elif self.job.policy == SHORTEST_FIRST:
+            order = self.size
+        else:
+            order = 0
+        return self.job.seq, order, self.seq
+
+
+class _Job(object):
+
+    def __init__(self, job_id, policy, seq):
+        self.id = job_id
+        self.policy = policy
+        self.seq = seq
+        self.task_ids = []
+        # volumes not ended yet
+        self.left = 0
+
+
+class Scheduler(object):
+    """Starts the queued clones of batches with start(volume, task_id).
+
+    start returns the task id once the clone runs, the task then ends with
+    task_done.
+    """
+
+    def __init__(self, start):
+        self._start = start
+        self.trans_states = transformer_state.TransformerSate()
+        self._jobs = {}
+        # job id: job, of the jobs all of whose volumes ended, oldest first
+        self._finished = collections.OrderedDict()
+        self._queued = []
+        # task id: clone
+        self._running = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit(self, volumes, sizes, policy=None):
+        """Queue volumes of sizes bytes, returns the job id and the task
+        ids of the volumes.
+        """
+        policy = policy or CONF.clone_schedule_policy
+        if policy not in POLICIES:
+            msg = "Input schedule policy error: %s" % policy
+            raise exception.InvalidInput(reason=msg)
+        with self._lock:
+            job = _Job(uuidutils.generate_uuid(), policy, next(self._seq))
+            for volume, size in zip(volumes, sizes):
+                task_id = uuidutils.generate_uuid()
+                self.trans_states.add_task(transformer.TransformerTask(
+                    task_id, task_state=task_status.QUEUED))
+                job.task_ids.append(task_id)
+                job.left += 1
+                self._queued.append(_Clone(job, task_id, volume, size,
+                                           next(self._seq)))
+            self._jobs[job.id] = job
+        LOG.info("Clone job %(job)s queued: %(count)s volumes, %(policy)s",
+                 {'job': job.id, 'count': len(job.task_ids),
+                  'policy': policy})
+        self._dispatch()
+        return job.id, list(job.task_ids)
+
+    def get_job(self, job_id):
+        """Tasks of the job and their states, None for an unknown job."""
+        with self._lock:
+            job = self._jobs.get(job_id) or self._finished.get(job_id)
+        if job is None:
+            return None
+        tasks = []
+        for task_id in job.task_ids:
+            task = self.trans_states.get_task(task_id)
+            tasks.append({'task_id': task_id,
+                          'task_state': task.task_state if task else None})
+        return {'job_id': job.id, 'policy': job.policy, 'tasks': tasks}
+
+    def task_done(self, task_id):
+        with self._lock:
+            clone = self._running.pop(task_id, None)
+            if clone is not None:
+                self._job_left(clone.job)
+        if clone is not None:
+            self._dispatch()
+
+    def _job_left(self, job):
+        """Count a volume of job ended, the job is finished with the last
+        one.
+        """
+        job.left -= 1
+        if job.left > 0:
+            return
+        self._jobs.pop(job.id, None)
+        self._finished[job.id] = job
+        while len(self._finished) > max(CONF.clone_finished_jobs, 0):
+            self._finished.popitem(last=False)
+
+    def _dispatch(self):
+        with self._lock:
+            ready = self._take_ready()
+        for clone in ready:
+            # a clone formats and mounts before its transfer runs
+            thread = threading.Thread(target=self._run, args=(clone,),
+                                      name='clone-%s' % clone.task_id)
+            thread.daemon = True
+            thread.start()
+
+    def _take_ready(self):
+        """Move the clones the caps let start to running."""
+        max_running = max(CONF.clone_max_running, 1)
+        max_per_device = max(CONF.clone_max_per_device, 1)
+        max_per_peer = max(CONF.clone_max_per_peer, 1)
+        ready = []
+        for clone in sorted(self._queued, key=_Clone.key):
+            if len(self._running) >= max_running:
+                break
+            running = self._running.values()
+            if (sum(1 for c in running if c.device == clone.device) >=
+                    max_per_device or
+                    sum(1 for c in running if c.peer == clone.peer) >=
+                    max_per_peer):
+                continue
+            self._queued.remove(clone)
+            self._running[clone.task_id] = clone
+            ready.append(clone)
+        return ready
+
+    def _run(self, clone):
+        LOG.debug("Start clone %(task)s of job %(job)s",
+                  {'task': clone.task_id, 'job': clone.job.id})
+        try:
+            if self._start(clone.volume, clone.task_id) is None:
+                raise exception.V2vException(message="clone not started")
+        except Exception as e:
+            LOG.error("Start clone %(task)s of job %(job)s error: "
+                      "%(error)s",
+                      {'task': clone.task_id, 'job': clone.job.id,
+                       'error': e})
+            self.trans_states.update_state(clone.task_id, task_status.ERROR)
+            self.task_done(clone.task_id)
+            notify.task_ended(clone.task_id, task_status.ERROR,
+                              clone.volume.get('callback_url'))
+
+
+def get_scheduler(start):
+    """The scheduler of the agent, made with start the first time."""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(start)
+        return _scheduler
+
+
+def task_done(task_id):
+    """Let the clones queued behind task_id start."""
+    if _scheduler is not None:
+        _scheduler.task_done(task_id)
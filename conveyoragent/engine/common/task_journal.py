@@ -0,0 +1,83 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""
+Clone requests of unfinished tasks, kept on disk so that they can be
+resumed under the same task id after the agent restarts.
+"""
+
+import os
+
+from oslo_config import cfg
+from oslo_log import log as logging
+from oslo_serialization import jsonutils
+
+task_journal_opts = [
+    cfg.StrOpt('task_journal_dir',
+               default='$state_path/tasks',
+               help='Directory the clone requests of unfinished tasks are '
+                    'kept in'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(task_journal_opts)
+
+LOG = logging.getLogger(__name__)
+
+_SUFFIX = '.json'
+
+
+def _path(task_id):
+    return os.path.join(CONF.task_journal_dir, task_id + _SUFFIX)
+
+
+def save(task_id, record):
+    directory = CONF.task_journal_dir
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = _path(task_id) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(jsonutils.dumps(record))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, _path(task_id))
+    except (IOError, OSError) as e:
+        # the task runs anyway, it just cannot resume after a restart
+        LOG.warning("Journal task %(task_id)s failed: %(error)s",
+                    {'task_id': task_id, 'error': e})
+
+
+def load(task_id):
+    try:
+        with open(_path(task_id)) as f:
+            return jsonutils.loads(f.read())
+    except (IOError, OSError, ValueError) as e:
+        LOG.debug("No journal of task %(task_id)s: %(error)s",
+                  {'task_id': task_id, 'error': e})
+        return None
+
+
+def remove(task_id):
+    try:
+        os.remove(_path(task_id))
+    except OSError:
+        pass
+
+
+def list_tasks():
+    try:
+        names = os.listdir(CONF.task_journal_dir)
+    except OSError:
+        return []
+    return sorted(name[:-len(_SUFFIX)] for name in names
+                  if name.endswith(_SUFFIX))
@@ -17,5 +17,6 @@
 status of a transformer task.
 """
 
-TASK_STATUS = (TRANSFORMERING, FINISHED, ERROR) = (
-               'DATA_TRANSFORMING', 'DATA_TRANS_FINISHED', 'DATA_TRANS_FAILED')
+TASK_STATUS = (QUEUED, TRANSFORMERING, FINISHED, ERROR) = (
+               'DATA_TRANS_QUEUED', 'DATA_TRANSFORMING', 'DATA_TRANS_FINISHED',
+               'DATA_TRANS_FAILED')
@@ -0,0 +1,165 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Token bucket shaping of the data the agent moves.
+
+Every transfer draws from the bucket of the whole agent and, if its task
+has one, from the bucket of its task. Buckets run into debt rather than
+splitting large reads: a caller takes what it moves at once and sleeps
+until the debt is paid back. Rates can be changed while transfers run.
+"""
+
+import threading
+import time
+
+from oslo_config import cfg
+
+throttle_opts = [
+    cfg.IntOpt('transfer_bandwidth_limit',
+               default=0,
+               help='Bytes per second all transfers of the agent may move '
+                    'together, 0 for no limit'),
+    cfg.FloatOpt('transfer_burst_time',
+                 default=0.5,
+                 help='Seconds worth of bandwidth an idle transfer may '
+                      'move at once'),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(throttle_opts)
+
+# longest sleep before a changed rate is noticed
+_MAX_WAIT = 0.5
+
+_lock = threading.Lock()
+_agent_bucket = None
+# task id -> TokenBucket
+_task_buckets = {}
+
+
+class TokenBucket(object):
+    """Thread safe token bucket, a rate of 0 does not limit."""
+
+    def __init__(self, rate=0):
+        self.rate = 0
+        self._tokens = 0.0
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def _capacity(self):
+        return self.rate * max(CONF.transfer_burst_time, 0.0)
+
+    def _refill(self, now):
+        if self.rate:
+            self._tokens = min(self._capacity(),
+                               self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def set_rate(self, rate):
+        rate = max(int(rate or 0), 0)
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if not self.rate:
+                # a bucket starting to limit starts full
+                self._tokens = float(rate) * max(CONF.transfer_burst_time,
+                                                 0.0)
+            self.rate = rate
+            self._tokens = min(self._tokens, self._capacity())
+
+    def consume(self, amount):
+        """Take amount bytes, waiting as long as the rate requires."""
+        with self._lock:
+            if not self.rate:
+                return
+            self._refill(time.time())
+            self._tokens -= amount
+        while True:
+            with self._lock:
+                if not self.rate:
+                    return
+                self._refill(time.time())
+                if self._tokens >= 0:
+                    return
+                wait = -self._tokens / self.rate
+            time.sleep(min(wait, _MAX_WAIT))
+
+
+class Limiter(object):
+    """Draws the bytes of one transfer from several buckets, counting
+    them in its progress.Progress if it has one.
+    """
+
+    def __init__(self, buckets, progress=None):
+        self.buckets = [bucket for bucket in buckets if bucket is not None]
+        self.progress = progress
+
+    def consume(self, amount):
+        if self.progress is not None:
+            self.progress.add(amount)
+        for bucket in self.buckets:
+            bucket.consume(amount)
+
+
+def agent_bucket():
+    global _agent_bucket
+    with _lock:
+        if _agent_bucket is None:
+            _agent_bucket = TokenBucket(CONF.transfer_bandwidth_limit)
+        return _agent_bucket
+
+
+def limiter(task_id=None, rate=None, progress=None):
+    """Limiter of a transfer, of the task task_id if there is one.
+
+    rate, when given, sets the limit of the task.
+    """
+    buckets = [agent_bucket()]
+    if task_id:
+        with _lock:
+            bucket = _task_buckets.get(task_id)
+            if bucket is None:
+                bucket = _task_buckets[task_id] = TokenBucket()
+        if rate is not None:
+            bucket.set_rate(rate)
+        buckets.append(bucket)
+    return Limiter(buckets, progress=progress)
+
+
+def set_limit(rate, task_id=None):
+    """Change the limit of a task, or of the agent without task_id.
+
+    Returns False for a task the agent does not shape.
+    """
+    if not task_id:
+        agent_bucket().set_rate(rate)
+        return True
+    with _lock:
+        bucket = _task_buckets.get(task_id)
+    if bucket is None:
+        return False
+    bucket.set_rate(rate)
+    return True
+
+
+def get_limit(task_id=None):
+    if not task_id:
+        return agent_bucket().rate
+    with _lock:
+        bucket = _task_buckets.get(task_id)
+    return bucket.rate if bucket is not None else None
+
+
+def release(task_id):
+    with _lock:
+        _task_buckets.pop(task_id, None)
@@ -23,7 +23,31 @@ class TransformerTask(object):
         self.id = task_id
         self.task_name = task_name
         self.task_state = task_state
+        # CompressionStats of a compressed transfer
+        self.compression = None
+        # times the transfer was resumed from its checkpoint
+        self.resumes = 0
+        # bytes per second the task is limited to, None for no limit
+        self.bandwidth_limit = None
+        # webhook the state of the task is posted to once it ends
+        self.callback_url = None
+        # version of the last change of the task, see changes
+        self.version = 0
+        # progress.Progress of the data moved, if it is counted
+        self.progress = None
 
     def get_state(self):
 
         return self.task_state
+
+    def get_details(self):
+        details = {'version': self.version}
+        if self.compression is not None:
+            details['compression'] = self.compression.to_dict()
+        if self.resumes:
+            details['resumes'] = self.resumes
+        if self.bandwidth_limit:
+            details['bandwidth_limit'] = self.bandwidth_limit
+        if self.progress is not None:
+            details.update(self.progress.to_dict())
+        return details
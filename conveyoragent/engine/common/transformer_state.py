@@ -18,6 +18,7 @@
 
 from oslo_log import log as logging
 
+from conveyoragent.engine.common import changes
 from conveyoragent.engine.common import transformer
 from conveyoragent import exception
 
@@ -43,6 +44,7 @@ class TransformerSate(object):
             self.add_task(task)
         else:
             task.task_state = state
+            changes.changed(task)
 
     def remove(self, task_id):
         task = _task_map.get(task_id)
@@ -52,6 +54,7 @@ class TransformerSate(object):
             raise exception.V2vException(message=msg)
 
         _task_map.pop(task_id)
+        changes.changed()
 
     def add_task(self, task):
 
@@ -70,6 +73,13 @@ class TransformerSate(object):
             raise exception.V2vException(message=msg)
 
         _task_map[task_id] = task
+        changes.changed(task)
+
+    def get_task(self, task_id):
+        return _task_map.get(task_id)
+
+    def get_task_ids(self):
+        return list(_task_map.keys())
 
     def get_task_state(self, task_id):
 
@@ -81,6 +91,17 @@ class TransformerSate(object):
 
         return task.task_state
 
+    def get_task_details(self, task_id):
+
+        task = _task_map.get(task_id)
+        if not task:
+            LOG.error("Query transformer task details error: task is not "
+                      "exist")
+            msg = "Query transformer task details is not exist"
+            raise exception.V2vException(message=msg)
+
+        return task.get_details()
+
 if __name__ == '__main__':
 
     a = TransformerSate()
@@ -15,6 +15,9 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import binascii
+import functools
+import os
 import threading
 import time
 
@@ -23,11 +26,23 @@ from eventlet import greenthread
 from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_utils import importutils
+from oslo_utils import strutils
 from oslo_utils import uuidutils
 
 from conveyoragent.brick import base
 from conveyoragent.conveyoragentclient.v1 import client as agentclient
+from conveyoragent.engine.agent.block import block as block_agent
+from conveyoragent.engine.agent.ftp import bundle as ftp_bundle
+from conveyoragent.engine.agent.ftp import stream as ftp_stream
+from conveyoragent.engine.common import changes
+from conveyoragent.engine.common import compression
+from conveyoragent.engine.common import executor
+from conveyoragent.engine.common import notify
+from conveyoragent.engine.common import progress
+from conveyoragent.engine.common import scheduler
+from conveyoragent.engine.common import task_journal
 from conveyoragent.engine.common import task_status
+from conveyoragent.engine.common import throttle
 from conveyoragent.engine.common import transformer
 from conveyoragent.engine.common import transformer_state
 from conveyoragent import exception
@@ -39,6 +54,8 @@ migrate_manager_opts = [
                     'ftp=conveyoragent.engine.agent.ftp.ftp.FtpAgent',
                     'fillp=conveyoragent.engine.agent.fillp.fillp.FillAgent',
                     'socket=conveyoragent.engine.agent.fillp.fillp.FillAgent',
+                    'block=conveyoragent.engine.agent.block.block.BlockAgent',
+                    'pull=conveyoragent.engine.agent.pull.pull.PullAgent',
                 ],
                 help='DEPRECATED. each resource manager class path.'),
     cfg.StrOpt('volume_name_path',
@@ -55,7 +72,28 @@ migrate_manager_opts = [
                help=''),
     cfg.IntOpt('trans_retry_interval',
                default=5,
-               help='')
+               help=''),
+    cfg.IntOpt('trans_resume_retries',
+               default=3,
+               help='Times an interrupted block transfer is resumed from '
+                    'its checkpoint before its task fails'),
+    cfg.IntOpt('trans_verify_retries',
+               default=2,
+               help='Times the ranges of a verified block transfer found '
+                    'to differ are sent again before its task fails'),
+    cfg.IntOpt('task_wait_max',
+               default=300,
+               help='Seconds a query of a task waits for it to change at '
+                    'most'),
+    cfg.IntOpt('task_events_interval',
+               default=5,
+               help='Seconds between two looks at the details of the tasks '
+                    'of an event stream, an empty line being sent when '
+                    'nothing changed'),
+    cfg.BoolOpt('resume_tasks_on_start',
+                default=True,
+                help='Resume the block transfers left unfinished by the '
+                     'previous run of the agent when it starts'),
 ]
 
 CONF = cfg.CONF
@@ -63,6 +101,10 @@ CONF.register_opts(migrate_manager_opts)
 
 LOG = logging.getLogger(__name__)
 
+# protocols whose sender runs inside the agent and is already running when
+# start_transformer_data returns
+IN_PROCESS_PROTOCOLS = ('block',)
+
 
 def agent_dict_from_config(named_agent_config, *args, **kwargs):
     """Create manager class by config file, and set key with class"""
@@ -76,6 +118,13 @@ def agent_dict_from_config(named_agent_config, *args, **kwargs):
     return agent_registry
 
 
+def _process_error(process):
+    """Exit code and end of stderr a source agent reported of a process."""
+    if not process:
+        return ''
+    return 'pid %(pid)s exited %(returncode)s: %(stderr)s' % process
+
+
 class MigrationManager(object):
 
     def __init__(self, *args, **kwargs):
@@ -195,10 +244,12 @@ class MigrationManager(object):
         agent = self.agents.get(protocol)
         agent.upLoadFile(host, port, localpath, remotepath)
 
-    def upLoadDirTree(self, host, port, localpath, remotepath, protocol='ftp'):
-        '''up load dir'''
+    def upLoadDirTree(self, host, port, localpath, remotepath, protocol='ftp',
+                      limiter=None, workers=None):
+        '''up load dir, workers files at a time'''
         agent = self.agents.get(protocol)
-        agent.upLoadDirTree(host, port, localpath, remotepath)
+        agent.upLoadDirTree(host, port, localpath, remotepath,
+                            limiter=limiter, workers=workers)
 
     def upLoadFileExt(self, host, port, localpath, remotepath, protocol='ftp'):
         '''up load file include resuming broken transfer'''
@@ -211,10 +262,112 @@ class MigrationManager(object):
         agent.downLoadFile(host, port, localpath, remotepath)
 
     def downLoadDirTree(self, host, port, localpath, remotepath,
-                        protocol='ftp'):
+                        protocol='ftp', compression_stats=None, limiter=None,
+                        workers=None, skip=None, sync=False):
         '''down load dir'''
         agent = self.agents.get(protocol)
-        agent.downLoadDirTree(host, port, localpath, remotepath)
+        agent.downLoadDirTree(host, port, localpath, remotepath,
+                              compression_stats=compression_stats,
+                              limiter=limiter, workers=workers, skip=skip,
+                              sync=sync)
+
+    def _bundle_download_dir_tree(self, host, port, des_ip, path,
+                                  compression_stats=None, limiter=None,
+                                  sync=False):
+        """Download path, its small files first in a bundle of the source.
+
+        What the bundle did not bring, because it failed or because the
+        files are large, is downloaded over ftp.
+        """
+        receiver = ftp_bundle.Receiver(path, limiter=limiter)
+        bundle_port = receiver.start()
+        try:
+            agent_client = agentclient.get_birdiegateway_client(host, port)
+            agent_client.vservices.send_bundle(des_ip, bundle_port, path,
+                                               receiver.token)
+        except Exception as e:
+            receiver.stop()
+            LOG.warning("Source can not send the bundle of %(path)s, "
+                        "download all of it over ftp: %(error)s",
+                        {'path': path, 'error': e})
+        try:
+            receiver.wait()
+        except exception.DownLoadDataError as e:
+            LOG.warning("Download over ftp what the bundle missed: %s", e)
+        # port is the one of the api of the source, not of its ftp
+        self.downLoadDirTree(host, None, path, path, 'ftp',
+                             compression_stats, limiter,
+                             skip=receiver.extracted, sync=sync)
+
+    def send_bundle(self, trans_ip, trans_port, path, token,
+                    max_size=None):
+        """Send the small files of path to the destination in a thread.
+
+        token is the one the receiver of the destination expects first.
+        """
+        if not token:
+            raise exception.InvalidInput(reason="Input bundle token error")
+        if not utils.is_int_like(trans_port):
+            msg = "Input bundle port error: %s" % trans_port
+            raise exception.InvalidInput(reason=msg)
+        if max_size is not None and (not utils.is_int_like(max_size) or
+                                     int(max_size) < 1):
+            msg = "Input bundle file size error: %s" % max_size
+            raise exception.InvalidInput(reason=msg)
+        if not path or not os.path.isdir(path):
+            msg = "Input bundle path error: %s" % path
+            raise exception.InvalidInput(reason=msg)
+
+        def send():
+            try:
+                ftp_bundle.send(trans_ip, int(trans_port), path, token,
+                                max_size=max_size and int(max_size))
+            except Exception as e:
+                LOG.error("Send bundle of %(path)s error: %(error)s",
+                          {'path': path, 'error': e})
+        thread = threading.Thread(target=send, name='ftp-bundle-sender')
+        thread.daemon = True
+        thread.start()
+
+    def start_file_server(self, path):
+        """Serve path to destinations pulling it, returns the port and
+        token of the server.
+        """
+        if not path or not os.path.isdir(path):
+            msg = "Input file server path error: %s" % path
+            raise exception.InvalidInput(reason=msg)
+        return self._pull_agent().start_server(path)
+
+    def stop_file_server(self, port):
+        if not utils.is_int_like(port):
+            msg = "Input file server port error: %s" % port
+            raise exception.InvalidInput(reason=msg)
+        if not self._pull_agent().stop_server(int(port)):
+            msg = "No file server on port %s" % port
+            raise exception.InvalidInput(reason=msg)
+
+    def _pull_agent(self):
+        agent = self.agents.get('pull')
+        if agent is None:
+            msg = "Transformer agent pull is not configured"
+            raise exception.InvalidInput(reason=msg)
+        return agent
+
+    def _pull_dir_tree(self, host, port, path, limiter=None):
+        """Pull path from a file server the source starts for it."""
+        agent_client = agentclient.get_birdiegateway_client(host, port)
+        file_server = agent_client.vservices.start_file_server(path)
+        try:
+            self._pull_agent().downLoadDirTree(
+                host, file_server['port'], file_server['token'], path,
+                limiter=limiter)
+        finally:
+            try:
+                agent_client.vservices.stop_file_server(file_server['port'])
+            except Exception as e:
+                # it stops by itself once idle
+                LOG.warning("Stop file server of %(path)s error: %(error)s",
+                            {'path': path, 'error': e})
 
     def downLoadFileExt(self, host, port, localpath, remotepath,
                         protocol='ftp'):
@@ -243,17 +396,108 @@ class MigrationManager(object):
             _msg = "Query task state error"
             raise exception.V2vException(message=_msg)
 
-    def clone_volume(self, volume):
+    def query_data_transformer_details(self, task_id):
+        try:
+            return self.trans_states.get_task_details(task_id)
+        except exception.V2vException as ext:
+            LOG.error("Query task %(task_id)s details error: %(error)s",
+                      {'task_id': task_id, 'error': ext})
+            _msg = "Query task details error"
+            raise exception.V2vException(message=_msg)
+
+    def wait_task(self, task_id, wait, since=None):
+        """Wait wait seconds at most for task_id to change past version
+        since, by default its version now.
+
+        Returns the version of the task then, None for an unknown task.
+        """
+        if not utils.is_int_like(wait) or int(wait) < 0:
+            msg = "Input wait error: %s" % wait
+            raise exception.InvalidInput(reason=msg)
+        if since is not None:
+            if not utils.is_int_like(since) or int(since) < 0:
+                msg = "Input since error: %s" % since
+                raise exception.InvalidInput(reason=msg)
+            since = int(since)
+        deadline = time.time() + min(int(wait), CONF.task_wait_max)
+        while True:
+            # taken first, so that no change after the look at the task
+            # goes unseen
+            seen = changes.version()
+            task = self.trans_states.get_task(task_id)
+            if task is None:
+                return None
+            if since is None:
+                since = task.version
+            remaining = deadline - time.time()
+            if task.version > since or remaining <= 0:
+                return task.version
+            changes.wait(seen, remaining)
+
+    def task_events(self, task_ids=None, since=None, timeout=None):
+        """Events of the state and details of tasks, all of them without
+        task_ids, as they change past version since.
+
+        The events are dicts, None for nothing changed in a while. They
+        end once all of task_ids ended, or after timeout seconds.
+        """
+        for name, value in (('since', since), ('timeout', timeout)):
+            if value is not None and (not utils.is_int_like(value) or
+                                      int(value) < 0):
+                msg = "Input %s error: %s" % (name, value)
+                raise exception.InvalidInput(reason=msg)
+        since = int(since or 0)
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + int(timeout)
+        return self._task_events(task_ids, since, deadline)
+
+    def _task_events(self, task_ids, since, deadline):
+        ended = (task_status.FINISHED, task_status.ERROR)
+        # task id: last event sent
+        sent = {}
+        while True:
+            seen = changes.version()
+            running = False
+            for task_id in task_ids or self.trans_states.get_task_ids():
+                task = self.trans_states.get_task(task_id)
+                if task is None:
+                    continue
+                event = {'task_id': task_id, 'task_state': task.task_state}
+                event.update(task.get_details())
+                if task_id not in sent and task.version <= since:
+                    # known to the reader already
+                    sent[task_id] = event
+                elif sent.get(task_id) != event:
+                    sent[task_id] = event
+                    yield event
+                if task.task_state not in ended:
+                    running = True
+            if task_ids and not running:
+                return
+
+            wait = CONF.task_events_interval
+            if deadline is not None:
+                wait = min(wait, deadline - time.time())
+                if wait <= 0:
+                    return
+            if changes.wait(seen, wait) == seen:
+                # progress does not change the version
+                yield None
+
+    def clone_volume(self, volume, task_id=None):
         LOG.debug("Copy volume start: %s", volume)
         protocol = volume.get("trans_protocol")
         if not protocol:
             LOG.error("Transformer data protocol is null.")
             return None
-        task_id = None
         if 'ftp' == protocol:
-            task_id = self._ftp_copy_volume(volume)
-        elif protocol in ['fillp', 'socket']:
-            task_id = self._fillp_copy_volume(volume, protocol)
+            task_id = self._ftp_copy_volume(volume, task_id=task_id)
+        elif protocol in ['fillp', 'socket', 'block']:
+            task_id = self._fillp_copy_volume(volume, protocol,
+                                              task_id=task_id)
+        elif 'pull' == protocol:
+            task_id = self._pull_copy_volume(volume, task_id=task_id)
         else:
             LOG.error("Copy volume error: protocol %s not support", protocol)
             return None
@@ -261,12 +505,193 @@ class MigrationManager(object):
         LOG.debug("Copy volume end: %s", task_id)
         return task_id
 
-    def _ftp_copy_volume(self, volume):
+    def clone_volumes(self, volumes, policy=None):
+        """Queue the clones of volumes, returns the job id and the task id
+        of each volume.
+
+        The clones start as the caps of the scheduler allow, in the order
+        of policy.
+        """
+        if not volumes or not isinstance(volumes, list):
+            msg = "Input volumes error: %s" % volumes
+            raise exception.InvalidInput(reason=msg)
+        for volume in volumes:
+            if not isinstance(volume, dict) or not volume.get(
+                    'trans_protocol'):
+                msg = "Input volume error: %s" % volume
+                raise exception.InvalidInput(reason=msg)
+            self._get_callback_url(volume)
+            self._get_priority(volume)
+        sizes = [self._volume_size(volume) for volume in volumes]
+        clones = scheduler.get_scheduler(self.clone_volume)
+        return clones.submit(volumes, sizes, policy=policy)
+
+    def get_clone_job(self, job_id):
+        """Tasks of a batch of clones, None if there is no such job."""
+        return scheduler.get_scheduler(self.clone_volume).get_job(job_id)
+
+    def _volume_size(self, volume):
+        """Bytes of volume, as given or of its destination device."""
+        size = volume.get('size')
+        if size is not None:
+            if not utils.is_int_like(size) or int(size) < 0:
+                msg = "Input volume size error: %s" % size
+                raise exception.InvalidInput(reason=msg)
+            return int(size)
+        try:
+            fd = os.open(volume.get('des_dev_name') or '', os.O_RDONLY)
+        except OSError as e:
+            LOG.warning("Size of volume %(dev)s unknown: %(error)s",
+                        {'dev': volume.get('des_dev_name'), 'error': e})
+            return 0
+        try:
+            return block_agent.device_size(fd)
+        finally:
+            os.close(fd)
+
+    def resume_clone_volume(self, task_id):
+        """Resume an interrupted clone under its task id.
+
+        Only the chunks missing from the checkpoint of the destination are
+        sent again.
+        """
+        if not uuidutils.is_uuid_like(task_id):
+            msg = "Input task id error: %s" % task_id
+            raise exception.InvalidInput(reason=msg)
+        task = self.trans_states.get_task(task_id)
+        if task and task.task_state == task_status.TRANSFORMERING:
+            msg = "Task %s is still transforming" % task_id
+            raise exception.InvalidInput(reason=msg)
+        record = task_journal.load(task_id)
+        if not record:
+            msg = "Task %s can not be resumed" % task_id
+            raise exception.InvalidInput(reason=msg)
+
+        LOG.info("Resume clone volume task %s", task_id)
+        return self._fillp_copy_volume(record['volume'], record['protocol'],
+                                       task_id=task_id, resume=True)
+
+    def resume_clone_volumes(self):
+        """Resume the clones the previous run of the agent left."""
+        for task_id in task_journal.list_tasks():
+            if self.trans_states.get_task(task_id):
+                continue
+            try:
+                self.resume_clone_volume(task_id)
+            except Exception as e:
+                LOG.error("Resume clone volume task %(task_id)s error: "
+                          "%(error)s", {'task_id': task_id, 'error': e})
+
+    def set_bandwidth_limit(self, limit, task_id=None):
+        """Change the bytes per second of a task, or of the whole agent.
+
+        The new limit applies to the transfers already running.
+        """
+        if not utils.is_int_like(limit) or int(limit) < 0:
+            msg = "Input bandwidth limit error: %s" % limit
+            raise exception.InvalidInput(reason=msg)
+        limit = int(limit)
+        if not throttle.set_limit(limit, task_id=task_id):
+            msg = "Task %s is not transforming" % task_id
+            raise exception.InvalidInput(reason=msg)
+
+        if task_id:
+            task = self.trans_states.get_task(task_id)
+            if task:
+                task.bandwidth_limit = limit
+                changes.changed(task)
+            # a resumed task keeps the limit
+            record = task_journal.load(task_id)
+            if record:
+                record['volume']['bandwidth_limit'] = limit
+                task_journal.save(task_id, record)
+        LOG.info("Bandwidth limit of %(scope)s set to %(limit)s bytes/s",
+                 {'scope': task_id or 'the agent', 'limit': limit})
+        return limit
+
+    def get_ftp_stats(self):
+        """Transfers, bytes and rate of the ftp downloads of the agent."""
+        return ftp_stream.get_counters().to_dict()
+
+    def get_transfer_stats(self):
+        """Queue depth, workers busy and wait and run times of the
+        transfers of the agent.
+        """
+        return executor.get_executor().stats()
+
+    def _get_bandwidth_limit(self, volume):
+        limit = volume.get('bandwidth_limit')
+        if limit is None:
+            return None
+        if not utils.is_int_like(limit) or int(limit) < 0:
+            msg = "Input bandwidth limit error: %s" % limit
+            raise exception.InvalidInput(reason=msg)
+        return int(limit)
+
+    def _get_callback_url(self, volume):
+        url = volume.get('callback_url')
+        if not url:
+            return None
+        if not url.startswith(('http://', 'https://')):
+            msg = "Input callback url error: %s" % url
+            raise exception.InvalidInput(reason=msg)
+        return url
+
+    def _get_priority(self, volume):
+        priority = volume.get('priority') or executor.NORMAL
+        if priority not in executor.PRIORITIES:
+            msg = "Input priority error: %s" % priority
+            raise exception.InvalidInput(reason=msg)
+        return priority
+
+    def _get_compression(self, volume):
+        algorithm = volume.get('compression') or compression.NONE
+        if algorithm not in compression.supported_algorithms():
+            msg = "Input compression error: %s" % algorithm
+            raise exception.InvalidInput(reason=msg)
+        if algorithm == compression.NONE:
+            return None
+        return algorithm
+
+    def _add_task(self, task):
+        """Add task, in place of the one it runs again or was queued as."""
+        old_task = self.trans_states.get_task(task.id)
+        if old_task:
+            task.resumes = old_task.resumes
+            self.trans_states.remove(task.id)
+        self.trans_states.add_task(task)
+
+    def _ftp_copy_volume(self, volume, task_id=None):
         dev_disk_name = volume['des_dev_name']
         disk_format = volume['src_dev_format']
 
-        # 1. format disk
-        self.migrate_ssh.format_disk(dev_disk_name, disk_format)
+        # MODE Z of ftp always deflates
+        stats = None
+        if self._get_compression(volume):
+            stats = compression.CompressionStats(compression.ZLIB)
+        bandwidth_limit = self._get_bandwidth_limit(volume)
+        callback_url = self._get_callback_url(volume)
+        priority = self._get_priority(volume)
+        # the size of the files is only known if given
+        total = None
+        if volume.get('size') is not None:
+            total = self._volume_size(volume)
+        bundle = strutils.bool_from_string(volume.get('bundle', False))
+        # a sync of a clone run before only fetches what it misses
+        sync = strutils.bool_from_string(volume.get('sync', False))
+        des_ip = None
+        if bundle:
+            # the source sends the bundle to the gateway of the destination
+            des_ip = (volume.get('des_gw_url') or '').split(':')[0]
+            if not des_ip:
+                msg = "Input destination gw url error: %s" % \
+                    volume.get('des_gw_url')
+                raise exception.InvalidInput(reason=msg)
+
+        # 1. format disk, unless a sync keeps what an earlier run wrote
+        if (not sync or self.migrate_ssh.get_disk_format(dev_disk_name) !=
+                disk_format):
+            self.migrate_ssh.format_disk(dev_disk_name, disk_format)
 
         # 2. make the same directory as the source vm's disk mounted
         mount_dir = volume['src_mount_point'][0]
@@ -292,25 +717,85 @@ class MigrationManager(object):
         host_port = urls[1]
         try:
             # create transformer task and return task id for quering its state
-            task_id = uuidutils.generate_uuid()
+            task_id = task_id or uuidutils.generate_uuid()
             task_state = task_status.TRANSFORMERING
             task = transformer.TransformerTask(task_id, task_state=task_state)
-            self.trans_states.add_task(task)
+            task.compression = stats
+            task.bandwidth_limit = bandwidth_limit
+            task.callback_url = callback_url
+            task.progress = progress.Progress(total=total)
+            self._add_task(task)
+            limiter = throttle.limiter(task_id, rate=bandwidth_limit,
+                                       progress=task.progress)
 
             # start data transformer task thread
-            args = [host_ip, host_port, mount_dir, mount_dir]
-            thread = AgentThread(self.downLoadDirTree,
-                                 self.trans_states,
-                                 task_id,
-                                 *args)
-            thread.start()
+            if bundle:
+                target = functools.partial(self._bundle_download_dir_tree,
+                                           sync=sync)
+                args = [host_ip, host_port, des_ip, mount_dir, stats,
+                        limiter]
+            else:
+                # the ftp server of the source is on the ftp port
+                target = functools.partial(self.downLoadDirTree, sync=sync)
+                args = [host_ip, None, mount_dir, mount_dir, 'ftp',
+                        stats, limiter]
+            AgentTask(target, self.trans_states, task_id,
+                      *args).start(priority)
             return task_id
             # self.downLoadDirTree(host_ip, host_ip, mount_dir, mount_dir)
+        except exception.TransferQueueFull:
+            raise
         except Exception as e:
             LOG.error("DownLoad data error: %s", e)
             raise exception.DownLoadDataError(error=e)
 
-    def _fillp_copy_volume(self, volume, protocol):
+    def _pull_copy_volume(self, volume, task_id=None):
+        dev_disk_name = volume['des_dev_name']
+        disk_format = volume['src_dev_format']
+        bandwidth_limit = self._get_bandwidth_limit(volume)
+        callback_url = self._get_callback_url(volume)
+        priority = self._get_priority(volume)
+
+        remote_host = volume['src_gw_url']
+        urls = remote_host.split(':')
+        if len(urls) != 2:
+            LOG.error("Input source gw url error: %s", remote_host)
+            msg = "Input source gw url error: " + remote_host
+            raise exception.InvalidInput(reason=msg)
+        host_ip = urls[0]
+        host_port = urls[1]
+
+        # the same directory as the one the source serves, on a new disk
+        self.migrate_ssh.format_disk(dev_disk_name, disk_format)
+        mount_dir = volume['src_mount_point'][0]
+        self.migrate_ssh.make_dir(mount_dir)
+        volume['disk_name'] = volume['des_dev_name']
+        volume['disk_format'] = volume['src_dev_format']
+        self.migrate_ssh.mount_disk(volume, mount_dir)
+
+        try:
+            task_id = task_id or uuidutils.generate_uuid()
+            task = transformer.TransformerTask(
+                task_id, task_state=task_status.TRANSFORMERING)
+            task.bandwidth_limit = bandwidth_limit
+            task.callback_url = callback_url
+            # the size of the tree is known once it is listed
+            task.progress = progress.Progress()
+            self._add_task(task)
+            limiter = throttle.limiter(task_id, rate=bandwidth_limit,
+                                       progress=task.progress)
+
+            AgentTask(self._pull_dir_tree, self.trans_states, task_id,
+                      host_ip, host_port, mount_dir, limiter).start(priority)
+            return task_id
+        except exception.TransferQueueFull:
+            raise
+        except Exception as e:
+            LOG.error("Pull data error: %s", e)
+            raise exception.DownLoadDataError(error=e)
+
+    def _fillp_copy_volume(self, volume, protocol, task_id=None,
+                           resume=False):
         # 1. get sgent vm info
         src_disk_name = volume.get('src_dev_name')
         dev_disk_name = volume.get('des_dev_name')
@@ -329,13 +814,90 @@ class MigrationManager(object):
             raise exception.InvalidInput(reason=msg)
 
         des_ip = des_urls[0]
+        callback_url = self._get_callback_url(volume)
+        priority = self._get_priority(volume)
+
+        # options for the sending side
+        trans_options = {}
+        if CONF.trans_callback:
+            # the source pushes the end of the transfer back to us
+            trans_options['callback_agent'] = des_vm_url
+        stream_count = volume.get('stream_count')
+        if stream_count is not None:
+            if not utils.is_int_like(stream_count) or int(stream_count) < 1:
+                msg = "Input stream count error: %s" % stream_count
+                raise exception.InvalidInput(reason=msg)
+            trans_options['stream_count'] = int(stream_count)
+
+        server_options = {
+            'des_dev_fresh': strutils.bool_from_string(
+                volume.get('des_dev_fresh', False)),
+        }
+
+        # a resumed task keeps its id, its checkpoint is named after it
+        if not task_id:
+            task_id = uuidutils.generate_uuid()
+        if protocol in IN_PROCESS_PROTOCOLS:
+            server_options['checkpoint'] = task_id
+            if resume:
+                trans_options['resume'] = True
+
+        stats = None
+        algorithm = self._get_compression(volume)
+        if algorithm and protocol not in IN_PROCESS_PROTOCOLS:
+            LOG.warning("Protocol %s does not compress, ignore compression",
+                        protocol)
+        elif algorithm:
+            stats = compression.CompressionStats(algorithm)
+            server_options['compression_stats'] = stats
+            trans_options['compression'] = algorithm
+
+        dedup = strutils.bool_from_string(volume.get('dedup', False))
+        if dedup and protocol not in IN_PROCESS_PROTOCOLS:
+            LOG.warning("Protocol %s does not deduplicate, ignore dedup",
+                        protocol)
+        elif dedup:
+            trans_options['dedup'] = True
+
+        # re-clone of a volume copied before: only send what changed
+        delta = strutils.bool_from_string(volume.get('delta', False))
+        if delta and protocol not in IN_PROCESS_PROTOCOLS:
+            LOG.warning("Protocol %s always copies everything, ignore "
+                        "delta", protocol)
+        elif delta:
+            trans_options['delta'] = True
+
+        # the receiver shapes the transfer, TCP slows the sender down
+        bandwidth_limit = self._get_bandwidth_limit(volume)
+        if bandwidth_limit and protocol not in IN_PROCESS_PROTOCOLS:
+            LOG.warning("Protocol %s runs outside of the agent, ignore "
+                        "bandwidth limit", protocol)
+        elif protocol in IN_PROCESS_PROTOCOLS:
+            server_options['limiter'] = throttle.limiter(
+                task_id, rate=bandwidth_limit)
+
+        # the bytes written by a fillp process are not known
+        task_progress = None
+        if protocol in IN_PROCESS_PROTOCOLS:
+            task_progress = progress.Progress()
+            server_options['progress'] = task_progress
+
+        # compare Merkle trees of both ends once the data is sent
+        verify = strutils.bool_from_string(volume.get('verify', False))
+        if verify and protocol not in IN_PROCESS_PROTOCOLS:
+            LOG.warning("Protocol %s can not be verified, ignore verify",
+                        protocol)
+        elif verify:
+            trans_options['verify'] = True
+            server_options['verify'] = True
 
         # 2. start fillp server
         trans_port = volume.get('trans_port')
         agent_driver = self.agents.get(protocol)
         try:
             agent_driver.start_fillp_server(des_ip, trans_port,
-                                            dev_disk_name, protocol)
+                                            dev_disk_name, protocol,
+                                            options=server_options)
         except Exception as e:
             _msg = "Conveyor agent start fillp server error: %s" % e
             LOG.error(_msg)
@@ -355,18 +917,37 @@ class MigrationManager(object):
         try:
             # create transformer task and return task id for querying it's
             # state
-            task_id = uuidutils.generate_uuid()
             task_state = task_status.TRANSFORMERING
             task = transformer.TransformerTask(task_id, task_state=task_state)
-            self.trans_states.add_task(task)
+            task.compression = stats
+            if protocol in IN_PROCESS_PROTOCOLS:
+                task.bandwidth_limit = bandwidth_limit
+            task.callback_url = callback_url
+            task.progress = task_progress
+            self._add_task(task)
+            if resume:
+                task.resumes += 1
+            if protocol in IN_PROCESS_PROTOCOLS:
+                task_journal.save(task_id, {'protocol': protocol,
+                                            'volume': volume})
 
             # start data transformer task thread
             args = [src_vm_ip, src_vm_port, des_ip, trans_port,
-                    src_disk_name, dev_disk_name, protocol, mount]
-            thread = AgentThread(self._fillp_transformer_data,
-                                 self.trans_states, task_id, *args)
-            thread.start()
+                    src_disk_name, dev_disk_name, protocol, mount,
+                    trans_options, task_id]
+            AgentTask(self._fillp_transformer_data, self.trans_states,
+                      task_id, *args).start(priority)
             return task_id
+        except exception.TransferQueueFull:
+            if 'socket' != protocol:
+                agent_driver.stop_fillp_server('server', protocol,
+                                               port=trans_port)
+            # a refused clone never started, nothing is left to resume; a
+            # refused resume can be retried
+            if protocol in IN_PROCESS_PROTOCOLS and not resume:
+                agent_driver.remove_checkpoint(task_id)
+                task_journal.remove(task_id)
+            raise
         except Exception as e:
             LOG.error("Download data error: %s", e)
             raise exception.DownLoadDataError(Error=e)
@@ -374,33 +955,45 @@ class MigrationManager(object):
     def _fillp_transformer_data(self, src_host, src_port,
                                 trans_ip, trans_port,
                                 src_disk, dev_disk,
-                                protocol, mount):
-        # 1. copy data
-        try:
-            agent_client = agentclient.get_birdiegateway_client(src_host,
-                                                                src_port)
-            agent_client.vservices.start_transformer_data(trans_ip,
-                                                          trans_port,
-                                                          src_disk,
-                                                          dev_disk,
-                                                          protocol)
-            # waiting server started
-            self._await_trans_server_started(src_host, src_port, protocol)
-        except Exception as e:
-            LOG.error("Fillp transformer data error: %s", e)
-            raise exception.DownLoadDataError(error=e)
-
-        # 2. wait data transformer finish
+                                protocol, mount, trans_options=None,
+                                task_id=None):
         agent_driver = self.agents.get(protocol)
+        trans_options = dict(trans_options or {})
+        resumes = 0
         try:
-            self._await_data_trans_status(src_host, src_port, protocol)
-        except Exception as e:
-            LOG.error("Await data transformer error: %s", unicode(e))
-            raise
+            while True:
+                try:
+                    self._fillp_send_data(src_host, src_port, trans_ip,
+                                          trans_port, src_disk, dev_disk,
+                                          protocol, trans_options)
+                    if trans_options.get('verify'):
+                        self._verify_data(src_host, src_port, trans_ip,
+                                          trans_port, src_disk, dev_disk,
+                                          protocol, trans_options)
+                    break
+                except Exception as e:
+                    # the receiver is still running, the source only has
+                    # to send what its checkpoint misses
+                    if (protocol not in IN_PROCESS_PROTOCOLS or
+                            resumes >= CONF.trans_resume_retries):
+                        raise
+                    resumes += 1
+                    self._count_resume(task_id)
+                    LOG.warning("Transformer data to %(dev)s interrupted, "
+                                "resume %(resumes)s: %(error)s",
+                                {'dev': dev_disk, 'resumes': resumes,
+                                 'error': e})
+                    trans_options['resume'] = True
+                    greenthread.sleep(CONF.trans_retry_interval)
         finally:
             # 2.2 close fillp server
             if 'socket' != protocol:
-                agent_driver.stop_fillp_server('server', protocol)
+                agent_driver.stop_fillp_server('server', protocol,
+                                               port=trans_port)
+
+        if protocol in IN_PROCESS_PROTOCOLS and task_id:
+            agent_driver.remove_checkpoint(task_id)
+            task_journal.remove(task_id)
 
         # 3. mount disk to directory
         if mount:
@@ -414,8 +1007,127 @@ class MigrationManager(object):
                           {'disk': dev_disk, 'dir': mount, 'error': e})
                 raise
 
+    def _fillp_send_data(self, src_host, src_port, trans_ip, trans_port,
+                         src_disk, dev_disk, protocol, trans_options):
+        callback_id = None
+        if trans_options.get('callback_agent'):
+            callback_id = notify.expect()
+            trans_options = dict(trans_options, callback_id=callback_id)
+        # 1. copy data
+        try:
+            agent_client = agentclient.get_birdiegateway_client(src_host,
+                                                                src_port)
+            rsp = agent_client.vservices.start_transformer_data(
+                trans_ip, trans_port, src_disk, dev_disk, protocol,
+                options=trans_options)
+            # a source agent not pushing it is polled for the end
+            if callback_id and not (rsp or {}).get('callback'):
+                notify.forget(callback_id)
+                callback_id = None
+            # waiting server started
+            if protocol not in IN_PROCESS_PROTOCOLS:
+                self._await_trans_server_started(src_host, src_port,
+                                                 protocol, trans_port)
+        except Exception as e:
+            if callback_id:
+                notify.forget(callback_id)
+            LOG.error("Fillp transformer data error: %s", e)
+            raise exception.DownLoadDataError(error=e)
+
+        # 2. wait data transformer finish
+        try:
+            self._await_data_trans_status(src_host, src_port, protocol,
+                                          trans_port=trans_port,
+                                          callback_id=callback_id)
+        except Exception as e:
+            LOG.error("Await data transformer error: %s", unicode(e))
+            raise
+
+        # a restarted source reports finished without having sent it all
+        if protocol in IN_PROCESS_PROTOCOLS:
+            missing = self.agents.get(protocol).missing_bytes(trans_port)
+            if missing:
+                raise exception.DownLoadDataError(
+                    error="%s bytes missing on %s" % (missing, dev_disk))
+
+    def _verify_data(self, src_host, src_port, trans_ip, trans_port,
+                     src_disk, dev_disk, protocol, trans_options):
+        """Compare the Merkle trees of both ends, resending what differs."""
+        agent_driver = self.agents.get(protocol)
+        agent_client = agentclient.get_birdiegateway_client(src_host,
+                                                            src_port)
+        vservices = agent_client.vservices
+
+        def fetch(level, indexes):
+            rsp = vservices.get_transformer_tree(trans_ip, trans_port,
+                                                 protocol, level=level,
+                                                 indexes=indexes)
+            return [binascii.unhexlify(node) if node else None
+                    for node in rsp['nodes']]
+
+        for attempt in range(max(CONF.trans_verify_retries, 0) + 1):
+            remote = vservices.get_transformer_tree(trans_ip, trans_port,
+                                                    protocol)
+            ranges = agent_driver.compare_tree(trans_port, remote, fetch)
+            if not ranges:
+                LOG.debug("Data of %(des)s verified against %(src)s",
+                          {'des': dev_disk, 'src': src_disk})
+                vservices.get_transformer_tree(trans_ip, trans_port,
+                                               protocol, release=True)
+                return
+
+            if attempt >= CONF.trans_verify_retries:
+                break
+            LOG.warning("%(count)s ranges of %(des)s differ from "
+                        "%(src)s, sending them again",
+                        {'count': len(ranges), 'des': dev_disk,
+                         'src': src_disk})
+            options = dict(trans_options, ranges=ranges)
+            options.pop('resume', None)
+            self._fillp_send_data(src_host, src_port, trans_ip, trans_port,
+                                  src_disk, dev_disk, protocol, options)
+
+        raise exception.DownLoadDataError(
+            error="data of %(des)s differs from %(src)s" %
+                  {'des': dev_disk, 'src': src_disk})
+
+    def get_transformer_tree(self, trans_ip, trans_port, protocol,
+                             level=None, indexes=None, release=False):
+        """Merkle tree of the data sent to trans_ip:trans_port.
+
+        Without a level only the shape and the root are returned.
+        """
+        agent_driver = self.agents.get(protocol)
+        if protocol not in IN_PROCESS_PROTOCOLS or not agent_driver:
+            _msg = "Protocol %s does not verify data" % protocol
+            LOG.error(_msg)
+            raise exception.V2vException(message=_msg)
+        if release:
+            agent_driver.release_sender_tree(trans_ip, trans_port)
+            return {}
+
+        tree = agent_driver.get_sender_tree(trans_ip, trans_port)
+        if tree is None:
+            _msg = "No data was verified to %s:%s" % (trans_ip, trans_port)
+            LOG.error(_msg)
+            raise exception.V2vException(message=_msg)
+        if level is None:
+            return {'size': tree.size,
+                    'leaf_size': tree.leaf_size,
+                    'depth': tree.depth,
+                    'root': binascii.hexlify(tree.root()).decode()}
+        nodes = tree.nodes(int(level), [int(i) for i in indexes or []])
+        return {'nodes': [binascii.hexlify(node).decode() if node else None
+                          for node in nodes]}
+
+    def _count_resume(self, task_id):
+        task = self.trans_states.get_task(task_id)
+        if task:
+            task.resumes += 1
+            changes.changed(task)
+
     def start_transformer_data(self, trans_ip, trans_port, src_dev, des_dev,
-                               protocol='fillp'):
+                               protocol='fillp', options=None):
         agent_driver = self.agents.get(protocol)
 
         if not agent_driver:
@@ -423,16 +1135,40 @@ class MigrationManager(object):
             LOG.error(_msg)
             raise exception.V2vException(message=_msg)
 
+        options = dict(options or {})
+        agent_url = options.pop('callback_agent', None)
+        callback_id = options.pop('callback_id', None)
         try:
-            res = agent_driver.transformer_data(trans_ip, trans_port,
-                                                src_dev, des_dev, protocol)
-            return res
+            sender = agent_driver.transformer_data(trans_ip, trans_port,
+                                                   src_dev, des_dev,
+                                                   protocol,
+                                                   options=options)
         except Exception as e:
             _msg = "Conveyor agent transformer data error: %s" % e
             LOG.error(_msg)
             raise exception.V2vException(message=_msg)
 
-    def fillp_transformer_data_status(self, protocol):
+        if not (agent_url and callback_id):
+            return False
+        status_fn = None
+        if protocol not in IN_PROCESS_PROTOCOLS:
+            # the fillp process may outlive its thread
+            status_fn = functools.partial(self.fillp_transformer_data_status,
+                                          protocol, port=trans_port)
+        notify.watch(sender, status_fn, agent_url, callback_id)
+        return True
+
+    def transfer_done(self, callback_id, status, error=None):
+        """The source pushed the end of the transfer waited on with
+        callback_id.
+        """
+        if not callback_id or not utils.is_int_like(status):
+            msg = "Input transfer done error: %s, %s" % (callback_id, status)
+            raise exception.InvalidInput(reason=msg)
+        if not notify.deliver(callback_id, int(status), error=error):
+            LOG.debug("No transfer waits on callback %s", callback_id)
+
+    def fillp_transformer_data_status(self, protocol, port=None):
         agent_driver = self.agents.get(protocol)
         if not agent_driver:
             _msg = "Conveyor agent does not supprt: %s" % protocol
@@ -441,14 +1177,26 @@ class MigrationManager(object):
 
         try:
             service_name = protocol + '-client'
-            res = agent_driver.query_transformer_task_status(service_name)
+            res = agent_driver.query_transformer_task_status(service_name,
+                                                             port=port)
             return res
         except Exception as e:
             _msg = "Conveyor agent query transformer data status error: %s" % e
             LOG.error(_msg)
             raise exception.V2vException(message=_msg)
 
-    def _await_data_trans_status(selfself, host, port, protocol):
+    def fillp_transformer_process(self, protocol, port=None):
+        """Pid, exit code and end of stderr of the fillp client sending
+        to port, None if the agent runs no process for it.
+        """
+        agent_driver = self.agents.get(protocol)
+        query = getattr(agent_driver, 'query_transformer_process', None)
+        if query is None:
+            return None
+        return query(protocol + '-client', port=port)
+
+    def _await_data_trans_status(self, host, port, protocol,
+                                 trans_port=None, callback_id=None):
         retries = CONF.trans_retry_num
         if retries < 0:
             LOG.warning("Treating negative config value (%(retries)s) for "
@@ -458,43 +1206,74 @@ class MigrationManager(object):
         attempts = 1
         if retries >= 1:
             attempts = retries + 1
-        for attempts in range(1, attempts + 1):
-            cls = agentclient.get_birdiegateway_client(host, port)
-            status = cls.vservices.get_data_transformer_status(protocol)
-            task_status = status.get('status')
-            # if noe volume data transformer failed, thos clone failed
-            if 1 == task_status:
-                return attempts
-            elif 0 == task_status:
-                LOG.debug("Fillp data transformering, waiting...")
-            else:
-                _msg = 'Data transformer error: fillp cmd error.'
-                LOG.error(_msg)
-                raise exception.DownLoadDataError(error=_msg)
+        interval = CONF.trans_retry_interval
+        if callback_id:
+            # the source pushes the end, polls only make up for a lost
+            # push, within the same time
+            interval = max(CONF.trans_callback_poll_interval, interval, 1)
+            attempts = max(attempts * CONF.trans_retry_interval // interval,
+                           1)
+        try:
+            for attempts in range(1, attempts + 1):
+                if callback_id:
+                    pushed = notify.wait(callback_id, interval)
+                    if pushed is not None:
+                        task_status, error = pushed
+                        if notify.FINISHED == task_status:
+                            return attempts
+                        _msg = 'Data transformer error: %s' % error
+                        LOG.error(_msg)
+                        raise exception.DownLoadDataError(error=_msg)
+
+                cls = agentclient.get_birdiegateway_client(host, port)
+                status = cls.vservices.get_data_transformer_status(
+                    protocol, port=trans_port)
+                task_status = status.get('status')
+                # if noe volume data transformer failed, thos clone failed
+                if 1 == task_status:
+                    return attempts
+                elif 0 == task_status:
+                    LOG.debug("Fillp data transformering, waiting...")
+                else:
+                    _msg = ('Data transformer error: fillp cmd error. %s'
+                            % _process_error(status.get('process')))
+                    LOG.error(_msg)
+                    raise exception.DownLoadDataError(error=_msg)
 
-            greenthread.sleep(CONF.trans_retry_interval)
+                if not callback_id:
+                    greenthread.sleep(interval)
+        finally:
+            if callback_id:
+                notify.forget(callback_id)
 
         # NOTE(harlowja: Should only happen if we ran out of attempts
         raise exception.DownLoadDataError(error="Transformer data "
                                                 "time out")
 
-    def _await_trans_server_started(self, host, port, protocol):
+    def _await_trans_server_started(self, host, port, protocol,
+                                    trans_port=None):
         retries = 30
         attempts = 1
         if retries >= 1:
             attempts = retries + 1
         for attempts in range(1, attempts + 1):
             cls = agentclient.get_birdiegateway_client(host, port)
-            status = cls.vservices.get_data_transformer_status(protocol)
+            status = cls.vservices.get_data_transformer_status(
+                protocol, port=trans_port)
             task_status = status.get('status')
             # if noe volume data transformer failed, thos clone failed
             if 0 == task_status:
                 LOG.debug("Fillp server started.")
                 return attempts
+            elif 1 == task_status and trans_port and status.get('process'):
+                # the process of the port already ended well
+                LOG.debug("Fillp client to %s already ended.", trans_port)
+                return attempts
             elif 1 == task_status:
                 LOG.debug("Fillp server starting, waiting...")
             else:
-                _msg = 'Data transformer error: fillp cmd error.'
+                _msg = ('Data transformer error: fillp cmd error. %s'
+                        % _process_error(status.get('process')))
                 LOG.error(_msg)
                 raise exception.DownLoadDataError(error=_msg)
 
@@ -505,25 +1284,44 @@ class MigrationManager(object):
                                                 "start failed")
 
 
-class AgentThread(threading.Thread):
+class AgentTask(object):
+    """A task of the agent, run by a worker of the executor."""
 
     def __init__(self, fun, state_ops_cls, task_id, *args):
-        threading.Thread.__init__(self)
         self.fun = fun
         self.args = args
         self.trans_states = state_ops_cls
         self.task_id = task_id
 
-    def run(self):
-        args = self.args
-        if self.fun:
-            try:
-                self.fun(*args)
-                self.trans_states.update_state(self.task_id,
-                                               task_status.FINISHED)
-            except Exception as e:
-                self.trans_states.update_state(self.task_id, task_status.ERROR)
-                LOG.error("Conveyor agent operator %(ops)s error: %(error)s",
-                          {'ops': self.fun, 'error': e})
-                msg = "Operator %s error" % self.fun
-                raise exception.V2vException(message=msg)
+    def start(self, priority=None):
+        """Queue the task, which fails if the queue is full.
+
+        A task refused never started: its caller is told so, no end of it
+        is notified.
+        """
+        try:
+            return executor.get_executor().submit(self, priority=priority,
+                                                  name=self.task_id)
+        except exception.TransferQueueFull:
+            self.trans_states.update_state(self.task_id, task_status.ERROR)
+            throttle.release(self.task_id)
+            raise
+
+    def __call__(self):
+        try:
+            self.fun(*self.args)
+            self.trans_states.update_state(self.task_id,
+                                           task_status.FINISHED)
+        except Exception:
+            # logged by the executor
+            self.trans_states.update_state(self.task_id, task_status.ERROR)
+            raise
+        finally:
+            self._release()
+
+    def _release(self):
+        throttle.release(self.task_id)
+        scheduler.task_done(self.task_id)
+        task = self.trans_states.get_task(self.task_id)
+        if task:
+            notify.task_ended(task.id, task.task_state, task.callback_url)
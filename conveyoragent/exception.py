@@ -266,3 +266,14 @@ class ReadOnlyFieldError(V2vException):
 class DownLoadDataError(V2vException):
 
     msg_fmt = _('DownLoad data failed: %(error)s')
+
+
+class UpLoadDataError(V2vException):
+
+    message = _('UpLoad data failed: %(error)s')
+
+
+class TransferQueueFull(V2vException):
+
+    message = _('Transfer queue is full: %(size)s transfers waiting')
+    code = 429
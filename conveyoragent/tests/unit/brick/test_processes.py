@@ -0,0 +1,68 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+from oslo_concurrency import processutils as putils
+import testtools
+
+from conveyoragent.brick import base
+from conveyoragent.brick import processes
+
+
+class TestProcesses(testtools.TestCase):
+
+    def test_failed(self):
+        process = processes.start('test-client', 4001,
+                                  ['sh', '-c', 'echo no route >&2; exit 3'])
+        self.assertEqual(3, process.wait())
+        self.assertEqual(processes.FAILED,
+                         processes.status('test-client', '4001'))
+        info = processes.find('test-client', 4001).to_dict()
+        self.assertEqual(process.pid, info['pid'])
+        self.assertEqual('no route', info['stderr'])
+
+    def test_by_port(self):
+        running = processes.start('test-client', 4002, ['sleep', '5'])
+        self.addCleanup(running._proc.kill)
+        processes.start('test-client', 4003, ['true']).wait()
+        self.assertEqual(processes.RUNNING,
+                         processes.status('test-client', 4002))
+        self.assertEqual(processes.FINISHED,
+                         processes.status('test-client', 4003))
+        self.assertIs(running, processes.find('test-client'))
+        self.assertEqual(processes.FINISHED,
+                         processes.status('test-client', 4004))
+
+
+class TestTrackedCmd(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTrackedCmd, self).setUp()
+        self.execute = mock.Mock(return_value=('', ''))
+        self.cmd = base.MigrationCmd(None, execute=self.execute)
+
+    def test_error_has_stderr(self):
+        error = self.assertRaises(putils.ProcessExecutionError,
+                                  self.cmd._run_tracked, 'test-client', 4005,
+                                  'sh', '-c', 'echo refused >&2; exit 2')
+        self.assertEqual(2, error.exit_code)
+        self.assertEqual('refused', error.stderr)
+
+    def test_close_only_port(self):
+        running = processes.start('fillp-server', 4006, ['sleep', '5'])
+        self.addCleanup(running._proc.kill)
+
+        self.cmd.fillp_close_connect('server', 'fillp', port=4007)
+        self.assertFalse(self.execute.called)
+        self.cmd.fillp_close_connect('server', 'fillp', port=4006)
+        self.assertEqual(('fillp', 'close', 'server', '-o', 'fillp', '-i',
+                          running.pid), self.execute.call_args[0])
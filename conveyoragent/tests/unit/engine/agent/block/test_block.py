@@ -0,0 +1,336 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from conveyoragent.common import config
+from conveyoragent.engine.agent.block import block
+from conveyoragent.engine.common import compression
+
+CONF = config.CONF
+
+
+class TestBlockAgent(testtools.TestCase):
+
+    def setUp(self):
+        super(TestBlockAgent, self).setUp()
+        CONF.set_override('block_chunk_size', 64 * 1024)
+        self.addCleanup(CONF.clear_override, 'block_chunk_size')
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        CONF.set_override('block_dedup_index_path',
+                          os.path.join(self.tmpdir, 'chunk_index'))
+        self.addCleanup(CONF.clear_override, 'block_dedup_index_path')
+        self.agent = block.BlockAgent()
+        self.addCleanup(self.agent.stop_fillp_server, 'server', 'block')
+
+    def _make_devices(self, data):
+        src = os.path.join(self.tmpdir, 'src')
+        des = os.path.join(self.tmpdir, 'des')
+        with open(src, 'wb') as f:
+            f.write(data)
+        with open(des, 'wb') as f:
+            f.truncate(len(data))
+        return src, des
+
+    def _make_sparse_devices(self, size, fill):
+        src = os.path.join(self.tmpdir, 'src')
+        des = os.path.join(self.tmpdir, 'des')
+        data = bytearray(size)
+        with open(src, 'wb') as f:
+            f.truncate(size)
+            for offset in (0, size // 2):
+                chunk = os.urandom(8192)
+                f.seek(offset)
+                f.write(chunk)
+                data[offset:offset + len(chunk)] = chunk
+            # allocated but zero
+            f.seek(size // 4)
+            f.write(b'\0' * 128 * 1024)
+        with open(des, 'wb') as f:
+            f.write(fill * size)
+        return src, des, bytes(data)
+
+    def _transfer(self, src, des, server_options=None, **options):
+        receiver = self.agent.start_fillp_server('127.0.0.1', 0, des,
+                                                 'block',
+                                                 options=server_options)
+        sender = self.agent.transformer_data('127.0.0.1', receiver.port,
+                                             src, des, 'block',
+                                             options=options)
+        sender.join(30)
+        return sender
+
+    def test_transfer(self):
+        data = os.urandom(300 * 1024 + 123)
+        src, des = self._make_devices(data)
+
+        sender = self._transfer(src, des)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(block.STATUS_FINISHED,
+                         self.agent.query_transformer_task_status(
+                             'block-client'))
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    @mock.patch.object(block.time, 'sleep')
+    def test_transfer_receiver_error(self, mock_sleep):
+        src, des = self._make_devices(os.urandom(1024))
+        os.remove(des)
+
+        sender = self._transfer(src, des)
+
+        self.assertEqual(block.STATUS_ERROR, sender.state)
+        self.assertEqual(block.STATUS_ERROR,
+                         self.agent.query_transformer_task_status(
+                             'block-client'))
+
+    def test_transfer_sparse(self):
+        src, des, data = self._make_sparse_devices(1024 * 1024, b'x')
+
+        sender = self._transfer(src, des)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertLess(sender.bytes_sent, len(data) // 4)
+        self.assertEqual(len(data),
+                         sender.bytes_sent + sender.bytes_skipped)
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_transfer_sparse_fresh_device(self):
+        src, des, data = self._make_sparse_devices(1024 * 1024, b'\0')
+
+        with mock.patch.object(block.sparse, 'zero_range') as zero_range:
+            sender = self._transfer(src, des,
+                                    server_options={'des_dev_fresh': True})
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertFalse(zero_range.called)
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_transfer_multi_stream(self):
+        data = os.urandom(1024 * 1024 + 4096)
+        src, des = self._make_devices(data)
+
+        sender = self._transfer(src, des, stream_count=4)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(4, len(sender.streams))
+        self.assertEqual(len(data), sender.streams[-1].range_end)
+        for stream in sender.streams:
+            self.assertEqual(stream.range_end, stream.committed)
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    @mock.patch.object(block.time, 'sleep')
+    def test_transfer_retry_failed_stream(self, mock_sleep):
+        CONF.set_override('block_sync_interval', 64 * 1024)
+        self.addCleanup(CONF.clear_override, 'block_sync_interval')
+        data = os.urandom(1024 * 1024)
+        src, des = self._make_devices(data)
+        send_ranges = block.RangeStream._send_ranges
+
+        def _send_ranges(stream, sock, src, start, end):
+            if stream.index == 1 and stream.attempts == 1:
+                send_ranges(stream, sock, src, start, start + 128 * 1024)
+                # wait for the acknowledgement of the synced part
+                while stream.committed < start + 64 * 1024:
+                    stream._read_acks(sock)
+                raise IOError("connection reset")
+            return send_ranges(stream, sock, src, start, end)
+
+        with mock.patch.object(block.RangeStream, '_send_ranges',
+                               _send_ranges):
+            sender = self._transfer(src, des, stream_count=2)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual([1, 2], [s.attempts for s in sender.streams])
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_transfer_compressed(self):
+        # compressible chunks interleaved with random ones
+        data = b''.join(os.urandom(32 * 1024) + b'conveyor' * 4096
+                        for _i in range(8))
+        src, des = self._make_devices(data)
+        stats = compression.CompressionStats(compression.ZLIB)
+
+        sender = self._transfer(src, des,
+                                server_options={'compression_stats': stats},
+                                compression=compression.ZLIB)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+        result = stats.to_dict()
+        self.assertEqual(len(data), result['raw_bytes'])
+        self.assertEqual(sender.bytes_sent, result['wire_bytes'])
+        self.assertLess(result['ratio'], 0.75)
+        self.assertGreater(result['compress_cpu_time'], 0)
+
+    def test_transfer_dedup(self):
+        base = os.urandom(512 * 1024)
+        data = base + os.urandom(128 * 1024)
+        src, des = self._make_devices(data)
+        # an earlier volume of the same migration holding the base image
+        other_src = os.path.join(self.tmpdir, 'other_src')
+        other_des = os.path.join(self.tmpdir, 'other_des')
+        with open(other_src, 'wb') as f:
+            f.write(base)
+        with open(other_des, 'wb') as f:
+            f.truncate(len(base))
+
+        sender = self._transfer(other_src, other_des, dedup=True)
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(0, sender.bytes_deduped)
+        self.agent.stop_fillp_server('server', 'block')
+
+        # a new agent run only knows the saved index
+        self.agent = block.BlockAgent()
+        self.addCleanup(self.agent.stop_fillp_server, 'server', 'block')
+        sender = self._transfer(src, des, stream_count=2, dedup=True)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(len(base), sender.bytes_deduped)
+        self.assertEqual(len(data) - len(base), sender.bytes_sent)
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_transfer_dedup_stale_location(self):
+        data = os.urandom(256 * 1024)
+        src, des = self._make_devices(data)
+        other_des = os.path.join(self.tmpdir, 'other_des')
+        with open(other_des, 'wb') as f:
+            f.write(data)
+        index = self.agent._get_chunk_index()
+        chunk = block.chunk_size()
+        for offset in range(0, len(data), chunk):
+            index.add(block.chunk_index.digest(data[offset:offset + chunk]),
+                      other_des, offset, chunk)
+        # rewritten since it was indexed
+        with open(other_des, 'r+b') as f:
+            f.write(b'x' * chunk)
+
+        sender = self._transfer(src, des, dedup=True)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(len(data) - chunk, sender.bytes_deduped)
+        self.assertEqual(chunk, sender.bytes_sent)
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_transfer_delta(self):
+        chunk = block.chunk_size()
+        old = os.urandom(16 * chunk + 100)
+        data = bytearray(old)
+        data[3 * chunk + 10:3 * chunk + 20] = os.urandom(10)
+        data[9 * chunk:10 * chunk] = b'\0' * chunk
+        data[-1:] = b'z'
+        data = bytes(data)
+        src, des = self._make_devices(data)
+        with open(des, 'wb') as f:
+            f.write(old)
+
+        sender = self._transfer(src, des, stream_count=2, delta=True)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(chunk + 100, sender.bytes_sent)
+        self.assertEqual(chunk, sender.bytes_skipped)
+        self.assertEqual(14 * chunk, sender.bytes_matched)
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    @mock.patch.object(block.time, 'sleep')
+    def test_transfer_resume(self, mock_sleep):
+        CONF.set_override('block_sync_interval', 64 * 1024)
+        self.addCleanup(CONF.clear_override, 'block_sync_interval')
+        CONF.set_override('block_stream_retries', 0)
+        self.addCleanup(CONF.clear_override, 'block_stream_retries')
+        CONF.set_override('block_checkpoint_dir', self.tmpdir)
+        self.addCleanup(CONF.clear_override, 'block_checkpoint_dir')
+        data = os.urandom(1024 * 1024)
+        src, des = self._make_devices(data)
+        send_ranges = block.RangeStream._send_ranges
+
+        def _send_ranges(stream, sock, src, start, end):
+            send_ranges(stream, sock, src, start, start + 256 * 1024)
+            while stream.committed < start + 256 * 1024:
+                stream._read_acks(sock)
+            raise IOError("connection reset")
+
+        options = {'checkpoint': 'task'}
+        with mock.patch.object(block.RangeStream, '_send_ranges',
+                               _send_ranges):
+            sender = self._transfer(src, des, server_options=options)
+        self.assertEqual(block.STATUS_ERROR, sender.state)
+        receiver = list(self.agent._receivers.values())[0]
+        self.assertEqual(len(data) - 256 * 1024,
+                         self.agent.missing_bytes(receiver.port))
+        self.agent.stop_fillp_server('server', 'block')
+
+        # as if the agent was restarted
+        self.agent = block.BlockAgent()
+        self.addCleanup(self.agent.stop_fillp_server, 'server', 'block')
+        sender = self._transfer(src, des, server_options=options,
+                                resume=True)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(len(data) - 256 * 1024, sender.bytes_sent)
+        receiver = list(self.agent._receivers.values())[0]
+        self.assertEqual(0, self.agent.missing_bytes(receiver.port))
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    def test_transfer_verify(self):
+        chunk = block.chunk_size()
+        CONF.set_override('block_verify_leaf_size', chunk)
+        self.addCleanup(CONF.clear_override, 'block_verify_leaf_size')
+        src, des, data = self._make_sparse_devices(8 * chunk, b'x')
+        options = {'verify': True}
+
+        sender = self._transfer(src, des, server_options=options,
+                                stream_count=2, verify=True)
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        receiver = list(self.agent._receivers.values())[0]
+        source = self.agent.get_sender_tree('127.0.0.1', receiver.port)
+        remote = {'size': source.size, 'leaf_size': source.leaf_size}
+        self.assertEqual(
+            [], self.agent.compare_tree(receiver.port, remote, source.nodes))
+
+        # corrupted behind the transfer's back, the tree is read back
+        with open(des, 'r+b') as f:
+            f.seek(5 * chunk + 7)
+            f.write(b'corrupt')
+        receiver.tree.leaves[5] = None
+        ranges = self.agent.compare_tree(receiver.port, remote,
+                                         source.nodes)
+        self.assertEqual([[5 * chunk, chunk]], ranges)
+
+        sender = self.agent.transformer_data('127.0.0.1', receiver.port,
+                                             src, des, 'block',
+                                             options={'verify': True,
+                                                      'ranges': ranges})
+        sender.join(30)
+
+        self.assertEqual(block.STATUS_FINISHED, sender.state)
+        self.assertEqual(chunk, sender.bytes_sent + sender.bytes_skipped)
+        self.assertEqual(
+            [], self.agent.compare_tree(receiver.port, remote, source.nodes))
+        with open(des, 'rb') as f:
+            self.assertEqual(data, f.read())
@@ -0,0 +1,65 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+
+import testtools
+
+from conveyoragent.engine.agent.block import checkpoint
+
+
+class TestCheckpoint(testtools.TestCase):
+
+    def setUp(self):
+        super(TestCheckpoint, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'task.bitmap')
+
+    def _checkpoint(self, size, granularity=10):
+        bitmap = checkpoint.Checkpoint(self.path)
+        bitmap.prepare(size, granularity)
+        self.addCleanup(bitmap.close)
+        return bitmap
+
+    def test_mark_whole_chunks_only(self):
+        bitmap = self._checkpoint(205)
+
+        bitmap.mark(5, 40)
+        bitmap.mark(95, 205)
+
+        self.assertEqual([(0, 10), (40, 60)], bitmap.missing(0, 205))
+        self.assertEqual([(42, 58)], bitmap.missing(42, 100))
+        self.assertEqual(70, bitmap.missing_bytes())
+
+    def test_resume_from_file(self):
+        bitmap = self._checkpoint(1000)
+        bitmap.mark(0, 500)
+        bitmap.mark(990, 1000)
+        bitmap.close()
+
+        # the granularity of the file wins
+        resumed = self._checkpoint(1000, granularity=64)
+
+        self.assertEqual(10, resumed.granularity)
+        self.assertEqual([(500, 490)], resumed.missing(0, 1000))
+
+    def test_other_size_starts_over(self):
+        bitmap = self._checkpoint(1000)
+        bitmap.mark(0, 1000)
+        bitmap.close()
+
+        resumed = self._checkpoint(2000)
+
+        self.assertEqual(2000, resumed.missing_bytes())
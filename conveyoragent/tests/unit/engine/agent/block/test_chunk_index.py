@@ -0,0 +1,64 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+
+import testtools
+
+from conveyoragent.engine.agent.block import chunk_index
+
+
+class TestChunkIndex(testtools.TestCase):
+
+    def setUp(self):
+        super(TestChunkIndex, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'state', 'chunk_index')
+
+    def test_evict_least_recently_used(self):
+        index = chunk_index.ChunkIndex(max_entries=2)
+        index.add(b'a', '/dev/vdb', 0, 4096)
+        index.add(b'b', '/dev/vdb', 4096, 4096)
+        index.lookup(b'a')
+        index.add(b'c', '/dev/vdc', 0, 4096)
+
+        self.assertEqual(2, len(index))
+        self.assertIsNone(index.lookup(b'b'))
+        self.assertEqual(('/dev/vdb', 0, 4096), index.lookup(b'a'))
+
+    def test_save_and_load(self):
+        index = chunk_index.ChunkIndex(max_entries=10, path=self.path)
+        keys = [chunk_index.digest(str(i).encode()) for i in range(3)]
+        for i, key in enumerate(keys):
+            index.add(key, '/dev/vd%s' % 'bcb'[i], i * 4096, 4096)
+        index.save()
+
+        loaded = chunk_index.ChunkIndex(max_entries=2, path=self.path)
+        loaded.load()
+
+        # the most recently used entries are kept
+        self.assertEqual(2, len(loaded))
+        self.assertIsNone(loaded.lookup(keys[0]))
+        self.assertEqual(('/dev/vdb', 8192, 4096), loaded.lookup(keys[2]))
+
+    def test_load_corrupt(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'garbage')
+        index = chunk_index.ChunkIndex(path=self.path)
+
+        index.load()
+
+        self.assertEqual(0, len(index))
@@ -0,0 +1,70 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import hashlib
+import os
+import tempfile
+
+import testtools
+
+from conveyoragent.engine.agent.block import merkle
+
+
+class TestMerkleTree(testtools.TestCase):
+
+    def _tree(self, data, leaf_size=100):
+        tree = merkle.MerkleTree(len(data), leaf_size)
+        tree.feed(0, data)
+        return tree
+
+    def test_pieces_in_any_order(self):
+        data = os.urandom(150) + b'\0' * 200 + os.urandom(30)
+        tree = merkle.MerkleTree(len(data), 100)
+
+        tree.feed(350, data[350:])
+        tree.feed_zero(150, 200)
+        tree.feed(40, data[40:150])
+        tree.feed(0, data[:40])
+
+        self.assertEqual(self._tree(data).root(), tree.root())
+        self.assertEqual(hashlib.sha256(data[:100]).digest(),
+                         tree.leaves[0])
+        self.assertEqual(2, tree.depth)
+
+    def test_differing_leaves(self):
+        data = os.urandom(1000)
+        other = bytearray(data)
+        other[250] ^= 1
+        other[999] ^= 1
+        ours = self._tree(data)
+        theirs = self._tree(bytes(other))
+        fetched = []
+
+        def fetch(level, indexes):
+            fetched.append(level)
+            return theirs.nodes(level, indexes)
+
+        self.assertEqual([2, 9], merkle.differing_leaves(ours, fetch))
+        self.assertEqual([4, 3, 2, 1, 0], fetched)
+        self.assertEqual([], merkle.differing_leaves(ours, ours.nodes))
+
+    def test_read_unknown(self):
+        data = os.urandom(250)
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            tree = merkle.MerkleTree(len(data), 100)
+            tree.feed(100, data[100:200])
+
+            self.assertEqual(2, tree.read_unknown(f.name))
+
+        self.assertEqual(self._tree(data).root(), tree.root())
@@ -0,0 +1,215 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In memory ftp server standing in for ftplib.FTP."""
+
+import posixpath
+import threading
+
+from conveyoragent.engine.agent.ftp import ftplib
+
+
+class FakeFTP(object):
+    """Sessions of a server whose files are FakeFTP.files.
+
+    files maps absolute paths to their content, directories to None.
+    """
+
+    files = {}
+    connects = 0
+    # (host, port) of each connect
+    dialled = []
+    retrieved = []
+    listed = []
+    mlsd = True
+    # modification times of files, YYYYMMDDHHMMSS
+    mtimes = {}
+    # most MKD commands sent ahead of their replies
+    in_flight = 0
+    lock = threading.Lock()
+
+    @classmethod
+    def reset(cls, files, mlsd=True):
+        cls.files = dict(files)
+        cls.files.setdefault('/', None)
+        cls.connects = 0
+        cls.dialled = []
+        cls.retrieved = []
+        cls.listed = []
+        cls.mlsd = mlsd
+        cls.in_flight = 0
+        cls.mtimes = {}
+
+    def __init__(self):
+        self.cwd_path = '/'
+        self.conn = None
+        self.sent = []
+
+    def connect(self, host, port, timeout):
+        with FakeFTP.lock:
+            FakeFTP.connects += 1
+            FakeFTP.dialled.append((host, port))
+
+    def login(self, user, passwd):
+        pass
+
+    def set_pasv(self, pasv):
+        pass
+
+    def voidcmd(self, cmd):
+        return '200 OK'
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def _path(self, path):
+        return posixpath.normpath(posixpath.join(self.cwd_path, path))
+
+    def pwd(self):
+        return self.cwd_path
+
+    def cwd(self, path):
+        path = self._path(path)
+        if path not in self.files or self.files[path] is not None:
+            raise ftplib.error_perm('550 %s: no such directory' % path)
+        self.cwd_path = path
+
+    def _children(self, path):
+        return sorted(name for name in self.files
+                      if name != path and posixpath.dirname(name) == path)
+
+    def nlst(self, *args):
+        return [posixpath.basename(name)
+                for name in self._children(self.cwd_path)]
+
+    def retrlines(self, cmd, callback):
+        if cmd == 'MLSD' and not self.mlsd:
+            raise ftplib.error_perm('500 Unknown command')
+        with FakeFTP.lock:
+            FakeFTP.listed.append((cmd, self.cwd_path))
+        for name in self._children(self.cwd_path):
+            data = self.files[name]
+            base = posixpath.basename(name)
+            if cmd == 'MLSD':
+                callback('type=%s;size=%d;modify=%s; %s' %
+                         ('dir' if data is None else 'file',
+                          len(data or ''), self._mtime(name), base))
+            else:
+                callback('%srw-r--r-- 1 root root %d Jan 01 2020 %s' %
+                         ('d' if data is None else '-', len(data or ''),
+                          base))
+
+    def size(self, path):
+        data = self.files.get(self._path(path))
+        if data is None:
+            raise ftplib.error_perm('550 not a file')
+        return len(data)
+
+    def retrbinary(self, cmd, callback, blocksize=8192, rest=None,
+                   buf=None):
+        path = self._path(cmd.split(' ', 1)[1])
+        data = self.files.get(path)
+        if data is None:
+            raise ftplib.error_perm('550 %s: no such file' % path)
+        with FakeFTP.lock:
+            FakeFTP.retrieved.append((path, rest) if rest else path)
+        data = data[rest or 0:]
+        for pos in range(0, len(data), blocksize):
+            callback(data[pos:pos + blocksize])
+        return '226 Transfer complete'
+
+    def sendcmd(self, cmd):
+        verb, path = cmd.split(' ', 1)
+        assert verb == 'MDTM', verb
+        if self.files.get(self._path(path)) is None:
+            raise ftplib.error_perm('550 not a file')
+        return '213 ' + self._mtime(self._path(path))
+
+    def _mtime(self, path):
+        return FakeFTP.mtimes.get(path, '20200101000000')
+
+    def mkd(self, path):
+        path = self._path(path)
+        with FakeFTP.lock:
+            if path in self.files:
+                raise ftplib.error_perm('550 %s: file exists' % path)
+            if self.files.get(posixpath.dirname(path), '') is not None:
+                raise ftplib.error_perm('550 %s: no such directory' %
+                                        posixpath.dirname(path))
+            self.files[path] = None
+        return path
+
+    def putcmd(self, line):
+        self.sent.append(line)
+
+    def getresp(self):
+        """Reply to the oldest command sent with putcmd."""
+        with FakeFTP.lock:
+            FakeFTP.in_flight = max(FakeFTP.in_flight, len(self.sent))
+        cmd, arg = self.sent.pop(0).split(' ', 1)
+        assert cmd == 'MKD', cmd
+        return '257 "%s" created' % self.mkd(arg)
+
+    def storbinary(self, cmd, fp, blocksize=8192, callback=None):
+        path = self._path(cmd.split(' ', 1)[1])
+        if self.files.get(posixpath.dirname(path), '') is not None:
+            raise ftplib.error_perm('553 %s: no such directory' % path)
+        chunks = []
+        while True:
+            buf = fp.read(blocksize)
+            if not buf:
+                break
+            chunks.append(buf)
+            if callback:
+                callback(buf)
+        with FakeFTP.lock:
+            self.files[path] = b''.join(chunks)
+        return '226 Transfer complete'
+
+    def transfercmd(self, cmd, rest=None):
+        path = self._path(cmd.split(' ', 1)[1])
+        data = self.files.get(path)
+        if data is None:
+            raise ftplib.error_perm('550 %s: no such file' % path)
+        with FakeFTP.lock:
+            FakeFTP.retrieved.append((path, rest or 0))
+        self.conn = FakeConnection(data[rest or 0:])
+        return self.conn
+
+    def voidresp(self):
+        conn, self.conn = self.conn, None
+        if conn is not None and conn.pos < len(conn.data):
+            raise ftplib.error_temp('426 Connection closed; transfer '
+                                    'aborted')
+        return '226 Transfer complete'
+
+
+class FakeConnection(object):
+    """Data connection sending data in small pieces."""
+
+    def __init__(self, data, piece=700):
+        self.data = data
+        self.pos = 0
+        self.piece = piece
+        self.closed = False
+
+    def recv_into(self, view):
+        n = min(len(view), self.piece, len(self.data) - self.pos)
+        view[:n] = self.data[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,149 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import io
+import os
+import shutil
+import socket
+import stat
+import tarfile
+import tempfile
+
+import testtools
+
+from conveyoragent.engine.agent.ftp import bundle
+from conveyoragent import exception
+
+
+class TestBundle(testtools.TestCase):
+
+    def setUp(self):
+        super(TestBundle, self).setUp()
+        self.src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.src)
+        self.dst = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dst)
+        self.receiver = bundle.Receiver(self.dst)
+        self.port = self.receiver.start(host='127.0.0.1')
+
+    def _write(self, rel, data, mode=0o644, mtime=1500000000):
+        path = os.path.join(self.src, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, mode)
+        os.utime(path, (mtime, mtime))
+
+    def _send_raw(self, members, token=None):
+        """Send a tar stream of members (name, data), no trailer.
+
+        A member whose data is a tuple is a link to the path in it.
+        token is the first line sent, the one of the receiver by default.
+        """
+        out = io.BytesIO()
+        tar = tarfile.open(fileobj=out, mode='w|')
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            if isinstance(data, tuple):
+                info.type = tarfile.SYMTYPE
+                info.linkname = data[0]
+                tar.addfile(info)
+                continue
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        tar.close()
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        sock.sendall(token or self.receiver.token.encode('ascii') + b'\n')
+        # cut short before the end blocks
+        sock.sendall(out.getvalue()[:-1024])
+        sock.close()
+
+    def test_send(self):
+        self._write('etc/hosts', b'127.0.0.1 localhost\n')
+        self._write('etc/shadow', b'root:x:\n', mode=0o600)
+        self._write('var/image', b'x' * 1000)
+        os.symlink('hosts', os.path.join(self.src, 'etc', 'link'))
+        os.chmod(os.path.join(self.src, 'etc'), 0o750)
+        os.utime(os.path.join(self.src, 'etc'), (1400000000, 1400000000))
+
+        counts = bundle.send('127.0.0.1', self.port, self.src,
+                             self.receiver.token, max_size=100)
+        self.receiver.wait()
+
+        self.assertEqual({'files': 3, 'bytes': 28}, counts)
+        with open(os.path.join(self.dst, 'etc', 'hosts'), 'rb') as f:
+            self.assertEqual(b'127.0.0.1 localhost\n', f.read())
+        shadow = os.stat(os.path.join(self.dst, 'etc', 'shadow'))
+        self.assertEqual(0o600, stat.S_IMODE(shadow.st_mode))
+        self.assertEqual(1500000000, shadow.st_mtime)
+        etc = os.stat(os.path.join(self.dst, 'etc'))
+        self.assertEqual(0o750, stat.S_IMODE(etc.st_mode))
+        self.assertEqual(1400000000, etc.st_mtime)
+        self.assertEqual('hosts',
+                         os.readlink(os.path.join(self.dst, 'etc', 'link')))
+        self.assertTrue(os.path.isdir(os.path.join(self.dst, 'var')))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'var',
+                                                     'image')))
+        self.assertEqual(set(os.path.join(self.dst, 'etc', name)
+                             for name in ('hosts', 'shadow', 'link')),
+                         self.receiver.extracted)
+
+    def test_cut_short(self):
+        self._send_raw([('a', b'a' * 10), ('b', b'b' * 10)])
+
+        self.assertRaises(exception.DownLoadDataError, self.receiver.wait)
+        self.assertEqual(set([os.path.join(self.dst, 'a'),
+                              os.path.join(self.dst, 'b')]),
+                         self.receiver.extracted)
+
+    def test_out_of_root(self):
+        self._send_raw([('a', b'a'), ('../evil', b'evil')])
+
+        self.assertRaises(exception.DownLoadDataError, self.receiver.wait)
+        self.assertFalse(os.path.exists(os.path.join(self.dst, os.pardir,
+                                                     'evil')))
+
+    def test_bad_token(self):
+        self._send_raw([('a', b'a')], token=b'0' * 32 + b'\n')
+        self._write('b', b'b')
+        bundle.send('127.0.0.1', self.port, self.src, self.receiver.token)
+        self.receiver.wait()
+
+        # only the source knowing the token was heard
+        self.assertEqual(set([os.path.join(self.dst, 'b')]),
+                         self.receiver.extracted)
+
+    def test_write_through_link(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        pwned = os.path.join(outside, 'pwned')
+        self._send_raw([('a', (pwned,)), ('a', b'evil'), ('b', b'b')])
+
+        self.assertRaises(exception.DownLoadDataError, self.receiver.wait)
+        self.assertFalse(os.path.exists(pwned))
+        # the file replaced the link
+        self.assertFalse(os.path.islink(os.path.join(self.dst, 'a')))
+        with open(os.path.join(self.dst, 'a'), 'rb') as f:
+            self.assertEqual(b'evil', f.read())
+
+    def test_out_of_root_through_link(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        os.mkdir(os.path.join(outside, 'x'))
+        self._send_raw([('x', (os.path.join(outside, 'x'),)),
+                        ('x/../b', b'evil'), ('c', b'c')])
+
+        self.assertRaises(exception.DownLoadDataError, self.receiver.wait)
+        self.assertEqual([], os.listdir(os.path.join(outside, 'x')))
+        self.assertEqual(['x'], os.listdir(outside))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'c')))
@@ -0,0 +1,81 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+
+from eventlet.green import socket as green_socket
+import mock
+from oslo_config import cfg
+import testtools
+
+from conveyoragent.engine.agent.ftp import ftp
+from conveyoragent.engine.agent.ftp import ftplib
+from conveyoragent.engine.agent.ftp import green
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.tests.unit.engine.agent.ftp import fakes
+
+CONF = cfg.CONF
+
+
+class TestGreen(testtools.TestCase):
+
+    def setUp(self):
+        super(TestGreen, self).setUp()
+        CONF.set_override('ftp_client', green.GREEN)
+        self.addCleanup(CONF.clear_override, 'ftp_client')
+
+    def test_ftplib_module(self):
+        module = green.ftplib_module()
+        self.assertIs(green_socket, module.socket)
+        # errors of the copy are caught as the ones of ftplib
+        self.assertIs(ftplib.error_perm, module.error_perm)
+        self.assertIs(ftplib.all_errors, module.all_errors)
+        CONF.set_override('ftp_client', green.THREAD)
+        self.assertIs(ftplib, green.ftplib_module())
+
+    def test_download_tree_in_green_threads(self):
+        patchers = [mock.patch.object(pool.ftplib, 'FTP', fakes.FakeFTP),
+                    mock.patch.object(pool, '_pool', None),
+                    mock.patch.object(green, 'ftplib_module',
+                                      return_value=pool.ftplib)]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        CONF.set_override('ftp_pool_max_per_host', 2)
+        self.addCleanup(CONF.clear_override, 'ftp_pool_max_per_host')
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fakes.FakeFTP.reset({
+            '/data': None,
+            '/data/a': b'a' * 10,
+            '/data/b': b'b' * 20,
+            '/data/c': b'c' * 30,
+        })
+        agent = ftp.FtpAgent(host='src', port=21)
+        threads = set()
+        download = agent._downLoadFile
+
+        def record_thread(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return download(*args, **kwargs)
+
+        with mock.patch.object(agent, '_downLoadFile', record_thread):
+            # more workers than sessions: they wait for each other
+            agent.downLoadDirTree('src', 21, tmpdir, 'data', workers=3)
+
+        for name, size in (('a', 10), ('b', 20), ('c', 30)):
+            with open(os.path.join(tmpdir, name), 'rb') as f:
+                self.assertEqual(name.encode('ascii') * size, f.read())
+        self.assertEqual(set([threading.current_thread()]), threads)
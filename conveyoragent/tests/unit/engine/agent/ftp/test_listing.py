@@ -0,0 +1,68 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import calendar
+
+import testtools
+
+from conveyoragent.engine.agent.ftp import listing
+from conveyoragent.tests.unit.engine.agent.ftp import fakes
+
+
+class TestListing(testtools.TestCase):
+
+    def test_parse_mlsd(self):
+        self.assertEqual(
+            listing.Entry('a file', listing.FILE, 1234,
+                          calendar.timegm((2020, 1, 2, 3, 4, 5))),
+            listing.parse_mlsd_line(
+                'type=file;size=1234;modify=20200102030405.123; a file'))
+        self.assertEqual(listing.DIR, listing.parse_mlsd_line(
+            'Type=dir;Modify=20200102030405; sub').type)
+        self.assertIsNone(listing.parse_mlsd_line('type=cdir; .'))
+
+    def test_parse_list(self):
+        now = calendar.timegm((2020, 3, 1, 0, 0, 0))
+        entry = listing.parse_list_line(
+            '-rw-r--r--   1 root  root   4096 Feb 29 12:30 my file', now)
+        self.assertEqual(listing.Entry('my file', listing.FILE, 4096,
+                                       calendar.timegm((2020, 2, 29, 12, 30,
+                                                        0))), entry)
+        # a date later than now is from the year before
+        entry = listing.parse_list_line(
+            'drwxr-xr-x 2 1000 4096 Dec 24 08:00 sub', now)
+        self.assertEqual(listing.DIR, entry.type)
+        self.assertEqual(calendar.timegm((2019, 12, 24, 8, 0, 0)),
+                         entry.mtime)
+        entry = listing.parse_list_line(
+            'lrwxrwxrwx 1 root root 7 Jan 01 2019 link -> target', now)
+        self.assertEqual(('link', listing.LINK), entry[:2])
+        entry = listing.parse_list_line(
+            '01-31-20  09:15PM       <DIR>          Program Files', now)
+        self.assertEqual(listing.Entry('Program Files', listing.DIR, 0,
+                                       calendar.timegm((2020, 1, 31, 21, 15,
+                                                        0))), entry)
+        self.assertIsNone(listing.parse_list_line('total 8', now))
+
+    def test_lister_falls_back_to_list_and_caches(self):
+        for mlsd in (True, False):
+            fakes.FakeFTP.reset({'/d': None, '/d/f': b'abc', '/d/s': None},
+                                mlsd=mlsd)
+            lister = listing.Lister(fakes.FakeFTP())
+
+            entries = lister.list('/d')
+            lister.list('/d')
+
+            self.assertEqual([('f', listing.FILE, 3), ('s', listing.DIR, 0)],
+                             [entry[:3] for entry in entries])
+            self.assertEqual(mlsd, lister.mlsd)
+            self.assertEqual(1, len(fakes.FakeFTP.listed))
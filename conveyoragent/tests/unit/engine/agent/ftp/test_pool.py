@@ -0,0 +1,119 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+import mock
+import testtools
+
+from conveyoragent.common import config
+from conveyoragent.engine.agent.ftp import ftplib
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent import exception
+
+CONF = config.CONF
+
+
+class FakeFTP(object):
+
+    connects = 0
+
+    def __init__(self):
+        self.alive = True
+        self.cwd_calls = []
+        self.closed = False
+
+    def connect(self, host, port, timeout):
+        FakeFTP.connects += 1
+
+    def login(self, user, passwd):
+        pass
+
+    def pwd(self):
+        return '/home'
+
+    def cwd(self, path):
+        self.cwd_calls.append(path)
+
+    def set_pasv(self, pasv):
+        pass
+
+    def voidcmd(self, cmd):
+        if not self.alive:
+            raise ftplib.error_temp('421 timeout')
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class TestSessionPool(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSessionPool, self).setUp()
+        FakeFTP.connects = 0
+        patcher = mock.patch.object(pool.ftplib, 'FTP', FakeFTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = pool.SessionPool(max_per_host=1, idle_timeout=60)
+
+    def test_reuse(self):
+        session = self.pool.acquire('host', 21, 'user', 'pw')
+        self.pool.release(session)
+        again = self.pool.acquire('host', '21', 'user', 'pw')
+
+        self.assertIs(session, again)
+        self.assertEqual(1, FakeFTP.connects)
+
+    def test_dead_and_broken_sessions_replaced(self):
+        session = self.pool.acquire('host', 21, 'user', 'pw')
+        session.ftp.alive = False
+        self.pool.release(session)
+        again = self.pool.acquire('host', 21, 'user', 'pw')
+        self.pool.release(again, broken=True)
+        third = self.pool.acquire('host', 21, 'user', 'pw')
+
+        self.assertTrue(session.ftp.closed)
+        self.assertTrue(again.ftp.closed)
+        self.assertEqual(3, FakeFTP.connects)
+        self.assertIsNot(again, third)
+
+    def test_idle_eviction(self):
+        session = self.pool.acquire('host', 21, 'user', 'pw')
+        self.pool.release(session)
+        session.last_used -= 61
+        self.pool.acquire('host', 21, 'user', 'pw')
+
+        self.assertTrue(session.ftp.closed)
+        self.assertEqual(2, FakeFTP.connects)
+
+    def test_max_per_host(self):
+        CONF.set_override('ftp_pool_acquire_timeout', 0)
+        self.addCleanup(CONF.clear_override, 'ftp_pool_acquire_timeout')
+        session = self.pool.acquire('host', 21, 'user', 'pw')
+
+        self.assertRaises(exception.DownLoadDataError, self.pool.acquire,
+                          'host', 21, 'user', 'pw')
+        # other servers are not limited by it
+        self.pool.acquire('other', 21, 'user', 'pw')
+
+        CONF.set_override('ftp_pool_acquire_timeout', 10)
+        got = []
+        waiter = threading.Thread(
+            target=lambda: got.append(self.pool.acquire('host', 21, 'user',
+                                                        'pw')))
+        waiter.start()
+        self.pool.release(session)
+        waiter.join(10)
+        self.assertEqual([session], got)
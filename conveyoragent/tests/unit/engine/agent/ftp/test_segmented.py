@@ -0,0 +1,96 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from conveyoragent.common import config
+from conveyoragent.engine.agent.ftp import ftp
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.engine.agent.ftp import segmented
+from conveyoragent import exception
+from conveyoragent.tests.unit.engine.agent.ftp import fakes
+
+CONF = config.CONF
+
+
+class TestSegmentedDownload(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSegmentedDownload, self).setUp()
+        patcher = mock.patch.object(pool.ftplib, 'FTP', fakes.FakeFTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(pool, '_pool', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name, value in (('ftp_segment_size', 1000),
+                            ('ftp_segment_min_file_size', 2000),
+                            ('ftp_segment_sessions', 3)):
+            CONF.set_override(name, value)
+            self.addCleanup(CONF.clear_override, name)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.local = os.path.join(self.tmpdir, 'image')
+        self.data = os.urandom(4500)
+        fakes.FakeFTP.reset({'/disk': None, '/disk/image': self.data})
+        self.agent = ftp.FtpAgent(host='src', port=21)
+
+    def _read(self):
+        with open(self.local, 'rb') as f:
+            return f.read()
+
+    def test_download(self):
+        self.assertEqual(0, self.agent.downLoadFileExt(
+            'src', 21, self.local, '/disk/image'))
+
+        self.assertEqual(self.data, self._read())
+        self.assertFalse(segmented.is_pending(self.local))
+        self.assertEqual([0, 1000, 2000, 3000, 4000],
+                         sorted(rest for _path, rest
+                                in fakes.FakeFTP.retrieved))
+
+    def test_no_free_session(self):
+        CONF.set_override('ftp_pool_max_per_host', 1)
+        self.addCleanup(CONF.clear_override, 'ftp_pool_max_per_host')
+
+        self.assertEqual(0, self.agent.downLoadFileExt(
+            'src', 21, self.local, '/disk/image'))
+
+        # the caller fetches every segment on its own session
+        self.assertEqual(self.data, self._read())
+        self.assertEqual(1, fakes.FakeFTP.connects)
+
+    def test_retry_fetches_missing_segments(self):
+        transfercmd = fakes.FakeFTP.transfercmd
+
+        def fail_third(ftp, cmd, rest=None):
+            if rest == 2000:
+                raise IOError('connection reset')
+            return transfercmd(ftp, cmd, rest)
+        with mock.patch.object(fakes.FakeFTP, 'transfercmd', fail_third):
+            self.assertRaises(exception.DownLoadDataError,
+                              self.agent.downLoadFileExt, 'src', 21,
+                              self.local, '/disk/image')
+        self.assertTrue(segmented.is_pending(self.local))
+
+        fakes.FakeFTP.retrieved = []
+        self.assertEqual(0, self.agent.downLoadFileExt(
+            'src', 21, self.local, '/disk/image'))
+
+        self.assertEqual([('/disk/image', 2000)], fakes.FakeFTP.retrieved)
+        self.assertEqual(self.data, self._read())
+        self.assertFalse(segmented.is_pending(self.local))
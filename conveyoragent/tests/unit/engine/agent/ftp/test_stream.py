@@ -0,0 +1,104 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import mock
+import testtools
+
+from conveyoragent.common import config
+from conveyoragent.engine.agent.ftp import ftp
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.engine.agent.ftp import stream
+from conveyoragent.tests.unit.engine.agent.ftp import fakes
+
+CONF = config.CONF
+
+
+class TestReceive(testtools.TestCase):
+
+    def setUp(self):
+        super(TestReceive, self).setUp()
+        CONF.set_override('ftp_receive_buffer_size', 4096)
+        self.addCleanup(CONF.clear_override, 'ftp_receive_buffer_size')
+        self.data = os.urandom(100000)
+        self.sock, peer = socket.socketpair()
+        self.addCleanup(self.sock.close)
+
+        def send():
+            peer.sendall(self.data)
+            peer.close()
+        self.sender = threading.Thread(target=send)
+        self.sender.start()
+        self.addCleanup(self.sender.join)
+
+    def test_receive(self):
+        chunks = []
+        before = stream.get_counters().to_dict()
+
+        received = stream.receive(self.sock,
+                                  lambda view: chunks.append(view.tobytes()))
+
+        self.assertEqual(len(self.data), received)
+        self.assertEqual(self.data, b''.join(chunks))
+        self.assertTrue(all(len(c) <= 4096 for c in chunks))
+        after = stream.get_counters().to_dict()
+        self.assertEqual(before['transfers'] + 1, after['transfers'])
+        self.assertEqual(before['bytes'] + len(self.data), after['bytes'])
+
+    def test_receive_length(self):
+        chunks = []
+        limiter = mock.Mock()
+
+        received = stream.receive(self.sock,
+                                  lambda view: chunks.append(view.tobytes()),
+                                  limiter=limiter, length=5000)
+
+        self.assertEqual(5000, received)
+        self.assertEqual(self.data[:5000], b''.join(chunks))
+        self.assertEqual(5000, sum(c[0][0] for c in
+                                   limiter.consume.call_args_list))
+        self.sock.recv_into(bytearray(len(self.data)), 0,
+                            socket.MSG_WAITALL)
+
+
+class TestDownLoadFileExt(testtools.TestCase):
+
+    def setUp(self):
+        super(TestDownLoadFileExt, self).setUp()
+        patcher = mock.patch.object(pool.ftplib, 'FTP', fakes.FakeFTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(pool, '_pool', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_resume(self):
+        data = os.urandom(5000)
+        fakes.FakeFTP.reset({'/disk': None, '/disk/image': data})
+        local = os.path.join(self.tmpdir, 'image')
+        with open(local, 'wb') as f:
+            f.write(data[:1200])
+        agent = ftp.FtpAgent(host='src', port=21)
+
+        self.assertEqual(0, agent.downLoadFileExt('src', 21, local,
+                                                  '/disk/image'))
+
+        self.assertEqual([('/disk/image', 1200)], fakes.FakeFTP.retrieved)
+        with open(local, 'rb') as f:
+            self.assertEqual(data, f.read())
@@ -0,0 +1,119 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from conveyoragent.common import config
+from conveyoragent.engine.agent.ftp import ftp
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.engine.agent.ftp import sync
+from conveyoragent.tests.unit.engine.agent.ftp import fakes
+
+CONF = config.CONF
+
+
+class TestManifest(testtools.TestCase):
+
+    def setUp(self):
+        super(TestManifest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'sync', 'manifest')
+
+    def test_check(self):
+        manifest = sync.Manifest(self.path).load()
+        manifest.record(sync.PARTIAL, 'a', 10, 100)
+        manifest.record(sync.COMPLETE, 'a', 10, 100)
+        manifest.record(sync.PARTIAL, 'dir/with space', 10, 100)
+        manifest._log.flush()
+
+        # records appended and not compacted are read back too
+        manifest = sync.Manifest(self.path).load()
+        self.assertEqual((sync.SKIP, 0), manifest.check('a', 10, 100, 10))
+        self.assertEqual((sync.FETCH, 0), manifest.check('a', 11, 100, 10))
+        self.assertEqual((sync.FETCH, 0), manifest.check('a', 10, 101, 10))
+        self.assertEqual((sync.FETCH, 0), manifest.check('a', 10, 100,
+                                                         None))
+        self.assertEqual((sync.RESUME, 4),
+                         manifest.check('dir/with space', 10, 100, 4))
+        self.assertEqual((sync.FETCH, 0), manifest.check('b', 10, 100, 10))
+        manifest.close()
+
+        with open(self.path, 'rb') as f:
+            self.assertEqual(2, f.read().count(b'\0'))
+
+
+class TestSyncDownload(testtools.TestCase):
+
+    def setUp(self):
+        super(TestSyncDownload, self).setUp()
+        patcher = mock.patch.object(pool.ftplib, 'FTP', fakes.FakeFTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(pool, '_pool', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        CONF.set_override('ftp_sync_manifest_dir',
+                          os.path.join(self.tmpdir, 'sync'))
+        self.addCleanup(CONF.clear_override, 'ftp_sync_manifest_dir')
+        self.local = os.path.join(self.tmpdir, 'data')
+        self.agent = ftp.FtpAgent(host='src', port=21)
+
+    def _download(self):
+        fakes.FakeFTP.retrieved = []
+        self.agent.downLoadDirTree('src', 21, self.local, '/data',
+                                   sync=True)
+        return set(fakes.FakeFTP.retrieved)
+
+    def _read(self, rel):
+        with open(os.path.join(self.local, rel), 'rb') as f:
+            return f.read()
+
+    def _test_sync(self, mlsd):
+        fakes.FakeFTP.reset({'/data': None, '/data/same': b'same',
+                             '/data/changed': b'old',
+                             '/data/touched': b'touched',
+                             '/data/big': b'0123456789'}, mlsd=mlsd)
+        self.assertEqual(set(['/data/big', '/data/changed', '/data/same',
+                              '/data/touched']), self._download())
+
+        fakes.FakeFTP.files.update({'/data/changed': b'new!',
+                                    '/data/new': b'new'})
+        fakes.FakeFTP.mtimes['/data/touched'] = '20210101000000'
+        # left partial by an earlier run
+        manifest = sync.Manifest(sync.manifest_path(
+            'src', 21, '/data', self.local)).load()
+        manifest.record(sync.PARTIAL, 'big', 10, 1577836800)
+        manifest.close()
+        with open(os.path.join(self.local, 'big'), 'wb') as f:
+            f.write(b'0123')
+
+        self.assertEqual(set([('/data/big', 4), '/data/changed',
+                              '/data/new', '/data/touched']),
+                         self._download())
+        self.assertEqual(b'0123456789', self._read('big'))
+        self.assertEqual(b'new!', self._read('changed'))
+
+        self.assertEqual(set(), self._download())
+
+    def test_sync_mlsd(self):
+        self._test_sync(mlsd=True)
+
+    def test_sync_mdtm(self):
+        self._test_sync(mlsd=False)
@@ -0,0 +1,134 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+
+import mock
+import testtools
+
+from conveyoragent.common import config
+from conveyoragent.engine.agent.ftp import ftp
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.engine.agent.ftp import tree
+from conveyoragent import exception
+from conveyoragent.tests.unit.engine.agent.ftp import fakes
+
+CONF = config.CONF
+
+
+class TestTreeDownload(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTreeDownload, self).setUp()
+        patcher = mock.patch.object(pool.ftplib, 'FTP', fakes.FakeFTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(pool, '_pool', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.agent = ftp.FtpAgent(host='src', port=21)
+
+    def _read(self, *parts):
+        with open(os.path.join(self.tmpdir, *parts), 'rb') as f:
+            return f.read()
+
+    def test_download_tree(self):
+        fakes.FakeFTP.reset({
+            '/data': None,
+            '/data/small': b'a',
+            '/data/big': b'b' * 5000,
+            '/data/sub': None,
+            '/data/sub/mid': b'c' * 100,
+            '/data/sub/empty': None,
+        })
+
+        self.agent.downLoadDirTree('src', 21, self.tmpdir, 'data',
+                                   workers=1)
+
+        self.assertEqual(b'a', self._read('small'))
+        self.assertEqual(b'b' * 5000, self._read('big'))
+        self.assertEqual(b'c' * 100, self._read('sub', 'mid'))
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpdir, 'sub',
+                                                   'empty')))
+        # the walker and the worker each have a session
+        self.assertEqual(2, fakes.FakeFTP.connects)
+
+    def test_ftp_port(self):
+        fakes.FakeFTP.reset({'/a': b'a', '/b': b'b' * 5000})
+
+        # the port of the api of the source agent
+        self.agent.downLoadDirTree('src', '9998', self.tmpdir, '/',
+                                   workers=2)
+
+        self.assertEqual(b'b' * 5000, self._read('b'))
+        self.assertEqual(set([('src', 21)]), set(fakes.FakeFTP.dialled))
+
+    def test_largest_first(self):
+        fakes.FakeFTP.reset({
+            '/small': b'a',
+            '/big': b'b' * 5000,
+            '/mid': b'c' * 100,
+        })
+        walked = threading.Event()
+        walk = tree.TreeDownload._walk
+        download = tree.TreeDownload._download_queued
+
+        def walk_then_signal(self):
+            walk(self)
+            walked.set()
+
+        def download_after_walk(self):
+            walked.wait(10)
+            download(self)
+
+        # the worker only starts once everything is listed
+        with mock.patch.object(tree.TreeDownload, '_walk',
+                               walk_then_signal), \
+                mock.patch.object(tree.TreeDownload, '_download_queued',
+                                  download_after_walk):
+            self.agent.downLoadDirTree('src', 21, self.tmpdir, '/',
+                                       workers=1)
+
+        self.assertEqual(['/big', '/mid', '/small'],
+                         fakes.FakeFTP.retrieved)
+
+    def test_no_worker_session(self):
+        fakes.FakeFTP.reset({'/a': b'a', '/b': b'b' * 5000})
+        CONF.set_override('ftp_pool_max_per_host', 1)
+        self.addCleanup(CONF.clear_override, 'ftp_pool_max_per_host')
+
+        self.agent.downLoadDirTree('src', 21, self.tmpdir, '/', workers=4)
+
+        # the walker downloads what no worker could
+        self.assertEqual(b'a', self._read('a'))
+        self.assertEqual(b'b' * 5000, self._read('b'))
+        self.assertEqual(1, fakes.FakeFTP.connects)
+
+    def test_failed_file(self):
+        fakes.FakeFTP.reset({'/a': b'a', '/b': b'b'})
+        retrbinary = fakes.FakeFTP.retrbinary
+
+        def fail_a(ftp, cmd, callback, *args, **kwargs):
+            if cmd.endswith('/a'):
+                raise IOError('disk full')
+            return retrbinary(ftp, cmd, callback, *args, **kwargs)
+        with mock.patch.object(fakes.FakeFTP, 'retrbinary', fail_a):
+            self.assertRaises(exception.DownLoadDataError,
+                              self.agent.downLoadDirTree, 'src', 21,
+                              self.tmpdir, '/', workers=2)
+
+        self.assertEqual(b'b', self._read('b'))
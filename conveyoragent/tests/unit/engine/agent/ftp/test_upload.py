@@ -0,0 +1,88 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import tempfile
+
+import mock
+import testtools
+
+from conveyoragent.engine.agent.ftp import ftp
+from conveyoragent.engine.agent.ftp import pool
+from conveyoragent.engine.agent.ftp import upload
+from conveyoragent import exception
+from conveyoragent.tests.unit.engine.agent.ftp import fakes
+
+
+class TestTreeUpload(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTreeUpload, self).setUp()
+        patcher = mock.patch.object(pool.ftplib, 'FTP', fakes.FakeFTP)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(pool, '_pool', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.local = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.local)
+        self.content = {'a': b'a' * 10, 'd/b': b'b' * 300,
+                        'd/e/c': b'c' * 20, 'd/e/f/g': b''}
+        for rel, data in self.content.items():
+            path = os.path.join(self.local, rel)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(data)
+        os.mkdir(os.path.join(self.local, 'empty'))
+        os.symlink(os.path.join(self.local, 'd'),
+                   os.path.join(self.local, 'loop'))
+        self.agent = ftp.FtpAgent(host='src', port=21)
+
+    def test_manifest(self):
+        dirs, files = upload.manifest(self.local)
+
+        self.assertEqual(['d', 'd/e', 'd/e/f', 'empty'], sorted(dirs))
+        for rel in ('d/e', 'd/e/f'):
+            self.assertLess(dirs.index(os.path.dirname(rel)),
+                            dirs.index(rel))
+        self.assertEqual(sorted((rel, len(data)) for rel, data
+                                in self.content.items()), sorted(files))
+
+    def test_upload(self):
+        fakes.FakeFTP.reset({'/data': None, '/data/d': None})
+
+        self.agent.upLoadDirTree('src', 21, self.local, '/data', workers=3)
+
+        for rel, data in self.content.items():
+            self.assertEqual(data, fakes.FakeFTP.files['/data/' + rel])
+        self.assertIsNone(fakes.FakeFTP.files['/data/empty'])
+        self.assertNotIn('/data/loop', fakes.FakeFTP.files)
+        self.assertEqual(5, fakes.FakeFTP.in_flight)
+
+    def test_failed_file(self):
+        fakes.FakeFTP.reset({})
+        storbinary = fakes.FakeFTP.storbinary
+
+        def fail_b(ftp, cmd, *args, **kwargs):
+            if cmd.endswith('/b'):
+                raise IOError('quota exceeded')
+            return storbinary(ftp, cmd, *args, **kwargs)
+        with mock.patch.object(fakes.FakeFTP, 'storbinary', fail_b):
+            self.assertRaises(exception.UpLoadDataError,
+                              self.agent.upLoadDirTree, 'src', 21,
+                              self.local, '/data')
+
+        self.assertNotIn('/data/d/b', fakes.FakeFTP.files)
+        self.assertEqual(self.content['d/e/c'],
+                         fakes.FakeFTP.files['/data/d/e/c'])
@@ -0,0 +1,148 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+
+import mock
+from oslo_config import cfg
+import testtools
+
+from conveyoragent.engine.agent.pull import client
+from conveyoragent.engine.agent.pull import pull
+from conveyoragent.engine.agent.pull import server
+from conveyoragent import exception
+
+CONF = cfg.CONF
+
+
+class TestPull(testtools.TestCase):
+
+    def setUp(self):
+        super(TestPull, self).setUp()
+        self.src = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.src)
+        self.dst = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dst)
+        self.server = server.start(self.src, host='127.0.0.1')
+        self.addCleanup(self.server.stop)
+        self.agent = pull.PullAgent()
+
+    def _write(self, rel, data, mode=0o644, mtime=1500000000):
+        path = os.path.join(self.src, rel)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.chmod(path, mode)
+        os.utime(path, (mtime, mtime))
+
+    def _read(self, rel):
+        with open(os.path.join(self.dst, rel), 'rb') as f:
+            return f.read()
+
+    def _client(self, token=None):
+        return client.FileClient('127.0.0.1', self.server.port,
+                                 token or self.server.token).connect()
+
+    def test_pull_tree(self):
+        self._write('a', b'x' * 1000, mode=0o600)
+        self._write('d/b', b'y' * 10)
+        self._write('d/e/c', b'')
+        os.symlink('../a', os.path.join(self.src, 'd', 'link'))
+        os.symlink('/etc/hostname', os.path.join(self.src, 'out'))
+
+        download = self.agent.downLoadDirTree(
+            '127.0.0.1', self.server.port, self.server.token, self.dst)
+
+        self.assertEqual(b'x' * 1000, self._read('a'))
+        self.assertEqual(b'y' * 10, self._read('d/b'))
+        self.assertEqual(b'', self._read('d/e/c'))
+        # the link is served as the file, the one out of root not at all
+        self.assertEqual(b'x' * 1000, self._read('d/link'))
+        self.assertFalse(os.path.lexists(os.path.join(self.dst, 'out')))
+        st = os.stat(os.path.join(self.dst, 'a'))
+        self.assertEqual(0o600, stat.S_IMODE(st.st_mode))
+        self.assertEqual(1500000000, int(st.st_mtime))
+        self.assertEqual(4, download.files)
+        self.assertEqual(2010, download.bytes)
+
+    def test_pull_in_ranges(self):
+        CONF.set_override('pull_range_size', 1000)
+        self.addCleanup(CONF.clear_override, 'pull_range_size')
+        data = os.urandom(4500)
+        self._write('big', data)
+
+        download = self.agent.downLoadDirTree(
+            '127.0.0.1', self.server.port, self.server.token, self.dst,
+            workers=3)
+
+        self.assertEqual(data, self._read('big'))
+        self.assertEqual(1, download.files)
+        self.assertEqual(1500000000,
+                         int(os.stat(os.path.join(self.dst, 'big')).st_mtime))
+
+    def test_pull_sub_tree(self):
+        self._write('a', b'a')
+        self._write('d/b', b'b')
+        self.agent.downLoadDirTree('127.0.0.1', self.server.port,
+                                   self.server.token, self.dst, 'd')
+        self.assertEqual(b'b', self._read('b'))
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'a')))
+
+    def test_walk_out_of_local(self):
+        self._write('a', b'a')
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        os.symlink(outside, os.path.join(self.dst, 'link'))
+        evil = os.path.join(outside, 'evil')
+        for path in (os.path.relpath(evil, self.dst), 'link/evil'):
+            entries = [client.Entry(server.FILE, 1, 0, 0o644, 0, 0, 'a'),
+                       client.Entry(server.FILE, 1, 0, 0o644, 0, 0, path)]
+            with mock.patch.object(client.FileClient, 'walk',
+                                   return_value=iter(entries)):
+                self.assertRaises(exception.DownLoadDataError,
+                                  self.agent.downLoadDirTree, '127.0.0.1',
+                                  self.server.port, self.server.token,
+                                  self.dst)
+            self.assertFalse(os.path.exists(evil))
+        # nothing is pulled from such a walk
+        self.assertFalse(os.path.exists(os.path.join(self.dst, 'a')))
+
+    def test_get_range(self):
+        self._write('a', b'0123456789')
+        chunks = []
+        with self._client() as conn:
+            n = conn.get('a', 3, 4, lambda view: chunks.append(view.tobytes()))
+            # the connection carries on with the next request
+            conn.get('a', 8, -1, lambda view: chunks.append(view.tobytes()))
+        self.assertEqual(4, n)
+        self.assertEqual(b'3456' + b'89', b''.join(chunks))
+
+    def test_path_out_of_root(self):
+        with self._client() as conn:
+            self.assertRaises(exception.DownLoadDataError,
+                              conn.get, '../etc/passwd', 0, -1, None)
+            self.assertRaises(exception.DownLoadDataError,
+                              list, conn.walk('..'))
+
+    def test_wrong_token(self):
+        self._write('a', b'a')
+        with self._client(token='0' * 32) as conn:
+            self.assertRaises(exception.DownLoadDataError,
+                              conn.get, 'a', 0, -1, None)
+
+    def test_stop(self):
+        self.assertTrue(server.stop(self.server.port))
+        self.assertFalse(server.stop(self.server.port))
@@ -13,13 +13,22 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import threading
+import time
+
 import mock
+from oslo_serialization import jsonutils
+from oslo_utils import uuidutils
 import testtools
+import webob
 
 from conveyoragent.common import config
 from conveyoragent import context
 from conveyoragent.engine.api import extensions
 from conveyoragent.engine.api.v1 import v2vgatewayservices
+from conveyoragent.engine.common import task_status
+from conveyoragent.engine.common import transformer
+from conveyoragent.engine.common import transformer_state
 from conveyoragent.engine.server import manager
 
 CONF = config.CONF
@@ -49,3 +58,47 @@ class TestV2vGateWayServiceController(testtools.TestCase):
         mock_clone_volume.return_value = 'task-001'
         result = self.agent_service.create(self.ctx, body)
         self.assertEqual('task-001', result['body']['task_id'])
+
+    @mock.patch.object(manager.MigrationManager,
+                       'query_data_transformer_details')
+    @mock.patch.object(manager.MigrationManager,
+                       'query_data_transformer_state')
+    def test_show(self, mock_state, mock_details):
+        mock_state.return_value = 'DATA_TRANSFORMING'
+        mock_details.return_value = {'compression': {'algorithm': 'zlib',
+                                                     'ratio': 0.5}}
+        req = webob.Request.blank('/v2vGateWayServices/task-001')
+        result = self.agent_service.show(req, 'task-001')
+        self.assertEqual('DATA_TRANSFORMING', result['body']['task_state'])
+        self.assertEqual(0.5, result['body']['compression']['ratio'])
+
+    def _finish_later(self):
+        task_id = uuidutils.generate_uuid()
+        states = transformer_state.TransformerSate()
+        states.add_task(transformer.TransformerTask(
+            task_id, task_state=task_status.TRANSFORMERING))
+        self.addCleanup(states.remove, task_id)
+        timer = threading.Timer(0.2, states.update_state,
+                                (task_id, task_status.FINISHED))
+        timer.start()
+        self.addCleanup(timer.join)
+        return task_id
+
+    def test_show_wait(self):
+        task_id = self._finish_later()
+        req = webob.Request.blank('/v2vGateWayServices/%s?wait=10' %
+                                  task_id)
+        start = time.time()
+        result = self.agent_service.show(req, task_id)
+        self.assertEqual(task_status.FINISHED, result['body']['task_state'])
+        self.assertLess(time.time() - start, 5)
+
+    def test_events(self):
+        task_id = self._finish_later()
+        req = webob.Request.blank('/v2vGateWayServices/events?tasks=%s' %
+                                  task_id)
+        resp = self.agent_service.events(req)
+        states = [jsonutils.loads(line)['task_state']
+                  for line in resp.app_iter if line.strip()]
+        self.assertEqual([task_status.TRANSFORMERING, task_status.FINISHED],
+                         states)
@@ -0,0 +1,61 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+import testtools
+
+from conveyoragent.engine.common import executor
+from conveyoragent import exception
+
+
+class TestExecutor(testtools.TestCase):
+
+    def setUp(self):
+        super(TestExecutor, self).setUp()
+        self.executor = executor.Executor(workers=1, queue_size=2)
+        self.gate = threading.Event()
+        self.addCleanup(self.gate.set)
+        started = threading.Event()
+
+        def block():
+            started.set()
+            self.gate.wait(5)
+        # holds the only worker
+        self.executor.submit(block)
+        started.wait(5)
+
+    def test_priority_order(self):
+        ran = []
+        works = [self.executor.submit(ran.append, name, priority=priority)
+                 for name, priority in (('bulk', executor.PRECOPY),
+                                        ('cutover', executor.CUTOVER))]
+        self.gate.set()
+        for work in works:
+            work.join(5)
+        self.assertEqual(['cutover', 'bulk'], ran)
+
+    def test_queue_full(self):
+        for _i in range(2):
+            self.executor.submit(len, 'queued')
+        self.assertRaises(exception.TransferQueueFull,
+                          self.executor.submit, len, 'refused')
+        stats = self.executor.stats()
+        self.assertEqual(1, stats['rejected'])
+        self.assertEqual(2, stats['queued'])
+
+    def test_error_kept(self):
+        work = self.executor.submit(int, 'not a number')
+        self.gate.set()
+        work.join(5)
+        self.assertIsInstance(work.error, ValueError)
+        self.assertEqual(1, self.executor.stats()['failed'])
@@ -0,0 +1,61 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+
+import mock
+import testtools
+
+from conveyoragent.engine.common import notify
+
+
+class _Sender(threading.Thread):
+
+    def __init__(self, error=None):
+        threading.Thread.__init__(self)
+        self.error = error
+
+    def run(self):
+        pass
+
+
+class TestNotify(testtools.TestCase):
+
+    def test_wait_delivered(self):
+        callback_id = notify.expect()
+        self.addCleanup(notify.forget, callback_id)
+        self.assertIsNone(notify.wait(callback_id, 0.01))
+        self.assertTrue(notify.deliver(callback_id, notify.FINISHED))
+        self.assertEqual((notify.FINISHED, None),
+                         notify.wait(callback_id, 1))
+
+    def test_deliver_unknown(self):
+        self.assertFalse(notify.deliver('unknown', notify.FINISHED))
+
+    @mock.patch.object(notify.agentclient, 'get_birdiegateway_client')
+    def test_watch_pushes_end(self, get_client):
+        done = get_client.return_value.vservices.transfer_done
+        for error, status in ((None, notify.FINISHED),
+                              (IOError("reset"), notify.FAILED)):
+            sender = _Sender(error)
+            sender.start()
+            notify.watch(sender, None, '10.0.0.2:9998', 'cb').join(5)
+            get_client.assert_called_with('10.0.0.2', '9998')
+            done.assert_called_with('cb', status,
+                                    error=error and str(error))
+
+    @mock.patch.object(notify.requests, 'post')
+    def test_task_ended_posts_webhook(self, post):
+        self.assertIsNone(notify.task_ended('task', 'FINISHED', None))
+        notify.task_ended('task', 'FINISHED', 'http://caller/hook').join(5)
+        self.assertEqual('http://caller/hook', post.call_args[0][0])
+        self.assertIn('"task_id": "task"', post.call_args[1]['data'])
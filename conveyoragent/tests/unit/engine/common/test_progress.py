@@ -0,0 +1,58 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import testtools
+
+from conveyoragent.engine.common import progress
+from conveyoragent.engine.common import throttle
+
+
+class TestProgress(testtools.TestCase):
+
+    def setUp(self):
+        super(TestProgress, self).setUp()
+        self.now = 1000.0
+        patcher = mock.patch.object(progress.time, 'time',
+                                    side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rate_and_eta(self):
+        task_progress = progress.Progress(total=1000)
+        for _second in range(4):
+            self.now += 1
+            task_progress.add(100)
+        stats = task_progress.to_dict()
+        self.assertEqual(400, stats['bytes_done'])
+        self.assertEqual(100, stats['rate'])
+        self.assertEqual(100, stats['average_rate'])
+        self.assertEqual(6, stats['eta'])
+
+    def test_stalled(self):
+        task_progress = progress.Progress()
+        self.now += 1
+        task_progress.add(100)
+        self.now += 10
+        stats = task_progress.to_dict()
+        self.assertEqual(0, stats['rate'])
+        self.assertIsNone(stats['eta'])
+
+    def test_resumed_not_in_rate(self):
+        task_progress = progress.Progress(total=1000)
+        task_progress.start_at(800)
+        self.now += 2
+        throttle.limiter(progress=task_progress).consume(100)
+        stats = task_progress.to_dict()
+        self.assertEqual(900, stats['bytes_done'])
+        self.assertEqual(50, stats['average_rate'])
+        self.assertEqual(2, stats['eta'])
@@ -0,0 +1,122 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import threading
+import time
+
+from oslo_config import cfg
+import testtools
+
+from conveyoragent.engine.common import scheduler
+from conveyoragent.engine.common import task_status
+from conveyoragent.engine.common import transformer_state
+from conveyoragent import exception
+
+CONF = cfg.CONF
+
+
+def _volume(dev, peer='10.0.0.1'):
+    return {'src_dev_name': dev, 'src_gw_url': '%s:9998' % peer,
+            'trans_protocol': 'block'}
+
+
+class TestScheduler(testtools.TestCase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        for name, value in (('clone_max_running', 2),
+                            ('clone_max_per_device', 1),
+                            ('clone_max_per_peer', 2)):
+            CONF.set_override(name, value)
+            self.addCleanup(CONF.clear_override, name)
+        self.started = []
+        self.cond = threading.Condition()
+        self.scheduler = scheduler.Scheduler(self._start)
+        self.states = transformer_state.TransformerSate()
+
+    def _start(self, volume, task_id):
+        with self.cond:
+            self.started.append((volume['src_dev_name'], task_id))
+            self.cond.notify_all()
+        if volume.get('fail'):
+            raise IOError("no disk")
+        self.states.update_state(task_id, task_status.TRANSFORMERING)
+        return task_id
+
+    def _wait_started(self, count):
+        deadline = time.time() + 5
+        with self.cond:
+            while len(self.started) < count and time.time() < deadline:
+                self.cond.wait(0.1)
+        # none more than count
+        time.sleep(0.05)
+        return [dev for dev, _task_id in self.started]
+
+    def _finish(self, task_id):
+        self.states.update_state(task_id, task_status.FINISHED)
+        self.scheduler.task_done(task_id)
+
+    def test_largest_first_within_caps(self):
+        volumes = [_volume('a'), _volume('b'), _volume('c'), _volume('d')]
+        job_id, task_ids = self.scheduler.submit(volumes, [10, 40, 30, 20])
+
+        self.assertEqual(4, len(task_ids))
+        self.assertEqual(['b', 'c'], sorted(self._wait_started(2)))
+        job = self.scheduler.get_job(job_id)
+        self.assertEqual([task_status.QUEUED, task_status.TRANSFORMERING,
+                          task_status.TRANSFORMERING, task_status.QUEUED],
+                         [task['task_state'] for task in job['tasks']])
+
+        # a free slot starts the largest queued volume
+        self._finish(task_ids[2])
+        self.assertEqual(['b', 'c', 'd'], sorted(self._wait_started(3)))
+
+    def test_shortest_first(self):
+        volumes = [_volume('a'), _volume('b'), _volume('c')]
+        self.scheduler.submit(volumes, [10, 40, 30],
+                              policy=scheduler.SHORTEST_FIRST)
+        self.assertEqual(['a', 'c'], sorted(self._wait_started(2)))
+
+    def test_device_and_peer_caps(self):
+        CONF.set_override('clone_max_running', 4)
+        CONF.set_override('clone_max_per_peer', 1)
+        volumes = [_volume('a'), _volume('a', peer='10.0.0.2'),
+                   _volume('b'), _volume('c', peer='10.0.0.3')]
+        self.scheduler.submit(volumes, [4, 3, 2, 1])
+        # b waits for the peer of a
+        self.assertEqual(['a', 'a', 'c'], sorted(self._wait_started(3)))
+
+    def test_failed_start_frees_its_slot(self):
+        volumes = [dict(_volume('a'), fail=True), _volume('b'),
+                   _volume('c')]
+        job_id, task_ids = self.scheduler.submit(volumes, [3, 2, 1])
+        self.assertEqual(['a', 'b', 'c'], sorted(self._wait_started(3)))
+        self.assertEqual(task_status.ERROR,
+                         self.states.get_task_state(task_ids[0]))
+
+    def test_finished_jobs_forgotten(self):
+        CONF.set_override('clone_finished_jobs', 1)
+        jobs = [self.scheduler.submit([_volume(dev)], [1])
+                for dev in ('a', 'b')]
+        self._wait_started(2)
+        for job_id, task_ids in jobs:
+            self.assertIsNotNone(self.scheduler.get_job(job_id))
+            self._finish(task_ids[0])
+
+        # only the last job finished is kept
+        self.assertIsNone(self.scheduler.get_job(jobs[0][0]))
+        job = self.scheduler.get_job(jobs[1][0])
+        self.assertEqual(task_status.FINISHED, job['tasks'][0]['task_state'])
+
+    def test_bad_policy(self):
+        self.assertRaises(exception.InvalidInput, self.scheduler.submit,
+                          [_volume('a')], [1], policy='random')
@@ -0,0 +1,74 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import testtools
+
+from conveyoragent.engine.common import throttle
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+class TestTokenBucket(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTokenBucket, self).setUp()
+        self.clock = FakeClock()
+        for name in ('time', 'sleep'):
+            patcher = mock.patch.object(throttle.time, name,
+                                        getattr(self.clock, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_rate(self):
+        bucket = throttle.TokenBucket(1000)
+
+        # the burst goes out at once, the rest at the rate
+        bucket.consume(500)
+        self.assertEqual(0, self.clock.slept)
+        bucket.consume(2000)
+        self.assertAlmostEqual(2.0, self.clock.slept)
+
+    def test_change_rate_while_waiting(self):
+        bucket = throttle.TokenBucket(100)
+        sleep = self.clock.sleep
+
+        def raise_rate(seconds):
+            sleep(seconds)
+            bucket.set_rate(0)
+        with mock.patch.object(throttle.time, 'sleep', raise_rate):
+            bucket.consume(10000)
+
+        self.assertAlmostEqual(0.5, self.clock.slept)
+
+    def test_task_limits(self):
+        self.addCleanup(throttle.release, 'task')
+        limiter = throttle.limiter('task', rate=1000)
+
+        self.assertEqual(1000, throttle.get_limit('task'))
+        self.assertTrue(throttle.set_limit(10, task_id='task'))
+        self.assertEqual(10, limiter.buckets[1].rate)
+        self.assertFalse(throttle.set_limit(10, task_id='other'))
+        throttle.release('task')
+        self.assertIsNone(throttle.get_limit('task'))
@@ -0,0 +1,159 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Compare the ftp receive loops over a loopback ftp stand-in.
+
+    python tools/ftp_receive_benchmark.py [--size MiB] [--rounds N]
+
+A minimal server on 127.0.0.1 answers the commands of ftplib.FTP and sends
+size MiB of zeros for every RETR. Each loop downloads it rounds times to
+/dev/null:
+
+  recv     a new string per recv(), as the receive loop of downLoadFileExt
+           used to, without its sleep of 3 seconds per chunk
+  recv 1k  retrbinary with ftp_buffersize blocks, as downLoadFile used to
+  into     stream.receive, recv_into a buffer reused by the thread
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+from conveyoragent.engine.agent.ftp import ftplib
+from conveyoragent.engine.agent.ftp import stream
+
+MiB = 1024 * 1024
+
+
+class StandIn(object):
+    """Serves RETR of size bytes to one client at a time, passive only."""
+
+    def __init__(self, size):
+        self.size = size
+        self.chunk = b'\0' * MiB
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self._serve)
+        thread.daemon = True
+        thread.start()
+
+    def _serve(self):
+        while True:
+            conn, _addr = self.sock.accept()
+            try:
+                self._session(conn)
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def _session(self, conn):
+        ctrl = conn.makefile('rb')
+
+        def reply(line):
+            conn.sendall(line + b'\r\n')
+        reply(b'220 stand-in')
+        data = None
+        rest = 0
+        while True:
+            line = ctrl.readline().strip()
+            if not line:
+                return
+            cmd = line.split(b' ', 1)[0].upper()
+            if cmd == b'PASV':
+                data = socket.socket()
+                data.bind(('127.0.0.1', 0))
+                data.listen(1)
+                port = data.getsockname()[1]
+                reply(b'227 Entering Passive Mode (127,0,0,1,%d,%d)' %
+                      (port >> 8, port & 0xff))
+            elif cmd == b'SIZE':
+                reply(b'213 %d' % self.size)
+            elif cmd == b'REST':
+                rest = int(line.split()[1])
+                reply(b'350 Restarting')
+            elif cmd == b'RETR':
+                reply(b'150 Opening data connection')
+                sock, _addr = data.accept()
+                data.close()
+                left = self.size - rest
+                while left > 0:
+                    n = min(left, len(self.chunk))
+                    sock.sendall(self.chunk[:n])
+                    left -= n
+                sock.close()
+                rest = 0
+                reply(b'226 Transfer complete')
+            elif cmd == b'QUIT':
+                reply(b'221 Bye')
+                return
+            elif cmd == b'USER':
+                reply(b'331 Password')
+            else:
+                reply(b'200 OK')
+
+
+def recv_strings(ftp, devnull, blocksize):
+    conn = ftp.transfercmd('RETR image')
+    while True:
+        data = conn.recv(blocksize)
+        if not data:
+            break
+        devnull.write(data)
+    conn.close()
+    ftp.voidresp()
+
+
+def recv_into(ftp, devnull):
+    conn = ftp.transfercmd('RETR image')
+    stream.receive(conn, devnull.write)
+    conn.close()
+    ftp.voidresp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--size', type=int, default=1024,
+                        help='MiB sent per download')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    server = StandIn(args.size * MiB)
+    ftp = ftplib.FTP()
+    stream.configure(ftp)
+    ftp.connect('127.0.0.1', server.port)
+    ftp.login('bench', 'bench')
+    ftp.voidcmd('TYPE I')
+
+    loops = [
+        ('recv', lambda out: recv_strings(ftp, out, MiB)),
+        ('recv 1k', lambda out: ftp.retrbinary('RETR image', out.write,
+                                               1024)),
+        ('into', lambda out: recv_into(ftp, out)),
+    ]
+    with open('/dev/null', 'wb') as devnull:
+        for name, loop in loops:
+            best = None
+            for _round in range(args.rounds):
+                start = time.time()
+                loop(devnull)
+                spent = time.time() - start
+                best = spent if best is None else min(best, spent)
+            print('%-8s %8.1f MiB/s' % (name, args.size / best))
+    ftp.quit()
+
+
+if __name__ == '__main__':
+    main()